@@ -136,5 +136,73 @@ STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.ManifestStaticFilesSto
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Questionnaire: keep the answer path in a signed ?t= token instead of the
+# session, so wizard steps never write to the database.
+BTN_STATELESS_WIZARD = os.getenv("BTN_STATELESS_WIZARD", "0") == "1"
+
+# /api/tree/ Cache-Control max-age for unversioned requests (?v=<version> is immutable)
+BTN_TREE_CACHE_SECONDS = int(os.getenv("BTN_TREE_CACHE_SECONDS", "3600"))
+
+# Bearer token for POST /api/batch/ (partner bulk scoring); empty disables it
+BTN_PARTNER_API_TOKEN = os.getenv("BTN_PARTNER_API_TOKEN", "")
+
+# Questionnaire trees by segment. A source is either a versioned JSON tree
+# file (re-checked every BTN_TREE_CHECK_SECONDS and switched without a
+# restart; compiled versions cached in BTN_TREE_CACHE_DIR) or a
+# "module:NAME" Python TREE. Trees are loaded on first use, except the
+# BTN_PRELOAD_SEGMENTS ones, which load at startup (before gunicorn forks).
+BTN_TREE_FILE = os.getenv("BTN_TREE_FILE", "")
+BTN_TREES = {
+    "konven": BTN_TREE_FILE or "recommender.tree_konven:TREE",
+}
+BTN_DEFAULT_SEGMENT = "konven"
+BTN_PRELOAD_SEGMENTS = [s for s in os.getenv("BTN_PRELOAD_SEGMENTS", "konven").split(",") if s]
+BTN_TREE_CACHE_DIR = Path(os.getenv("BTN_TREE_CACHE_DIR", BASE_DIR / "var" / "tree_cache"))
+BTN_TREE_CHECK_SECONDS = float(os.getenv("BTN_TREE_CHECK_SECONDS", "2"))
+
+# Rendered question pages are cached per (tree version, node, ...) in the
+# default cache; None = until evicted (a new tree version uses new keys)
+BTN_QUESTION_CACHE_SECONDS = None
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # rendered analytics charts (recommender/charts.py): least recently used
+    # beyond MAX_ENTRIES, dropped after TIMEOUT seconds
+    "charts": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "btn-charts",
+        "TIMEOUT": int(os.getenv("BTN_CHART_CACHE_SECONDS", "3600")),
+        "OPTIONS": {"MAX_ENTRIES": 64},
+    },
+    # events per hour/day by month (recommender/timeseries.py); finished
+    # months are kept until evicted, keyed on the history generation
+    "timeseries": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "btn-timeseries",
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 2000},
+    },
+}
+
+# Write finished-questionnaire events behind the request: spooled to
+# BTN_EVENT_SPOOL_DIR and inserted in bulk by a per-worker background thread
+# every BTN_EVENT_FLUSH_SECONDS (inline once BTN_EVENT_BUFFER_SIZE are pending)
+BTN_EVENT_WRITE_BEHIND = os.getenv("BTN_EVENT_WRITE_BEHIND", "0") == "1"
+BTN_EVENT_SPOOL_DIR = Path(os.getenv("BTN_EVENT_SPOOL_DIR", BASE_DIR / "var" / "event_spool"))
+BTN_EVENT_FLUSH_SECONDS = float(os.getenv("BTN_EVENT_FLUSH_SECONDS", "1"))
+BTN_EVENT_BUFFER_SIZE = int(os.getenv("BTN_EVENT_BUFFER_SIZE", "1000"))
+
+# Questionnaire funnel counters are summed per worker and written every
+# BTN_FUNNEL_FLUSH_SECONDS (0 = on every view/answer)
+BTN_FUNNEL_FLUSH_SECONDS = float(os.getenv("BTN_FUNNEL_FLUSH_SECONDS", "5"))
+
+# Rows per page of the analytics events table (?page_size= overrides, max 500)
+BTN_ANALYTICS_PAGE_SIZE = int(os.getenv("BTN_ANALYTICS_PAGE_SIZE", "50"))
+
+# Columnar event snapshot for offline analysis (manage.py snapshot_events)
+BTN_SNAPSHOT_DIR = Path(os.getenv("BTN_SNAPSHOT_DIR", BASE_DIR / "var" / "snapshot"))
+
 LOGIN_REDIRECT_URL = "/recommender/analytics/"
 LOGOUT_REDIRECT_URL = "/recommender/login/"
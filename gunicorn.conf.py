@@ -0,0 +1,24 @@
+# Picked up automatically by `gunicorn config.wsgi:application` (see Procfile).
+import gc
+
+# Load Django (and the BTN_PRELOAD_SEGMENTS trees) once in the master so the
+# forked workers share the compiled trees instead of each building their own.
+preload_app = True
+
+
+def when_ready(server):
+    # Move everything loaded so far out of the GC's reach; collections in the
+    # workers then don't touch (and copy) the shared pages.
+    gc.freeze()
+
+
+def worker_exit(server, worker):
+    # Write events still buffered by this worker (BTN_EVENT_WRITE_BEHIND);
+    # anything lost to a hard kill is replayed from its spool file.
+    from recommender import funnel
+    from recommender.events import event_buffer, write_behind
+
+    if write_behind():
+        event_buffer().flush()
+    # and the funnel counts it has not written yet
+    funnel.flush()
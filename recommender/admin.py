@@ -1,3 +1,37 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import DataGeneration, PathPrefix, SessionSketch
+
+
+class ReadOnlyAdmin(admin.ModelAdmin):
+    """Derived rows, kept by the events_saved / events_deleting receivers and rebuild_rollups: view only."""
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(SessionSketch)
+class SessionSketchAdmin(ReadOnlyAdmin):
+    list_display = ("day", "segment", "customer_type", "goal")
+    list_filter = ("segment", "customer_type", "goal")
+    date_hierarchy = "day"
+    exclude = ("registers",)
+
+
+@admin.register(PathPrefix)
+class PathPrefixAdmin(ReadOnlyAdmin):
+    list_display = ("segment", "parent", "node", "choice", "depth", "count", "ends")
+    list_filter = ("segment", "depth")
+    search_fields = ("parent", "node", "choice")
+    ordering = ("segment", "depth", "-count")
+
+
+@admin.register(DataGeneration)
+class DataGenerationAdmin(ReadOnlyAdmin):
+    list_display = ("name", "value")
@@ -0,0 +1,172 @@
+"""
+Rebuild every analytics aggregate (rollups.py, sketches.py, paths.py) from
+the event table, optionally in parallel.
+
+RecommendationEvent is split into primary-key ranges up to the highest id
+at the start. Each range is counted on its own (its events, then its
+EventProduct links, streamed and folded chunk_size rows at a time), in a
+pool of worker processes when workers > 1. The partial results are merged
+(Counters added, sketches merged) and written to the three aggregate tables
+in one transaction, so readers never see them from different rebuilds.
+
+Events saved while the ranges are counted (which can take minutes) are
+applied to the old tables by the events_saved receivers, and the write
+replaces those tables. So the events above the starting id are counted
+again inside the write transaction and included.
+
+Workers are spawned processes with their own database connection, so they
+read the configured database, not a test database that only exists in the
+parent's connection.
+"""
+from __future__ import annotations
+
+import multiprocessing
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import django
+from django.db import transaction
+from django.db.models import Max, Min
+
+from . import generation, hll, paths, rollups, sketches
+from .models import EventProduct, RecommendationEvent
+
+DEFAULT_RANGE_SIZE = 50_000
+DEFAULT_CHUNK_SIZE = 5000
+
+EVENT_FIELDS = (
+    "created_at", "goal", "customer_type", "recommended_products", "segment", "session_key", "answers",
+)
+
+
+class Partial(NamedTuple):
+    """Aggregates of one primary-key range (or the merge of several)."""
+
+    events: int
+    rollups: Counter
+    sketches: Dict[sketches.SketchKey, hll.Sketch]
+    path_counts: Counter
+    path_ends: Counter
+
+
+class RebuildStats(NamedTuple):
+    events: int
+    ranges: int
+    workers: int
+    rollups: int    # rows written
+    sketches: int
+    prefixes: int
+    count_seconds: float
+    seconds: float  # counting plus writing
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.events / self.count_seconds if self.count_seconds else 0.0
+
+
+def pk_ranges(range_size: int = DEFAULT_RANGE_SIZE) -> List[Tuple[int, int]]:
+    """
+    [(lo, hi), ...] half-open id ranges of range_size covering the event
+    table as it is now (the last one ends right after the highest id).
+    """
+    bounds = RecommendationEvent.objects.aggregate(lo=Min("id"), hi=Max("id"))
+    if bounds["lo"] is None:
+        return []
+    end = bounds["hi"] + 1
+    return [(lo, min(lo + range_size, end)) for lo in range(bounds["lo"], end, range_size)]
+
+
+def count_range(lo: int, hi: Optional[int], chunk_size: int = DEFAULT_CHUNK_SIZE) -> Partial:
+    """Aggregates of the events with lo <= id < hi (hi None: no upper bound)."""
+    part = Partial(0, Counter(), {}, Counter(), Counter())
+    events = 0
+    qs = RecommendationEvent.objects.filter(id__gte=lo)
+    links = EventProduct.objects.filter(event_id__gte=lo)
+    if hi is not None:
+        qs, links = qs.filter(id__lt=hi), links.filter(event_id__lt=hi)
+    rows = qs.values_list(*EVENT_FIELDS)
+    rows = rows.iterator(chunk_size=chunk_size)
+    while chunk := list(islice(rows, chunk_size)):
+        events += len(chunk)
+        rollups.count(((c, g, t, p) for c, g, t, p, _, _, _ in chunk), counts=part.rollups)
+        sketches.collect(((c, s, t, g, k) for c, g, t, _, s, k, _ in chunk), part.sketches)
+        paths.count(((segment, answers) for _, _, _, _, segment, _, answers in chunk), part.path_counts, part.path_ends)
+
+    links = links.values_list("event__created_at", "product__name")
+    rollups.count((), links.iterator(chunk_size=chunk_size), counts=part.rollups)
+    return part._replace(events=events)
+
+
+def merge(partials) -> Partial:
+    total = Partial(0, Counter(), {}, Counter(), Counter())
+    events = 0
+    for part in partials:
+        events += part.events
+        total.rollups.update(part.rollups)
+        sketches.merge_into(total.sketches, part.sketches)
+        total.path_counts.update(part.path_counts)
+        total.path_ends.update(part.path_ends)
+    return total._replace(events=events)
+
+
+def _count_all(
+    ranges: List[Tuple[int, int]],
+    workers: int,
+    chunk_size: int,
+    progress: Optional[Callable[[int, int, Partial], None]],
+) -> Partial:
+    done = 0
+
+    def finished(part: Partial) -> Partial:
+        nonlocal done
+        done += 1
+        if progress is not None:
+            progress(done, len(ranges), part)
+        return part
+
+    if workers <= 1 or len(ranges) <= 1:
+        return merge(finished(count_range(lo, hi, chunk_size)) for lo, hi in ranges)
+
+    # spawn: no threads or open connections inherited from this process
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(ranges)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=django.setup,
+    ) as pool:
+        futures = [pool.submit(count_range, lo, hi, chunk_size) for lo, hi in ranges]
+        return merge(finished(future.result()) for future in as_completed(futures))
+
+
+def rebuild_all(
+    workers: int = 1,
+    range_size: int = DEFAULT_RANGE_SIZE,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: Optional[Callable[[int, int, Partial], None]] = None,
+) -> RebuildStats:
+    """
+    Recount rollups, session sketches and the answer-path trie from all
+    events, counting range_size-id ranges on up to workers processes, and
+    bump the history generation.
+    progress(done, ranges, partial) is called as each range finishes.
+    """
+    started = time.perf_counter()
+    ranges = pk_ranges(range_size)
+    total = _count_all(ranges, workers, chunk_size, progress)
+    counted = time.perf_counter()
+
+    with transaction.atomic():
+        # events saved since the ranges were taken
+        total = merge([total, count_range(ranges[-1][1] if ranges else 0, None, chunk_size)])
+        written = (
+            rollups.write(total.rollups, chunk_size=chunk_size),
+            sketches.write(total.sketches),
+            paths.write(total.path_counts, total.path_ends, chunk_size=chunk_size),
+        )
+        generation.bump()  # rows may have been changed behind save_events(): drop cached history too
+    return RebuildStats(
+        total.events, len(ranges), workers, *written,
+        count_seconds=counted - started, seconds=time.perf_counter() - started,
+    )
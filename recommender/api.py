@@ -0,0 +1,224 @@
+"""
+JSON API for clients that walk the questionnaire themselves.
+
+- GET  /api/tree/       compiled TREE as compact JSON (ETag + long cache lifetime)
+
+All endpoints take an optional segment ("konven", ...; default
+BTN_DEFAULT_SEGMENT) selecting the tree.
+- POST /api/recommend/  one call with the finished answer path; logs the event
+- POST /api/batch/      partner bulk scoring (NDJSON/CSV in, NDJSON out)
+
+A browser or the mobile app fetches the tree once, asks every question
+locally and only talks to the server again to log the result: two requests
+per user instead of two per question.
+"""
+from __future__ import annotations
+
+import codecs
+import hashlib
+import hmac
+import json
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_GET, require_POST
+
+from .batch import DEFAULT_BATCH_SIZE, parse_records, score_records
+from .events import find_event, log_event, result_url, run_public_id
+from .path_token import new_run_id
+from .tree_engine import CompiledTree
+from .tree_store import UnknownSegment, default_segment, get_tree
+
+API_SESSION_PREFIX = "api:"  # session_key of events logged through /api/recommend/
+
+# (tree, body, ETag) per segment, for the segment's current compiled tree;
+# a compiled tree never changes, a reload replaces the entry.
+_TREE_JSON: Dict[str, Tuple[CompiledTree, bytes, str]] = {}
+
+
+def _tree_payload(tree: CompiledTree) -> Dict[str, Any]:
+    """
+    Node list indexed by node id:
+    - question: {"k": key, "q": text, "c": [[choice_key, label, next_id], ...]}
+    - leaf:     {"k": key, "p": [products], "l": [links]}
+    next_id -1 marks a choice pointing at a missing node.
+    """
+    nodes = []
+    for i, key in enumerate(tree.keys):
+        if tree.is_leaf[i]:
+            nodes.append({"k": key, "p": tree.products[i], "l": tree.links[i]})
+        else:
+            nodes.append({
+                "k": key,
+                "q": tree.texts[i],
+                "c": [[k, label, nxt] for (k, label), nxt in zip(tree.choices[i], tree.next_ids[i])],
+            })
+    return {"version": tree.version, "root": tree.root, "nodes": nodes}
+
+
+def _tree_json(segment: str, tree: CompiledTree) -> Tuple[bytes, str]:
+    """The serialized tree and its ETag (a hash of the body)."""
+    entry = _TREE_JSON.get(segment)
+    if entry is None or entry[0] is not tree:
+        payload = {"segment": segment, **_tree_payload(tree)}
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        entry = _TREE_JSON[segment] = (tree, body, hashlib.sha256(body).hexdigest()[:32])
+    return entry[1], entry[2]
+
+
+def _segment_tree(segment: str) -> Optional[CompiledTree]:
+    try:
+        return get_tree(segment)
+    except UnknownSegment:
+        return None
+
+
+def _tree_etag(request) -> Optional[str]:
+    segment = request.GET.get("segment") or default_segment()
+    tree = _segment_tree(segment)
+    return _tree_json(segment, tree)[1] if tree else None
+
+
+def _error(message: str, status: int = 400) -> JsonResponse:
+    return JsonResponse({"error": message}, status=status)
+
+
+@require_GET
+@condition(etag_func=_tree_etag)
+def tree_view(request):
+    """
+    The compiled tree for ?segment=. Clients revalidate with If-None-Match
+    (304 when the tree is unchanged); ?v=<version> URLs never change and are
+    cached as immutable.
+    """
+    segment = request.GET.get("segment") or default_segment()
+    tree = _segment_tree(segment)
+    if tree is None:
+        return _error("Unknown segment.", status=404)
+    response = HttpResponse(_tree_json(segment, tree)[0], content_type="application/json")
+    if request.GET.get("v") == tree.version:
+        patch_cache_control(response, public=True, max_age=365 * 24 * 3600, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=getattr(settings, "BTN_TREE_CACHE_SECONDS", 3600))
+    return response
+
+
+def _resolve(tree: CompiledTree, body: Dict[str, Any]) -> int:
+    """
+    Path id for a request body carrying either "path" (choice positions from
+    the root) or "answers" ({node_id: choice_key}); one index lookup either way.
+    Raises ValueError if it is not a complete root-to-leaf path of tree.
+    """
+    if "path" in body:
+        if not isinstance(body["path"], list):
+            raise ValueError("'path' must be a list of choice indices.")
+        path_id = tree.resolve_path(body["path"])
+    elif "answers" in body:
+        if not isinstance(body["answers"], dict):
+            raise ValueError("'answers' must be an object.")
+        path_id = tree.resolve(body["answers"])
+    else:
+        raise ValueError("Send 'path' or 'answers'.")
+
+    if path_id < 0:
+        raise ValueError("Path does not end on a recommendation.")
+    return path_id
+
+
+@csrf_exempt
+@require_POST
+def recommend_view(request):
+    """
+    Validate a finished answer path and log its RecommendationEvent.
+
+    Body: {"path": [0, 1, 0]} or {"answers": {...}}, plus optional
+    "segment", "version" (tree version the client walked; 409 if stale) and
+    "run_id" (client-chosen id; retrying the same run does not log twice).
+    """
+    try:
+        body = json.loads(request.body or b"{}")
+    except (ValueError, UnicodeDecodeError):
+        return _error("Body must be JSON.")
+    if not isinstance(body, dict):
+        return _error("Body must be a JSON object.")
+
+    tree = _segment_tree(str(body.get("segment") or default_segment()))
+    if tree is None:
+        return _error("Unknown segment.", status=404)
+
+    version = body.get("version")
+    if version and version != tree.version:
+        return _error("Tree version changed; reload /api/tree/.", status=409)
+
+    try:
+        path_id = _resolve(tree, body)
+    except ValueError as exc:
+        return _error(str(exc))
+
+    node = tree.path_leaf[path_id]
+    run_id = str(body.get("run_id") or "")[:48] or new_run_id()
+    session_key = f"{API_SESSION_PREFIX}{run_id}"
+    answers = tree.answers_for(tree.paths[path_id])
+
+    public_id = run_public_id(session_key, answers)
+    created = find_event(public_id) is None
+    if created:
+        log_event(tree, node, session_key, answers)
+
+    meta = tree.meta[node]
+    return JsonResponse({
+        "event_id": str(public_id),
+        "result_url": request.build_absolute_uri(result_url(public_id)),
+        "leaf": tree.keys[node],
+        "products": [
+            {"name": name, "url": tree.links[node][i] if i < len(tree.links[node]) else ""}
+            for i, name in enumerate(tree.products[node])
+        ],
+        "segment": meta.get("segment", ""),
+        "customer_type": meta.get("customer_type", ""),
+        "goal": meta.get("goal", ""),
+        "version": tree.version,
+    }, status=201 if created else 200)
+
+
+def _partner_authorized(request) -> bool:
+    expected = getattr(settings, "BTN_PARTNER_API_TOKEN", "")
+    given = request.headers.get("Authorization", "")
+    return bool(expected) and hmac.compare_digest(given, f"Bearer {expected}")
+
+
+@csrf_exempt
+@require_POST
+def batch_view(request):
+    """
+    Score a stream of answer sets for partner systems.
+
+    Auth: "Authorization: Bearer <BTN_PARTNER_API_TOKEN>" (disabled when unset).
+    Body: NDJSON, or CSV when Content-Type is text/csv (see batch.py).
+    ?segment= picks the tree; ?persist=1 also logs a RecommendationEvent per
+    valid record.
+    The request body is read line by line and results are streamed back as
+    NDJSON, so neither side holds the whole batch in memory.
+    """
+    if not _partner_authorized(request):
+        return _error("Forbidden", status=403)
+
+    fmt = "csv" if request.content_type == "text/csv" else "ndjson"
+    try:
+        batch_size = max(1, min(int(request.GET.get("batch_size", DEFAULT_BATCH_SIZE)), 10000))
+    except ValueError:
+        return _error("'batch_size' must be an integer.")
+
+    tree = _segment_tree(request.GET.get("segment") or default_segment())
+    if tree is None:
+        return _error("Unknown segment.", status=404)
+
+    records = parse_records(codecs.iterdecode(request, "utf-8"), fmt)
+    results = score_records(records, persist=request.GET.get("persist") == "1", batch_size=batch_size, tree=tree)
+    return StreamingHttpResponse(
+        (json.dumps(result, ensure_ascii=False) + "\n" for result in results),
+        content_type="application/x-ndjson",
+    )
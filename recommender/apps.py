@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class RecommenderConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'recommender'
+
+    def ready(self):
+        # Compile the commonly used trees up front. With gunicorn's
+        # preload_app this runs once in the master, before workers fork.
+        from django.conf import settings
+        from . import generation, paths, rollups, sketches  # noqa: F401  (keep the aggregates current on every insert)
+        from .tree_store import registry
+
+        registry().preload(getattr(settings, "BTN_PRELOAD_SEGMENTS", []))
@@ -0,0 +1,136 @@
+"""
+Batch scoring of pre-filled questionnaires (partner systems, overnight jobs).
+
+Input is a stream of answer sets, either
+
+- NDJSON: one object per line, {"ref": "...", "answers": {node_id: choice_key}}
+  or {"ref": "...", "path": [choice positions]}
+- CSV: a header row with an optional "ref" column and one column per node id;
+  empty cells are questions that were not on the customer's path
+
+Records are resolved in chunks against the compiled tree's path index (one
+hash lookup each). With persist=True each chunk's events are written with a
+single bulk_create (events.save_events). Results come back as an iterator of dicts in input order,
+so callers can stream them out while the input is still being read.
+"""
+from __future__ import annotations
+
+import csv
+import json
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from .events import build_event, save_events
+from .path_token import new_run_id
+from .tree_engine import CompiledTree
+from .tree_store import get_tree
+
+BATCH_SESSION_PREFIX = "batch:"  # session_key of events persisted by a batch run
+DEFAULT_BATCH_SIZE = 1000
+REF_COLUMN = "ref"
+
+
+def parse_ndjson(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    for line_no, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, dict):
+            yield {"line": line_no, "error": "Line is not a JSON object."}
+            continue
+        record["line"] = line_no
+        yield record
+
+
+def parse_csv(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    reader = csv.DictReader(lines)
+    for line_no, row in enumerate(reader, start=2):
+        ref = row.pop(REF_COLUMN, None)
+        answers = {k: v.strip() for k, v in row.items() if k and v and v.strip()}
+        yield {"line": line_no, "ref": ref, "answers": answers}
+
+
+def parse_records(lines: Iterable[str], fmt: str) -> Iterator[Dict[str, Any]]:
+    if fmt == "csv":
+        return parse_csv(lines)
+    if fmt == "ndjson":
+        return parse_ndjson(lines)
+    raise ValueError(f"Unknown batch format '{fmt}' (expected 'ndjson' or 'csv')")
+
+
+def _path_id(tree: CompiledTree, record: Dict[str, Any]) -> int:
+    if "path" in record:
+        return tree.resolve_path(record["path"])
+    return tree.resolve(record.get("answers") or {})
+
+
+def _result(tree: CompiledTree, record: Dict[str, Any], path_id: int) -> Dict[str, Any]:
+    out: Dict[str, Any] = {"line": record["line"], "ref": record.get("ref")}
+    if "error" in record:
+        out.update(ok=False, error=record["error"])
+        return out
+    if path_id < 0:
+        out.update(ok=False, error="Answers are not a complete path through the tree.")
+        return out
+
+    leaf = tree.path_leaf[path_id]
+    meta = tree.meta[leaf]
+    out.update(
+        ok=True,
+        leaf=tree.keys[leaf],
+        products=list(tree.products[leaf]),
+        links=list(tree.links[leaf]),
+        segment=meta.get("segment", ""),
+        customer_type=meta.get("customer_type", ""),
+        goal=meta.get("goal", ""),
+    )
+    return out
+
+
+def score_records(
+    records: Iterable[Dict[str, Any]],
+    persist: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    batch_id: Optional[str] = None,
+    tree: Optional[CompiledTree] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Resolve records chunk by chunk and yield one result dict per record.
+    The whole batch runs on one tree version (tree, default: get_tree()).
+
+    With persist=True, valid records get a RecommendationEvent (session_key
+    "batch:<batch_id>:<line>", no partner ref stored) and their result
+    carries the event_id.
+    """
+    tree = tree or get_tree()
+    batch_id = batch_id or new_run_id()
+    records = iter(records)
+    while True:
+        chunk: List[Dict[str, Any]] = list(islice(records, batch_size))
+        if not chunk:
+            return
+
+        results = []
+        events = []
+        for record in chunk:
+            path_id = -1 if "error" in record else _path_id(tree, record)
+            result = _result(tree, record, path_id)
+            results.append(result)
+            if persist and result["ok"]:
+                events.append((result, build_event(
+                    tree,
+                    tree.path_leaf[path_id],
+                    f"{BATCH_SESSION_PREFIX}{batch_id}:{record['line']}",
+                    tree.answers_for(tree.paths[path_id]),
+                )))
+
+        if events:
+            save_events([event for _, event in events])
+            for result, event in events:
+                result["event_id"] = str(event.public_id)
+
+        yield from results
@@ -0,0 +1,169 @@
+"""
+Dashboard chart definitions and their data, plus PNG rendering of them.
+
+The dashboard draws its charts in the browser from chart_data() (see
+views.analytics_data). PNG images are the fallback for clients without
+JavaScript: /analytics/chart/<name>/<fingerprint>.png, where the fingerprint
+of the numbers shown makes every URL immutable (changed counts => new URL).
+
+- matplotlib is only imported when a PNG is actually rendered, so it costs
+  nothing at worker boot.
+- Rendered PNGs live in the "charts" cache alias (CACHES), which evicts by
+  LRU and TTL.
+- Rendering runs on a per-process background thread, one job per chart
+  version, using matplotlib's object API (no pyplot global state). While
+  a new version renders, requests get the last one rendered for the same
+  filters; only a chart never rendered before is waited for.
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.core.cache import caches
+
+CHART_CACHE = "charts"
+
+
+class ChartSpec(NamedTuple):
+    kind: str        # "pie" | "bar"
+    title: str
+    dimension: str   # rollups dimension the counts come from
+    limit: int       # slices / bars shown (rest folded into "Other" for pies)
+
+
+CHARTS: Dict[str, ChartSpec] = {
+    "goal": ChartSpec("pie", "Goals (Business/Individual)", "goal", 8),
+    "customer_type": ChartSpec("pie", "Customer Type", "customer_type", 8),
+    "top_products": ChartSpec("bar", "Top Recommended Products", "product", 5),
+}
+
+ChartData = List[Tuple[str, int]]
+
+
+def chart_data(name: str, counter: Counter) -> ChartData:
+    """The (label, value) pairs chart name actually draws from counter."""
+    spec = CHARTS[name]
+    items = counter.most_common(spec.limit)
+    data = [(k if k else "(blank)", v) for k, v in items]
+    if spec.kind == "pie":
+        # Keep chart readable: top N + "Other"
+        remaining = sum(counter.values()) - sum(v for _, v in items)
+        if remaining > 0:
+            data.append(("Other", remaining))
+    return data
+
+
+def fingerprint(name: str, data: ChartData) -> str:
+    raw = json.dumps([name, data], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:20]
+
+
+def _figure_png(fig) -> bytes:
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    FigureCanvasAgg(fig)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight", dpi=160)
+    return buf.getvalue()
+
+
+def render_png(name: str, data: ChartData) -> bytes:
+    from matplotlib.figure import Figure
+
+    spec = CHARTS[name]
+    if not data:
+        # empty chart placeholder
+        fig = Figure(figsize=(5, 3) if spec.kind == "pie" else (6, 3))
+        ax = fig.add_subplot()
+        ax.set_title(spec.title)
+        ax.text(0.5, 0.5, "No data", ha="center", va="center")
+        ax.axis("off")
+        return _figure_png(fig)
+
+    labels = [label for label, _ in data]
+    values = [value for _, value in data]
+    if spec.kind == "pie":
+        fig = Figure(figsize=(5, 4))
+        ax = fig.add_subplot()
+        ax.set_title(spec.title)
+        ax.pie(values, labels=labels, autopct="%1.0f%%", startangle=90)
+        ax.axis("equal")
+    else:
+        fig = Figure(figsize=(8, 6))
+        ax = fig.add_subplot()
+        ax.set_title(spec.title)
+        # Horizontal bars
+        y_pos = range(len(values))
+        ax.barh(y_pos, values)
+        ax.set_yticks(y_pos, labels)
+        ax.set_xlabel("Count")
+        fig.tight_layout()
+    return _figure_png(fig)
+
+
+def _key(name: str, fp: str) -> str:
+    return f"chart:{name}:{fp}"
+
+
+def _last_key(name: str, variant: str) -> str:
+    return f"chart-last:{name}:{variant}"
+
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_inflight: Dict[str, Future] = {}
+
+
+def _render_and_store(name: str, data: ChartData, fp: str, variant: str) -> bytes:
+    png = render_png(name, data)
+    caches[CHART_CACHE].set_many({_key(name, fp): png, _last_key(name, variant): png})
+    return png
+
+
+def _submit(name: str, data: ChartData, fp: str, variant: str) -> Future:
+    """Render in the background; one job per chart version at a time."""
+    global _executor, _executor_pid
+    key = _key(name, fp)
+    with _lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future
+        if _executor_pid != os.getpid():
+            # threads do not survive fork: every worker gets its own pool
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="btn-charts")
+            _executor_pid = os.getpid()
+            _inflight.clear()
+        future = _executor.submit(_render_and_store, name, data, fp, variant)
+        _inflight[key] = future
+    future.add_done_callback(lambda _: _inflight.pop(key, None))
+    return future
+
+
+def cached_png(name: str, fp: str) -> Optional[bytes]:
+    return caches[CHART_CACHE].get(_key(name, fp))
+
+
+def png_for(name: str, data: ChartData, fp: str, variant: str = "") -> Tuple[bytes, bool]:
+    """
+    (png, fresh) for the given chart version. A missing version is rendered
+    in the background; until it is ready the last PNG rendered for variant
+    (the filters) is returned with fresh False. A chart never rendered for
+    variant is waited for.
+    """
+    png = cached_png(name, fp)
+    if png is not None:
+        return png, True
+    future = _submit(name, data, fp, variant)
+    stale = caches[CHART_CACHE].get(_last_key(name, variant))
+    if stale is not None:
+        return stale, False
+    return future.result(), True
+
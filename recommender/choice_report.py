@@ -0,0 +1,69 @@
+"""
+Choice distribution of one question: how many events picked each choice at
+a node, for the dashboard filters.
+
+The choice is read from answers inside the database (AnswerChoice: JSON_EXTRACT
+on SQLite, ->> on PostgreSQL) and grouped there, one query per report.
+
+- Questions with an expression index on (segment, choice) (RecommendationEvent
+  .Meta.indexes: the ones every path answers) are counted from the index
+  alone; reports are always per tree, so segment is always filtered on.
+- For deeper questions, the tree tells which answers to those indexed
+  questions every path to the node has. Those conditions are added to the
+  query, so it only reads the events of that branch (an index range) instead
+  of every row.
+"""
+from __future__ import annotations
+
+from typing import Dict, List, NamedTuple
+
+from django.db.models import Count
+
+from . import dashboard
+from .expressions import AnswerChoice
+from .models import RecommendationEvent
+from .tree_engine import CompiledTree
+
+# node ids with an AnswerChoice index (keep in step with RecommendationEvent.Meta.indexes)
+INDEXED_KEYS = ("q1", "ind_q2_goal", "biz_q2_goal")
+
+
+class ChoiceRow(NamedTuple):
+    choice: str
+    label: str
+    count: int
+    share: float  # count / events that answered the node
+
+
+def branch_conditions(tree: CompiledTree, node_key: str) -> Dict[str, str]:
+    """{indexed node: choice} shared by every path of tree that answers node_key."""
+    conditions: Dict[str, set] = {}
+    for path in tree.paths:
+        answers = tree.answers_for(path)
+        if node_key not in answers:
+            continue
+        for key in INDEXED_KEYS:
+            if key != node_key:
+                conditions.setdefault(key, set()).add(answers.get(key))
+    return {key: values.pop() for key, values in conditions.items() if len(values) == 1 and None not in values}
+
+
+def choice_counts(tree: CompiledTree, node_key: str, filters: dashboard.Filters) -> Dict[str, int]:
+    """{choice: events} at node_key for the filtered events (unanswered events left out)."""
+    qs = dashboard.filter_events(RecommendationEvent.objects.all(), filters)
+    for i, (key, value) in enumerate(sorted(branch_conditions(tree, node_key).items())):
+        qs = qs.alias(**{f"branch_{i}": AnswerChoice(key)}).filter(**{f"branch_{i}": value})
+    rows = qs.annotate(choice=AnswerChoice(node_key)).values("choice").annotate(n=Count("id")).order_by()
+    return {row["choice"]: row["n"] for row in rows if row["choice"] is not None}
+
+
+def choice_report(tree: CompiledTree, node: int, filters: dashboard.Filters) -> List[ChoiceRow]:
+    """Every choice of node (in tree order, then choices only older trees had) with its count."""
+    counts = choice_counts(tree, tree.keys[node], filters)
+    total = sum(counts.values())
+    labels = dict(tree.choices[node])
+    order = [key for key, _ in tree.choices[node]] + sorted(key for key in counts if key not in labels)
+    return [
+        ChoiceRow(key, labels.get(key, key), counts.get(key, 0), counts.get(key, 0) / total if total else 0.0)
+        for key in order
+    ]
@@ -0,0 +1,137 @@
+"""
+Dashboard filters (date range, segment, customer_type, goal) and the counts
+behind the dashboard, aggregated in the database.
+
+- Without a segment/customer_type/goal filter the counts come from the daily
+  rollups (rollups.py); a date range just narrows the rollup days.
+- With one, they are GROUP BY queries on RecommendationEvent, served by the
+  (dimension, created_at) indexes. Products are one GROUP BY over
+  EventProduct (products.py) for the filtered events.
+- The events-per-day / per-hour trends come from timeseries.py (SQL
+  bucketing, closed buckets cached).
+
+Dates are local days (TIME_ZONE), both ends inclusive.
+"""
+from __future__ import annotations
+
+from collections import Counter
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from django.db.models import Count, QuerySet
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from . import rollups, timeseries
+from .models import EventProduct, RecommendationEvent
+
+DIMENSION_FILTERS = ("segment", "customer_type", "goal")
+
+# Trend ranges when the filters leave them open: days shown per day, hours per hour
+TREND_DAYS = 90
+TREND_HOURS = 48
+
+
+class Filters(NamedTuple):
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    segment: str = ""
+    customer_type: str = ""
+    goal: str = ""
+
+    def dimensions(self) -> Dict[str, str]:
+        return {name: getattr(self, name) for name in DIMENSION_FILTERS if getattr(self, name)}
+
+    def params(self) -> Dict[str, str]:
+        """Non-empty filters as query parameters (inverse of parse_filters)."""
+        out = {}
+        if self.date_from:
+            out["from"] = self.date_from.isoformat()
+        if self.date_to:
+            out["to"] = self.date_to.isoformat()
+        out.update(self.dimensions())
+        return out
+
+
+def _parse_day(value: str) -> Optional[date]:
+    try:
+        return parse_date(value or "")
+    except ValueError:
+        return None
+
+
+def parse_filters(params: Mapping[str, str]) -> Filters:
+    """Filters from ?from=YYYY-MM-DD&to=...&segment=&customer_type=&goal=; bad dates are ignored."""
+    return Filters(
+        date_from=_parse_day(params.get("from", "")),
+        date_to=_parse_day(params.get("to", "")),
+        **{name: (params.get(name) or "").strip() for name in DIMENSION_FILTERS},
+    )
+
+
+def _day_start(day: date) -> datetime:
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def filter_events(qs: QuerySet, filters: Filters) -> QuerySet:
+    if filters.date_from:
+        qs = qs.filter(created_at__gte=_day_start(filters.date_from))
+    if filters.date_to:
+        qs = qs.filter(created_at__lt=_day_start(filters.date_to + timedelta(days=1)))
+    return qs.filter(**filters.dimensions())
+
+
+def _grouped(qs: QuerySet, field: str) -> Counter:
+    counter: Counter = Counter()
+    for row in qs.order_by().values(field).annotate(n=Count("id")):
+        counter[(row[field] or "").strip()] += row["n"]
+    return counter
+
+
+def _grouped_products(qs: QuerySet) -> Counter:
+    counter: Counter = Counter()
+    linked = EventProduct.objects.filter(event__in=qs.order_by().values("id"))
+    for row in linked.values("product__name").annotate(n=Count("id")).order_by():
+        name = (row["product__name"] or "").strip()
+        if name:
+            counter[name] += row["n"]
+    # rows not moved by backfill_event_products yet: group by their list
+    legacy = qs.order_by().exclude(recommended_products=[])
+    for row in legacy.values("recommended_products").annotate(n=Count("id")):
+        for product in row["recommended_products"] or []:
+            product = (product or "").strip()
+            if product:
+                counter[product] += row["n"]
+    return counter
+
+
+def dimension_counters(filters: Filters) -> Dict[str, Counter]:
+    """{"goal" | "customer_type" | "product": Counter} for the filtered events."""
+    if not filters.dimensions():
+        return rollups.dashboard_counters(since=filters.date_from, until=filters.date_to)
+
+    qs = filter_events(RecommendationEvent.objects.all(), filters)
+    return {
+        "goal": _grouped(qs, "goal"),
+        "customer_type": _grouped(qs, "customer_type"),
+        "product": _grouped_products(qs),
+    }
+
+
+def trends(filters: Filters, now: Optional[datetime] = None) -> Dict[str, List[Tuple[str, int]]]:
+    """
+    {"per_day" | "per_hour": [(label, events), ...]}: every day of the filter
+    range (default: the last TREND_DAYS days) and the last TREND_HOURS hours of it.
+    """
+    now = now or timezone.now()
+    last_day = filters.date_to or timezone.localdate(now)
+    first_day = filters.date_from or last_day - timedelta(days=TREND_DAYS - 1)
+    start, end = _day_start(first_day), min(_day_start(last_day + timedelta(days=1)), now)
+    dims = filters.dimensions()
+
+    per_day = timeseries.series("day", start, end, dims, now=now)
+    per_hour = timeseries.series("hour", max(start, end - timedelta(hours=TREND_HOURS)), end, dims, now=now)
+    return {
+        "per_day": [(bucket.strftime("%Y-%m-%d"), n) for bucket, n in per_day],
+        "per_hour": [(bucket.strftime("%m-%d %H:00"), n) for bucket, n in per_hour],
+    }
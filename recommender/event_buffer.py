@@ -0,0 +1,198 @@
+"""
+Write-behind buffer for RecommendationEvent inserts.
+
+With BTN_EVENT_WRITE_BEHIND on, log_event() does not INSERT inside the
+request. The event is appended to the worker's spool file (one JSON line)
+and kept in memory; a background thread writes everything pending with one
+bulk_create every BTN_EVENT_FLUSH_SECONDS. Workers then take SQLite's write
+lock once per flush instead of once per finished questionnaire.
+
+- Events carry their public_id before they are written, so the result URL
+  is known right away; find_event() looks here while the row is pending.
+- The spool file outlives a crashed worker. Every worker holds an flock on
+  its own spool file, and a starting worker replays the ones nobody holds.
+  Writes are idempotent (public_id is unique), so replaying an event that
+  already made it to the database is harmless.
+- Once BTN_EVENT_BUFFER_SIZE events are pending, the request adding the next
+  one flushes inline: back-pressure instead of unbounded memory.
+
+Spool lines are flushed to the OS on every append (they survive the process,
+not the machine).
+"""
+from __future__ import annotations
+
+import atexit
+import fcntl
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.utils.dateparse import parse_datetime
+
+from .models import RecommendationEvent
+
+logger = logging.getLogger(__name__)
+
+SPOOL_GLOB = "events-*.ndjson"
+
+# Model fields stored per spooled event (everything but the auto id)
+SPOOL_FIELDS = [f.attname for f in RecommendationEvent._meta.concrete_fields if not f.primary_key]
+
+
+def dump_event(event: RecommendationEvent) -> bytes:
+    record = {name: getattr(event, name) for name in SPOOL_FIELDS}
+    record["created_at"] = event.created_at.isoformat()  # (DjangoJSONEncoder drops microseconds)
+    return json.dumps(record, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def load_event(line: bytes) -> RecommendationEvent:
+    record = json.loads(line)
+    record["created_at"] = parse_datetime(record["created_at"])
+    return RecommendationEvent(**{name: record[name] for name in SPOOL_FIELDS if name in record})
+
+
+class EventBuffer:
+    """
+    Pending events of one process, written by writer(events) (a list of
+    unsaved events; it must skip public_ids that already exist).
+    """
+
+    def __init__(
+        self,
+        spool_dir: Path,
+        writer: Callable[[Sequence[RecommendationEvent]], object],
+        flush_seconds: float = 1.0,
+        max_pending: int = 1000,
+    ):
+        self.spool_dir = Path(spool_dir)
+        self.writer = writer
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._pending: Dict[str, RecommendationEvent] = {}
+        self._spool = None
+        self._spool_path: Optional[Path] = None
+
+    # -- process setup ---------------------------------------------------
+
+    def _start(self) -> None:
+        """Called under _lock. Set up the spool + flusher once per process."""
+        if self._pid == os.getpid():
+            return
+        # first use, or a worker forked from a process that used the buffer
+        self._pid = os.getpid()
+        self._pending = {}
+        self._flush_lock = threading.Lock()
+        self._spool, self._spool_path = self._open_spool()
+        threading.Thread(target=self._run, name="btn-event-flusher", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _open_spool(self):
+        """
+        New spool file, locked before it gets its final name so replay never
+        picks up a file that still has a live owner.
+        """
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.spool_dir / f".events-{os.getpid()}-{secrets.token_hex(4)}.tmp"
+        fh = open(tmp, "ab")
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        path = tmp.with_name(tmp.name[1:]).with_suffix(".ndjson")
+        os.rename(tmp, path)
+        return fh, path
+
+    def _run(self) -> None:
+        self.replay_orphans()
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Event flush failed; events stay pending")
+            finally:
+                close_old_connections()
+
+    # -- public API ------------------------------------------------------
+
+    def put(self, event: RecommendationEvent) -> None:
+        line = dump_event(event)
+        with self._lock:
+            self._start()
+            self._spool.write(line)
+            self._spool.flush()
+            self._pending[str(event.public_id)] = event
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    def get(self, public_id) -> Optional[RecommendationEvent]:
+        """A pending (not yet written) event of this process."""
+        with self._lock:
+            return self._pending.get(str(public_id))
+
+    def flush(self) -> int:
+        """Write all pending events now; returns how many were pending."""
+        if self._pid != os.getpid():
+            return 0
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                events = list(self._pending.values())
+                old_spool, old_path = self._spool, self._spool_path
+                self._spool, self._spool_path = self._open_spool()
+            try:
+                self.writer(events)
+            except Exception:
+                # events stay pending (retried next flush) and on disk in
+                # old_path, which is unlocked now and replayed after a crash
+                old_spool.close()
+                raise
+            with self._lock:
+                for event in events:
+                    self._pending.pop(str(event.public_id), None)
+            old_spool.close()
+            old_path.unlink(missing_ok=True)
+            return len(events)
+
+    def replay_orphans(self) -> int:
+        """Write events from spool files left behind by dead processes."""
+        replayed = 0
+        if not self.spool_dir.is_dir():
+            return replayed
+        for path in sorted(self.spool_dir.glob(SPOOL_GLOB)):
+            if path == self._spool_path:
+                continue
+            try:
+                fh = open(path, "rb")
+            except FileNotFoundError:
+                continue  # replayed by someone else meanwhile
+            with fh:
+                try:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # owner is alive
+                events: List[RecommendationEvent] = []
+                for line_no, line in enumerate(fh, start=1):
+                    try:
+                        events.append(load_event(line))
+                    except (ValueError, KeyError, TypeError):
+                        # typically a line cut short by the crash
+                        logger.warning("Skipping unreadable spool line %s:%d", path, line_no)
+                try:
+                    self.writer(events)
+                except Exception:
+                    logger.exception("Replaying %s failed; will retry on next start", path)
+                    continue
+                path.unlink(missing_ok=True)
+                replayed += len(events)
+        if replayed:
+            logger.info("Replayed %d spooled events", replayed)
+        return replayed
@@ -0,0 +1,226 @@
+"""
+Building and logging RecommendationEvent rows for a reached leaf.
+
+Every entry point that ends a questionnaire (session wizard, token wizard,
+JSON API, batch scoring, generator) goes through here so the stored
+dimensions stay consistent, and every INSERT goes through save_events(), which
+sends events_saved for code that maintains derived data.
+"""
+from __future__ import annotations
+
+import json
+import threading
+import time
+import uuid
+from typing import List, Mapping, Optional, Sequence
+
+from django.conf import settings
+from django.core import signing
+from django.db import IntegrityError, transaction
+from django.dispatch import Signal
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from .event_buffer import EventBuffer
+from .models import RecommendationEvent
+from .products import link_events, product_keys
+from .tree_engine import CompiledTree
+
+# Sent with events=[saved events] inside the transaction that inserted them.
+events_saved = Signal()
+# Sent with events=<queryset> inside the transaction that deletes them,
+# before the DELETE (models.EventQuerySet.delete(), RecommendationEvent.delete()).
+events_deleting = Signal()
+
+# ?w= on result URLs handed out right after logging: see result_url()
+WAIT_PARAM = "w"
+WAIT_SALT = "recommender.events.wait"
+
+LOOKUP_CHUNK_SIZE = 500  # public_ids per IN (...) lookup, well under SQLite's variable limit
+INSERT_ATTEMPTS = 3
+
+# uuid5 namespace for public ids of logged runs
+RUN_NAMESPACE = uuid.UUID("6f1c3a52-0d7e-4b8a-9a51-2f0e7c9b4d13")
+
+
+def run_public_id(session_key: str, answers: Mapping[str, str], run_id: str = "") -> uuid.UUID:
+    """
+    public_id of the event a run (session_key + run_id) logs for answers.
+    Logging the same run again (refresh, retry, replay) gives the same id.
+    """
+    canonical = json.dumps(dict(answers), sort_keys=True, separators=(",", ":"))
+    return uuid.uuid5(RUN_NAMESPACE, f"{session_key}\x00{run_id}\x00{canonical}")
+
+
+def build_event(
+    tree: CompiledTree,
+    node: int,
+    session_key: str,
+    answers: Mapping[str, str],
+    public_id: Optional[uuid.UUID] = None,
+) -> RecommendationEvent:
+    """Unsaved RecommendationEvent for leaf node of tree."""
+    meta = tree.meta[node]
+    event = RecommendationEvent(
+        session_key=session_key,
+        answers=dict(answers),
+        recommended_products=list(tree.products[node]),
+        product_links=list(tree.links[node]),
+        # store common dimensions if present (optional model fields)
+        segment=meta.get("segment", ""),
+        customer_type=meta.get("customer_type", ""),
+        goal=meta.get("goal", ""),
+        tree_version=tree.version,
+    )
+    if public_id is not None:
+        event.public_id = public_id
+    return event
+
+
+def _stored_public_ids(public_ids: List[str]) -> set:
+    """The ones of public_ids that already have a row."""
+    stored = set()
+    for start in range(0, len(public_ids), LOOKUP_CHUNK_SIZE):
+        chunk = public_ids[start:start + LOOKUP_CHUNK_SIZE]
+        stored.update(
+            str(public_id) for public_id in
+            RecommendationEvent.objects.filter(public_id__in=chunk).values_list("public_id", flat=True)
+        )
+    return stored
+
+
+def _insert(events: List[RecommendationEvent]) -> List[RecommendationEvent]:
+    lists = [(event.recommended_products, event.product_links) for event in events]
+    for event in events:
+        event.recommended_products, event.product_links = [], []
+    try:
+        with transaction.atomic():  # savepoint: a conflicting row only undoes this INSERT
+            created = RecommendationEvent.objects.bulk_create(events)
+    finally:
+        for event, (names, links) in zip(events, lists):
+            event.recommended_products, event.product_links = names, links
+    link_events(created, [product_keys(names or [], links or []) for names, links in lists])
+    return created
+
+
+def save_events(events: Sequence[RecommendationEvent]) -> List[RecommendationEvent]:
+    """
+    INSERT events in one statement and transaction, skipping public_ids that
+    are already stored. Returns the inserted events (pk set).
+
+    public_ids are deterministic per run, so a retry handled by another worker
+    can store the same id between the lookup and the INSERT; the unique
+    constraint then fails the INSERT and it is retried without those ids.
+
+    The products listed on the events are stored as EventProduct rows; the
+    rows' own product JSON columns are written empty. The returned instances
+    keep their lists, so callers and events_saved receivers can read them.
+    """
+    unique = {str(event.public_id): event for event in events}
+    if not unique:
+        return []
+    with transaction.atomic():
+        for attempt in range(INSERT_ATTEMPTS):
+            stored = _stored_public_ids(list(unique))
+            new = [event for key, event in unique.items() if key not in stored]
+            try:
+                created = _insert(new) if new else []
+                break
+            except IntegrityError:
+                if attempt == INSERT_ATTEMPTS - 1:
+                    raise
+        if created:
+            events_saved.send(sender=RecommendationEvent, events=created)
+    return created
+
+
+def write_behind() -> bool:
+    return getattr(settings, "BTN_EVENT_WRITE_BEHIND", False)
+
+
+_buffer: Optional[EventBuffer] = None
+_buffer_lock = threading.Lock()
+
+
+def event_buffer() -> EventBuffer:
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = EventBuffer(
+                    settings.BTN_EVENT_SPOOL_DIR,
+                    writer=save_events,
+                    flush_seconds=getattr(settings, "BTN_EVENT_FLUSH_SECONDS", 1.0),
+                    max_pending=getattr(settings, "BTN_EVENT_BUFFER_SIZE", 1000),
+                )
+    return _buffer
+
+
+def log_event(
+    tree: CompiledTree,
+    node: int,
+    session_key: str,
+    answers: Mapping[str, str],
+    run_id: str = "",
+) -> RecommendationEvent:
+    """
+    Record the event for a finished run; see run_public_id() for how a
+    repeated call for the same run is recognised (one row either way).
+    With BTN_EVENT_WRITE_BEHIND the row is written shortly after by the event
+    buffer, otherwise before returning. Use the returned event's public_id,
+    not its pk (unset until written).
+    """
+    event = build_event(tree, node, session_key, answers, public_id=run_public_id(session_key, answers, run_id))
+    if write_behind():
+        event_buffer().put(event)
+    else:
+        save_events([event])
+    return event
+
+
+def find_event(public_id, wait: float = 0.0) -> Optional[RecommendationEvent]:
+    """
+    Event by public_id, including ones still pending in this process's
+    buffer. An event pending in another worker shows up within a flush
+    interval; wait polls the database up to that many seconds for it.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        if write_behind():
+            event = event_buffer().get(public_id)
+            if event is not None:
+                return event
+        event = RecommendationEvent.objects.filter(public_id=public_id).first()
+        if event is not None or time.monotonic() >= deadline:
+            return event
+        time.sleep(0.1)
+
+
+def result_wait_seconds() -> float:
+    """How long a result request may wait for its pending row (0 without write-behind)."""
+    return 2 * getattr(settings, "BTN_EVENT_FLUSH_SECONDS", 1.0) if write_behind() else 0.0
+
+
+def result_url(public_id) -> str:
+    """
+    Result page of an event that was just logged. With write-behind the row
+    may not be flushed yet when the redirect lands on another worker, so the
+    URL carries a short-lived signed ticket (?w=) that lets result requests
+    for this id wait for it; see may_wait().
+    """
+    url = reverse("recommender:result", kwargs={"public_id": public_id})
+    if not write_behind():
+        return url
+    signed = signing.TimestampSigner(salt=WAIT_SALT).sign(str(public_id))
+    return f"{url}?{urlencode({WAIT_PARAM: signed.split(':', 1)[1]})}"
+
+
+def may_wait(public_id, ticket: str) -> bool:
+    """True if ticket is a fresh result_url() ticket for public_id."""
+    if not ticket or not write_behind():
+        return False
+    try:
+        signing.TimestampSigner(salt=WAIT_SALT).unsign(f"{public_id}:{ticket}", max_age=result_wait_seconds() + 10)
+    except signing.BadSignature:  # also SignatureExpired
+        return False
+    return True
@@ -0,0 +1,122 @@
+"""
+Streaming export of RecommendationEvent rows as CSV or NDJSON.
+
+Rows are read with .iterator(chunk_size=...) and their products are fetched
+once per chunk, so memory stays flat however many events match. Output comes
+out as a generator of byte blocks, optionally gzip-compressed on the fly,
+for StreamingHttpResponse (views.analytics_export) or a file (export_events).
+
+Columns: id, public_id, created_at (ISO 8601), session_key, segment,
+customer_type, goal, tree_version, answers, products, links. In CSV, answers,
+products and links are JSON-encoded cells.
+"""
+from __future__ import annotations
+
+import csv
+import io
+import json
+import zlib
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List
+
+from django.db.models import QuerySet
+
+from .models import EventProduct
+from .products import product_keys
+
+FORMATS = ("csv", "ndjson")
+DEFAULT_CHUNK_SIZE = 2000
+
+EVENT_FIELDS = [
+    "id", "public_id", "created_at", "session_key", "segment", "customer_type", "goal", "tree_version", "answers",
+]
+COLUMNS = EVENT_FIELDS + ["products", "links"]
+
+# Output is handed out in blocks of about this size (before compression).
+BLOCK_SIZE = 64 * 1024
+
+
+def iter_rows(qs: QuerySet, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+    """One dict per event of qs (ordered by id), with its products and links."""
+    rows = qs.order_by("id").values(*EVENT_FIELDS, "recommended_products", "product_links").iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+
+        linked: Dict[int, List] = {}
+        ids = [row["id"] for row in chunk if not row["recommended_products"]]
+        if ids:
+            products = (
+                EventProduct.objects.filter(event_id__in=ids)
+                .order_by("event_id", "position")
+                .values_list("event_id", "product__name", "product__url")
+            )
+            for event_id, name, url in products:
+                linked.setdefault(event_id, []).append((name, url))
+
+        for row in chunk:
+            names = row.pop("recommended_products") or []
+            links = row.pop("product_links") or []
+            pairs = product_keys(names, links) if names else linked.get(row["id"], [])
+            row["public_id"] = str(row["public_id"])
+            row["created_at"] = row["created_at"].isoformat()
+            row["products"] = [name for name, _ in pairs]
+            row["links"] = [url for _, url in pairs]
+            yield row
+
+
+def _ndjson_lines(rows: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def _csv_lines(rows: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow([
+            json.dumps(row[col], ensure_ascii=False, separators=(",", ":"))
+            if col in ("answers", "products", "links") else row[col]
+            for col in COLUMNS
+        ])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def _blocks(lines: Iterable[str]) -> Iterator[bytes]:
+    parts: List[bytes] = []
+    size = 0
+    for line in lines:
+        data = line.encode("utf-8")
+        parts.append(data)
+        size += len(data)
+        if size >= BLOCK_SIZE:
+            yield b"".join(parts)
+            parts, size = [], 0
+    if parts:
+        yield b"".join(parts)
+
+
+def _gzipped(blocks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(qs: QuerySet, fmt: str = "csv", gzip: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """The export of qs as byte blocks. Raises ValueError for unknown formats."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}' (expected 'csv' or 'ndjson')")
+    lines = _csv_lines if fmt == "csv" else _ndjson_lines
+    blocks = _blocks(lines(iter_rows(qs, chunk_size)))
+    return _gzipped(blocks) if gzip else blocks
+
+
+def filename(fmt: str, gzip: bool, stamp: str) -> str:
+    return f"recommendation-events-{stamp}.{fmt}" + (".gz" if gzip else "")
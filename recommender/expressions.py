@@ -0,0 +1,45 @@
+"""
+Database expressions over RecommendationEvent.answers.
+
+Django's KT("answers__q1") sends the JSON path as a query parameter, which
+SQLite cannot match against an index on the same expression. AnswerChoice
+writes the (validated) key into the SQL instead, so a query using it and an
+expression index built from it (models.RecommendationEvent.Meta.indexes) are
+the same text and the index is used.
+"""
+from __future__ import annotations
+
+import re
+
+from django.db.models import CharField, F, Func
+from django.db.models.fields.json import KeyTextTransform
+
+# node ids as used in TREE; anything else could not be inlined safely
+ANSWER_KEY_RE = re.compile(r"^[-a-zA-Z0-9_]+$")
+
+
+class AnswerChoice(Func):
+    """The choice stored for node `key` in a JSON answers field, as text (NULL if unanswered)."""
+
+    output_field = CharField()
+
+    def __init__(self, key: str, field: str = "answers"):
+        if not ANSWER_KEY_RE.match(key or ""):
+            raise ValueError(f"Invalid answer key {key!r}")
+        self.key = key
+        super().__init__(F(field))
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.key!r}, {self.source_expressions[0]!r})"
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return f"JSON_EXTRACT({sql}, '$.\"{self.key}\"')", params
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return f"({sql} ->> '{self.key}')", params
+
+    def as_sql(self, compiler, connection, **extra_context):
+        # other backends: Django's own key transform (parameterised path)
+        return compiler.compile(KeyTextTransform(self.key, self.source_expressions[0]))
@@ -0,0 +1,172 @@
+"""
+Questionnaire funnel: how many runs reached each node of a tree, which
+choices they picked, and where they gave up.
+
+views.question calls record() when it shows a node (question card or result)
+and when a choice is accepted. Counts are summed in memory per process and
+written to NodeCount every BTN_FUNNEL_FLUSH_SECONDS by a background thread,
+one UPDATE per counter instead of one row per click. 0 writes on every call.
+Counts still pending when a worker is killed hard are lost; gunicorn's
+worker_exit hook flushes them on a normal shutdown.
+
+Views count page renders, so a refresh counts twice; drop-off is views minus
+answers per node.
+"""
+from __future__ import annotations
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from datetime import date
+from typing import List, NamedTuple, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import NodeCount
+from .tree_engine import CompiledTree
+
+logger = logging.getLogger(__name__)
+
+NODE_MAX_LENGTH = NodeCount._meta.get_field("node").max_length
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_pending: Counter = Counter()
+_pid: Optional[int] = None
+
+
+def flush_seconds() -> float:
+    return getattr(settings, "BTN_FUNNEL_FLUSH_SECONDS", 5.0)
+
+
+def _run() -> None:
+    while True:
+        time.sleep(flush_seconds())
+        try:
+            flush()
+        except Exception:
+            logger.exception("Funnel flush failed; counts stay pending")
+        finally:
+            close_old_connections()
+
+
+def _start() -> None:
+    """Called under _lock. Start the flusher once per process."""
+    global _pid
+    if _pid == os.getpid():
+        return
+    # first use, or a worker forked from a process that counted something
+    _pid = os.getpid()
+    _pending.clear()
+    threading.Thread(target=_run, name="btn-funnel-flusher", daemon=True).start()
+    atexit.register(_flush_at_exit)
+
+
+def _flush_at_exit() -> None:
+    try:
+        flush()
+    except Exception:
+        logger.warning("Dropping funnel counts that could not be written at exit", exc_info=True)
+
+
+def record(segment: str, node: str, choice: str = "") -> None:
+    """Count node of segment's tree as shown (choice "") or choice as picked there."""
+    key = (timezone.localdate(), segment, node[:NODE_MAX_LENGTH], choice[:NODE_MAX_LENGTH])
+    if flush_seconds() <= 0:
+        _apply(Counter({key: 1}))
+        return
+    with _lock:
+        _start()
+        _pending[key] += 1
+
+
+def flush() -> int:
+    """Write the counts pending in this process; returns how many counters changed."""
+    with _flush_lock:
+        with _lock:
+            if not _pending:
+                return 0
+            counts = Counter(_pending)
+            _pending.clear()
+        try:
+            _apply(counts)
+        except Exception:
+            with _lock:
+                _pending.update(counts)  # retried next flush
+            raise
+        return len(counts)
+
+
+def _apply(counts: Counter) -> None:
+    """Add counts to the stored NodeCount rows (created as needed)."""
+    NodeCount.objects.bulk_create(
+        [NodeCount(day=day, segment=segment, node=node, choice=choice, count=0)
+         for day, segment, node, choice in counts],
+        ignore_conflicts=True,
+    )
+    for (day, segment, node, choice), n in counts.items():
+        NodeCount.objects.filter(day=day, segment=segment, node=node, choice=choice).update(count=F("count") + n)
+
+
+class FunnelChoice(NamedTuple):
+    key: str
+    label: str
+    count: int
+
+
+class FunnelNode(NamedTuple):
+    key: str
+    text: str
+    depth: int
+    is_leaf: bool
+    views: int
+    answered: int
+    dropped: int            # views that picked nothing (0 for leaves)
+    drop_rate: float        # dropped / views
+    reach: float            # views / views of the root
+    choices: List[FunnelChoice]
+
+
+def funnel(tree: CompiledTree, segment: str, since: Optional[date] = None, until: Optional[date] = None) -> List[FunnelNode]:
+    """Every node reachable from the root, breadth first, with its counts for the days since..until."""
+    qs = NodeCount.objects.filter(segment=segment)
+    if since is not None:
+        qs = qs.filter(day__gte=since)
+    if until is not None:
+        qs = qs.filter(day__lte=until)
+    counts = {(row["node"], row["choice"]): row["total"] for row in qs.values("node", "choice").annotate(total=Sum("count"))}
+
+    root_views = counts.get((tree.keys[tree.root], ""), 0)
+    rows: List[FunnelNode] = []
+    seen = {tree.root}
+    queue = deque([(tree.root, 0)])
+    while queue:
+        node, depth = queue.popleft()
+        key = tree.keys[node]
+        views = counts.get((key, ""), 0)
+        choices = [FunnelChoice(choice, label, counts.get((key, choice), 0)) for choice, label in tree.choices[node]]
+        answered = sum(c.count for c in choices)
+        dropped = 0 if tree.is_leaf[node] else max(views - answered, 0)
+        rows.append(FunnelNode(
+            key=key,
+            text=tree.texts[node] if not tree.is_leaf[node] else ", ".join(tree.products[node]),
+            depth=depth,
+            is_leaf=tree.is_leaf[node],
+            views=views,
+            answered=answered,
+            dropped=dropped,
+            drop_rate=dropped / views if views else 0.0,
+            reach=views / root_views if root_views else 0.0,
+            choices=choices,
+        ))
+        for child in tree.next_ids[node]:
+            if child >= 0 and child not in seen:
+                seen.add(child)
+                queue.append((child, depth + 1))
+    return rows
@@ -0,0 +1,53 @@
+"""
+History generation: a counter in the database (DataGeneration) that changes
+whenever events that may already be cached as history change.
+
+Caches of past, closed buckets (timeseries.py trends, sketches.py merged
+sessions) put the current generation into their keys, so every process sees
+the change on its next read, without a restart or a shared cache. It is
+bumped:
+
+- when events are inserted with a created_at older than CLOSE_GRACE
+  (events_saved, same transaction as the INSERT): back-dated generator runs,
+  replayed spools, imports through save_events();
+- when events are deleted (RecommendationEvent.delete(), queryset delete(),
+  so the admin and generate_recommendation_results --delete-generated);
+- by `python manage.py rebuild_rollups`, run after rows were changed in the
+  database directly.
+
+Events within CLOSE_GRACE of now only land in buckets that are still open
+(not cached yet), so regular inserts never bump it.
+"""
+from __future__ import annotations
+
+from datetime import timedelta
+
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .events import events_saved
+from .models import DataGeneration
+
+HISTORY = "history"
+
+# a bucket is cached as closed this long after its end
+CLOSE_GRACE = timedelta(minutes=2)
+
+
+def current(name: str = HISTORY) -> int:
+    return DataGeneration.objects.filter(name=name).values_list("value", flat=True).first() or 0
+
+
+def bump(name: str = HISTORY) -> None:
+    if not DataGeneration.objects.filter(name=name).update(value=F("value") + 1):
+        _, created = DataGeneration.objects.get_or_create(name=name, defaults={"value": 1})
+        if not created:  # created concurrently
+            DataGeneration.objects.filter(name=name).update(value=F("value") + 1)
+
+
+@receiver(events_saved)
+def _on_events_saved(sender, events, **kwargs) -> None:
+    cutoff = timezone.now() - CLOSE_GRACE
+    if any(event.created_at < cutoff for event in events):
+        bump()
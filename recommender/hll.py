@@ -0,0 +1,52 @@
+"""
+HyperLogLog sketches: approximate distinct counts in a fixed 4 KiB.
+
+A sketch is M one-byte registers (bytes / bytearray). add() hashes a value
+into one register; merge() is a register-wise max, so the sketch of a union
+is the merge of the parts' sketches; estimate() gives the distinct count
+with a standard error of about 1.04 / sqrt(M) (1.6 %).
+"""
+from __future__ import annotations
+
+import hashlib
+import math
+from typing import Iterable, Union
+
+import numpy as np
+
+P = 12          # index bits
+M = 1 << P      # registers
+_W = 64 - P     # bits left for the rank
+_ALPHA = 0.7213 / (1 + 1.079 / M)
+
+Sketch = Union[bytes, bytearray, memoryview]
+
+
+def empty() -> bytearray:
+    return bytearray(M)
+
+
+def add(registers: bytearray, value: str) -> None:
+    h = int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+    index = h >> _W
+    rank = _W - (h & ((1 << _W) - 1)).bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+
+def merge(sketches: Iterable[Sketch]) -> bytes:
+    """Sketch of the union of sketches (an empty sketch if there are none)."""
+    out = np.zeros(M, dtype=np.uint8)
+    for sketch in sketches:
+        np.maximum(out, np.frombuffer(sketch, dtype=np.uint8), out=out)
+    return out.tobytes()
+
+
+def estimate(registers: Sketch) -> int:
+    regs = np.frombuffer(registers, dtype=np.uint8)
+    raw = _ALPHA * M * M / float(np.sum(np.ldexp(1.0, -regs.astype(np.int32))))
+    zeros = int(np.count_nonzero(regs == 0))
+    if raw <= 2.5 * M and zeros:
+        # small range: linear counting is more accurate
+        return round(M * math.log(M / zeros))
+    return round(raw)
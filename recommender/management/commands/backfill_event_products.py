@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recommender.models import RecommendationEvent
+from recommender.products import link_events, product_keys, sync_catalog
+from recommender.tree_store import registry
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the Product catalog from the configured trees and move the product lists "
+        "stored on older RecommendationEvent rows into EventProduct rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000, help="Events per transaction (default: 2000)")
+
+    def handle(self, *args, **opts):
+        batch_size = max(1, opts["batch_size"])
+
+        reg = registry()
+        for segment in reg.segments():
+            count = sync_catalog(reg.get(segment))
+            self.stdout.write(f"Catalog: {count} products from tree '{segment}'")
+
+        moved = 0
+        last_id = 0
+        legacy = RecommendationEvent.objects.exclude(recommended_products=[]).order_by("id")
+        while True:
+            chunk = list(legacy.filter(id__gt=last_id).only("id", "recommended_products", "product_links")[:batch_size])
+            if not chunk:
+                break
+            last_id = chunk[-1].id
+            keys = [product_keys(e.recommended_products or [], e.product_links or []) for e in chunk]
+            with transaction.atomic():
+                link_events(chunk, keys)
+                for event in chunk:
+                    event.recommended_products, event.product_links = [], []
+                RecommendationEvent.objects.bulk_update(chunk, ["recommended_products", "product_links"])
+            moved += len(chunk)
+
+        self.stdout.write(self.style.SUCCESS(f"Moved the product lists of {moved} events to EventProduct."))
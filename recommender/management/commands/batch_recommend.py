@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import json
+import sys
+import time
+from typing import Optional
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recommender.batch import DEFAULT_BATCH_SIZE, parse_records, score_records
+from recommender.tree_store import UnknownSegment, get_tree
+
+
+class Command(BaseCommand):
+    help = "Score a file of pre-filled answer sets (NDJSON or CSV) against TREE; writes NDJSON results."
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="Input file path, or '-' for stdin")
+        parser.add_argument("--format", choices=["ndjson", "csv"], default=None,
+                            help="Input format (default: from file extension, else ndjson)")
+        parser.add_argument("--output", default="-", help="Output NDJSON path (default: stdout)")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                            help=f"Records resolved/inserted per chunk (default: {DEFAULT_BATCH_SIZE})")
+        parser.add_argument("--segment", default=None, help="Tree to score against (default: BTN_DEFAULT_SEGMENT)")
+        parser.add_argument("--persist", action="store_true",
+                            help="Log a RecommendationEvent per valid record (bulk_create per chunk)")
+
+    def handle(self, *args, **opts):
+        path = opts["input"]
+        fmt: Optional[str] = opts["format"]
+        if fmt is None:
+            fmt = "csv" if path.lower().endswith(".csv") else "ndjson"
+        if opts["batch_size"] < 1:
+            raise CommandError("--batch-size must be >= 1")
+        try:
+            tree = get_tree(opts["segment"])
+        except UnknownSegment:
+            raise CommandError(f"Unknown segment '{opts['segment']}'")
+
+        src = sys.stdin if path == "-" else open(path, encoding="utf-8", newline="")
+        dst = sys.stdout if opts["output"] == "-" else open(opts["output"], "w", encoding="utf-8")
+
+        total = ok = 0
+        started = time.monotonic()
+        try:
+            records = parse_records(src, fmt)
+            for result in score_records(records, persist=opts["persist"], batch_size=opts["batch_size"], tree=tree):
+                dst.write(json.dumps(result, ensure_ascii=False) + "\n")
+                total += 1
+                ok += result["ok"]
+        finally:
+            if src is not sys.stdin:
+                src.close()
+            if dst is not sys.stdout:
+                dst.close()
+
+        elapsed = max(time.monotonic() - started, 1e-9)
+        self.stderr.write(self.style.SUCCESS(
+            f"Scored {total} records ({ok} ok, {total - ok} rejected) in {elapsed:.2f}s "
+            f"({total / elapsed:.0f} records/s)" + ("; events persisted" if opts["persist"] else "")
+        ))
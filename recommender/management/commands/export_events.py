@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recommender import dashboard, export
+from recommender.models import RecommendationEvent
+
+
+class Command(BaseCommand):
+    help = "Stream RecommendationEvent rows to a CSV or NDJSON file (or stdout), optionally gzipped."
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Target file (replaced atomically), or - for stdout")
+        parser.add_argument("--format", choices=export.FORMATS, default="",
+                            help="Output format (default: from the file name, else csv)")
+        parser.add_argument("--gzip", action="store_true", help="Compress the output (implied by a .gz file name)")
+        parser.add_argument("--from", dest="date_from", default="", help="First day, YYYY-MM-DD (inclusive)")
+        parser.add_argument("--to", dest="date_to", default="", help="Last day, YYYY-MM-DD (inclusive)")
+        for name in dashboard.DIMENSION_FILTERS:
+            parser.add_argument(f"--{name.replace('_', '-')}", dest=name, default="", help=f"Only events with this {name}")
+        parser.add_argument("--chunk-size", type=int, default=export.DEFAULT_CHUNK_SIZE,
+                            help=f"Rows fetched per query (default: {export.DEFAULT_CHUNK_SIZE})")
+
+    def handle(self, *args, **opts):
+        output = opts["output"]
+        gzip = opts["gzip"] or output.endswith(".gz")
+        fmt = opts["format"] or ("ndjson" if output.removesuffix(".gz").endswith((".ndjson", ".jsonl")) else "csv")
+
+        params = {"from": opts["date_from"], "to": opts["date_to"]}
+        params.update({name: opts[name] for name in dashboard.DIMENSION_FILTERS})
+        filters = dashboard.parse_filters(params)
+        for flag, given, parsed in (("--from", opts["date_from"], filters.date_from), ("--to", opts["date_to"], filters.date_to)):
+            if given and parsed is None:
+                raise CommandError(f"{flag} must be a date (YYYY-MM-DD)")
+
+        qs = dashboard.filter_events(RecommendationEvent.objects.all(), filters)
+        blocks = export.stream(qs, fmt, gzip=gzip, chunk_size=max(1, opts["chunk_size"]))
+
+        if output == "-":
+            out = sys.stdout.buffer
+            for block in blocks:
+                out.write(block)
+            out.flush()
+            return
+
+        target = Path(output)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                for block in blocks:
+                    fh.write(block)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        os.replace(tmp, target)
+
+        self.stdout.write(self.style.SUCCESS(f"Wrote {fmt}{' (gzip)' if gzip else ''} export to {target}"))
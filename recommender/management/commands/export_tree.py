@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recommender.tree_engine import ROOT_NODE, compile_tree, tree_version
+from recommender.tree_konven import TREE
+from recommender.tree_store import MAX_VERSION_LENGTH
+
+
+class Command(BaseCommand):
+    help = "Write tree_konven.TREE as a versioned JSON tree file (for BTN_TREE_FILE)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Target JSON file (replaced atomically)")
+        parser.add_argument("--tree-version", default="",
+                            help="Version label to store (default: content hash)")
+
+    def handle(self, *args, **opts):
+        version = opts["tree_version"] or tree_version(TREE)
+        if len(version) > MAX_VERSION_LENGTH:
+            raise CommandError(f"--tree-version must be at most {MAX_VERSION_LENGTH} characters")
+
+        # Refuse to publish a tree that would not compile.
+        try:
+            compile_tree(TREE, root=ROOT_NODE, version=version)
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        target = Path(opts["output"])
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}-", suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump({"version": version, "root": ROOT_NODE, "tree": TREE}, fh, ensure_ascii=False, indent=2)
+        # rename so running workers never read a half-written file
+        os.replace(tmp, target)
+
+        self.stdout.write(self.style.SUCCESS(f"Wrote tree version {version} ({len(TREE)} nodes) to {target}"))
@@ -3,31 +3,26 @@ from __future__ import annotations
 import hashlib
 import json
 import random
+import time
 from collections import deque
 from dataclasses import dataclass
 from datetime import timedelta
-from typing import Any, Dict, Tuple, Optional
+from typing import Any, Dict, List, Tuple, Optional
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
 from django.utils import timezone
 
+from recommender.aggregates import rebuild_all
 from recommender.models import RecommendationEvent
-from recommender.tree_konven import TREE
+from recommender.events import build_event, save_events
+from recommender.tree_engine import CompiledTree
+from recommender.tree_store import UnknownSegment, get_tree
 
 
 SESSION_KEY_PREFIX = "mgmt_generated"
 
-
-def _merge_meta(current: Dict[str, Any], incoming: Dict[str, Any]) -> Dict[str, Any]:
-    merged = dict(current or {})
-    for k, v in (incoming or {}).items():
-        if v is None:
-            continue
-        if isinstance(v, str) and v.strip() == "":
-            continue
-        merged[k] = v
-    return merged
+# Events per save_events() call: one INSERT transaction, with its product links and aggregate updates
+DEFAULT_BATCH_SIZE = 5000
 
 
 def _stable_hash(obj: Any) -> str:
@@ -35,11 +30,19 @@ def _stable_hash(obj: Any) -> str:
     return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
 
+def _dedupe_key(tree: CompiledTree, answers: Dict[str, str]) -> Any:
+    """
+    Path id from the tree's answer index; answers that are not a full path of
+    this tree (e.g. generated with --start) fall back to a content hash.
+    """
+    path_id = tree.resolve(answers)
+    return path_id if path_id >= 0 else _stable_hash(answers)
+
+
 @dataclass(frozen=True)
 class State:
-    node_id: str
+    node: int
     answers: Dict[str, str]
-    meta: Dict[str, Any]
     depth: int
 
 
@@ -47,7 +50,8 @@ class Command(BaseCommand):
     help = "Generate RecommendationEvent rows from TREE (exhaustive or random)."
 
     def add_arguments(self, parser):
-        parser.add_argument("--start", default="q1", help="Start node id (default: q1)")
+        parser.add_argument("--segment", default=None, help="Tree to walk (default: BTN_DEFAULT_SEGMENT)")
+        parser.add_argument("--start", default=None, help="Start node id (default: the tree's root)")
         parser.add_argument("--max-depth", type=int, default=50, help="Max traversal depth (default: 50)")
 
         # Exhaustive mode knobs
@@ -59,9 +63,11 @@ class Command(BaseCommand):
         parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducibility")
         parser.add_argument("--uniform", action="store_true", help="Choose choices uniformly (default is uniform anyway; reserved for future weighting)")
         parser.add_argument("--start-days-ago", type=int, default=0,
-                            help="If >0, spread created_at randomly over the last N days (requires created_at editable or post-update)")
+                            help="If >0, spread created_at randomly over the last N days")
 
         # Common knobs
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                            help=f"Events inserted per transaction (default: {DEFAULT_BATCH_SIZE})")
         parser.add_argument("--dry-run", action="store_true", help="Do not write to DB; just report")
         parser.add_argument("--delete-generated", action="store_true",
                             help=f"Delete events whose session_key starts with '{SESSION_KEY_PREFIX}' before generating")
@@ -77,8 +83,16 @@ class Command(BaseCommand):
         dry_run = opts["dry_run"]
         delete_generated = opts["delete_generated"]
         start_days_ago = opts["start_days_ago"]
+        batch_size = max(1, opts["batch_size"])
 
-        if start not in TREE:
+        try:
+            tree = get_tree(opts["segment"])
+        except UnknownSegment:
+            self.stderr.write(self.style.ERROR(f"Segment '{opts['segment']}' is not configured in BTN_TREES"))
+            return
+        start = start or tree.keys[tree.root]
+        start_node = tree.node_id(start)
+        if start_node < 0:
             self.stderr.write(self.style.ERROR(f"Start node '{start}' not found in TREE"))
             return
 
@@ -88,13 +102,15 @@ class Command(BaseCommand):
         if delete_generated and not dry_run:
             deleted, _ = RecommendationEvent.objects.filter(session_key__startswith=SESSION_KEY_PREFIX).delete()
             self.stdout.write(self.style.WARNING(f"Deleted {deleted} previously generated events."))
+            if deleted:
+                rebuild_all()
 
-        # Preload existing hashes for dedupe (only for exhaustive mode; for random mode, dedupe usually not desired)
-        existing_hashes = set()
+        # Preload existing path keys for dedupe (only for exhaustive mode; for random mode, dedupe usually not desired)
+        existing_keys = set()
         if dedupe and not dry_run and random_n == 0:
-            qs = RecommendationEvent.objects.filter(session_key__startswith=SESSION_KEY_PREFIX).only("answers")
-            for ev in qs.iterator(chunk_size=2000):
-                existing_hashes.add(_stable_hash(ev.answers or {}))
+            qs = RecommendationEvent.objects.filter(session_key__startswith=SESSION_KEY_PREFIX).values_list("answers", flat=True)
+            for answers in qs.iterator(chunk_size=2000):
+                existing_keys.add(_dedupe_key(tree, answers or {}))
 
         created_count = 0
         leaf_hits = 0
@@ -102,42 +118,53 @@ class Command(BaseCommand):
         dead_ends = 0
         skipped_dedupe = 0
 
-        @transaction.atomic
-        def _create_event(leaf_node_id: str, node: Dict[str, Any], answers: Dict[str, str], meta: Dict[str, Any]) -> Optional[int]:
+        pending: List[RecommendationEvent] = []
+        saved_count = 0
+        started = time.perf_counter()
+        now = timezone.now()
+
+        def _flush() -> None:
+            # written right away, also with BTN_EVENT_WRITE_BEHIND on
+            nonlocal saved_count
+            if pending:
+                saved_count += len(save_events(pending))
+                pending.clear()
+                if opts["verbosity"] >= 2:
+                    self.stdout.write(f"  {saved_count} events saved ({self._rate(saved_count, started)})")
+
+        def _create_event(leaf: int, answers: Dict[str, str]) -> None:
             nonlocal created_count, skipped_dedupe
 
-            answers_hash = _stable_hash(answers)
-
             if dedupe and random_n == 0:
-                if answers_hash in existing_hashes:
+                dedupe_key = _dedupe_key(tree, answers)
+                if dedupe_key in existing_keys:
                     skipped_dedupe += 1
-                    return None
-                existing_hashes.add(answers_hash)
+                    return
+                existing_keys.add(dedupe_key)
+
+            answers_hash = _stable_hash(answers)
 
             if dry_run:
                 created_count += 1
-                return None
-
-            ev = RecommendationEvent.objects.create(
-                session_key=f"{SESSION_KEY_PREFIX}:{leaf_node_id}:{answers_hash[:12]}:{created_count+1}",
-                answers=answers,
-                recommended_products=node.get("products", []),
-                product_links=node.get("links", []),
-                segment=meta.get("segment", ""),
-                customer_type=meta.get("customer_type", ""),
-                goal=meta.get("goal", ""),
+                return
+
+            ev = build_event(
+                tree,
+                leaf,
+                f"{SESSION_KEY_PREFIX}:{tree.keys[leaf]}:{answers_hash[:12]}:{created_count+1}",
+                answers,
             )
 
-            # Optional: spread timestamps (if you want charts to look real)
-            # This only works if created_at is auto_now_add and still writable via update().
+            # Optional: spread timestamps (if you want charts to look real); set before the INSERT
             if start_days_ago and start_days_ago > 0:
-                now = timezone.now()
                 delta_seconds = random.randint(0, start_days_ago * 24 * 3600)
-                fake_time = now - timedelta(seconds=delta_seconds)
-                RecommendationEvent.objects.filter(id=ev.id).update(created_at=fake_time)
+                ev.created_at = now - timedelta(seconds=delta_seconds)
+
+            pending.append(ev)
+            if len(pending) >= batch_size:
+                _flush()
 
             created_count += 1
-            return ev.id
 
         # ------------------------
         # RANDOM MODE
@@ -149,20 +176,22 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.WARNING("Note: --dedupe is ignored in --random mode (duplicates are expected)."))
 
             for _ in range(random_n):
-                leaf_id, leaf_node, answers, meta = self._simulate_one_run(start, max_depth)
-                if leaf_node is None:
+                leaf, answers = self._simulate_one_run(tree, start_node, max_depth)
+                if leaf < 0:
                     dead_ends += 1
                     continue
 
                 leaf_hits += 1
-                _create_event(leaf_id, leaf_node, answers, meta)
+                _create_event(leaf, answers)
 
                 if limit and created_count >= limit:
                     break
 
+            _flush()
             self._report(
                 mode=f"random ({random_n})",
                 created=created_count,
+                rate=self._rate(saved_count, started),
                 leaf_hits=leaf_hits,
                 dead_ends=dead_ends,
                 missing_nodes=missing_nodes,
@@ -175,48 +204,46 @@ class Command(BaseCommand):
         # ------------------------
         # EXHAUSTIVE MODE
         # ------------------------
-        queue = deque([State(node_id=start, answers={}, meta={}, depth=0)])
-        visited = set()  # (node_id, answers_hash) loop protection
+        queue = deque([State(node=start_node, answers={}, depth=0)])
+        visited = set()  # (node, answers_hash) loop protection
 
         while queue:
             state = queue.popleft()
             if state.depth > max_depth:
                 continue
 
-            node = TREE.get(state.node_id)
-            if not node:
+            if state.node < 0:
                 missing_nodes += 1
                 continue
 
-            meta = _merge_meta(state.meta, node.get("meta", {}))
-            key = (state.node_id, _stable_hash(state.answers))
+            key = (state.node, _stable_hash(state.answers))
             if key in visited:
                 continue
             visited.add(key)
 
-            if node.get("leaf") is True:
+            if tree.is_leaf[state.node]:
                 leaf_hits += 1
-                _create_event(state.node_id, node, state.answers, meta)
+                _create_event(state.node, state.answers)
                 if limit and created_count >= limit:
                     break
                 continue
 
-            choices = node.get("choices", {})
-            if not isinstance(choices, dict) or not choices:
+            choices = tree.choices[state.node]
+            if not choices:
                 dead_ends += 1
                 continue
 
-            for choice_key, info in choices.items():
-                nxt = info.get("next")
-                if not nxt:
-                    continue
+            node_key = tree.keys[state.node]
+            for (choice_key, _label), nxt in zip(choices, tree.next_ids[state.node]):
                 new_answers = dict(state.answers)
-                new_answers[state.node_id] = choice_key
-                queue.append(State(node_id=nxt, answers=new_answers, meta=meta, depth=state.depth + 1))
+                new_answers[node_key] = choice_key
+                queue.append(State(node=nxt, answers=new_answers, depth=state.depth + 1))
 
+        _flush()
         self._report(
             mode="exhaustive",
             created=created_count,
+            rate=self._rate(saved_count, started),
             leaf_hits=leaf_hits,
             dead_ends=dead_ends,
             missing_nodes=missing_nodes,
@@ -225,44 +252,44 @@ class Command(BaseCommand):
             seed=seed,
         )
 
-    def _simulate_one_run(self, start: str, max_depth: int) -> Tuple[str, Optional[Dict[str, Any]], Dict[str, str], Dict[str, Any]]:
+    def _simulate_one_run(self, tree: CompiledTree, start: int, max_depth: int) -> Tuple[int, Dict[str, str]]:
         """
         Walk from start -> randomly pick a choice each step until leaf or dead-end.
-        Returns: (leaf_id, leaf_node_or_None, answers, meta)
+        Returns: (leaf node id or -1, answers)
         """
-        node_id = start
+        node = start
         answers: Dict[str, str] = {}
-        meta: Dict[str, Any] = {}
         depth = 0
 
         while depth <= max_depth:
-            node = TREE.get(node_id)
-            if not node:
-                return node_id, None, answers, meta
-
-            meta = _merge_meta(meta, node.get("meta", {}))
+            if node < 0:
+                return -1, answers
 
-            if node.get("leaf") is True:
-                return node_id, node, answers, meta
+            if tree.is_leaf[node]:
+                return node, answers
 
-            choices = node.get("choices", {})
-            if not isinstance(choices, dict) or not choices:
-                return node_id, None, answers, meta
+            choices = tree.choices[node]
+            if not choices:
+                return -1, answers
 
-            choice_key = random.choice(list(choices.keys()))
-            answers[node_id] = choice_key
-            node_id = choices[choice_key].get("next")
-            if not node_id:
-                return "", None, answers, meta
+            pos = random.randrange(len(choices))
+            answers[tree.keys[node]] = choices[pos][0]
+            node = tree.next_ids[node][pos]
 
             depth += 1
 
-        return node_id, None, answers, meta
+        return -1, answers
+
+    @staticmethod
+    def _rate(saved: int, started: float) -> str:
+        elapsed = time.perf_counter() - started
+        return f"{elapsed:.1f}s, {saved / elapsed if elapsed else 0:,.0f} events/sec"
 
     def _report(
         self,
         mode: str,
         created: int,
+        rate: str,
         leaf_hits: int,
         dead_ends: int,
         missing_nodes: int,
@@ -272,7 +299,7 @@ class Command(BaseCommand):
     ) -> None:
         self.stdout.write("")
         self.stdout.write(self.style.SUCCESS(f"Generation finished ({mode})."))
-        self.stdout.write(f"Events created: {created}" + (" (dry-run; not saved)" if dry_run else ""))
+        self.stdout.write(f"Events created: {created}" + (" (dry-run; not saved)" if dry_run else f" ({rate})"))
         self.stdout.write(f"Leaf hits: {leaf_hits}")
         if skipped_dedupe:
             self.stdout.write(f"Skipped due to dedupe: {skipped_dedupe}")
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recommender.aggregates import DEFAULT_CHUNK_SIZE, DEFAULT_RANGE_SIZE, rebuild_all
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount the analytics rollups (EventRollup), unique-session sketches (SessionSketch) "
+        "and answer-path trie (PathPrefix) from all RecommendationEvent rows, counting "
+        "primary-key ranges on --workers processes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Processes counting id ranges in parallel (1 = in this process).")
+        parser.add_argument("--range-size", type=int, default=DEFAULT_RANGE_SIZE,
+                            help=f"Event ids per range (default {DEFAULT_RANGE_SIZE}).")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                            help=f"Rows fetched / inserted per query (default {DEFAULT_CHUNK_SIZE}).")
+
+    def handle(self, *args, **opts):
+        for name in ("workers", "range_size", "chunk_size"):
+            if opts[name] < 1:
+                raise CommandError(f"--{name.replace('_', '-')} must be at least 1.")
+
+        def progress(done, ranges, part):
+            if opts["verbosity"] >= 2:
+                self.stdout.write(f"  range {done}/{ranges}: {part.events} events")
+
+        stats = rebuild_all(opts["workers"], opts["range_size"], opts["chunk_size"], progress)
+        self.stdout.write(
+            f"Counted {stats.events} events in {stats.ranges} range(s) on {stats.workers} worker(s): "
+            f"{stats.count_seconds:.2f}s, {stats.rows_per_second:,.0f} rows/sec."
+        )
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {stats.rollups} rollup rows."))
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {stats.sketches} session sketches."))
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {stats.prefixes} answer-path prefixes."))
+        self.stdout.write(f"Done in {stats.seconds:.2f}s.")
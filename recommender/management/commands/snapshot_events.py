@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from recommender import snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Append the RecommendationEvent rows added since the last run to the columnar "
+        "snapshot (memory-mappable .npy files, see recommender/snapshot.py)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", nargs="?", default="",
+                            help="Snapshot directory (default: BTN_SNAPSHOT_DIR)")
+        parser.add_argument("--rebuild", action="store_true", help="Discard the snapshot and write all events again")
+        parser.add_argument("--chunk-size", type=int, default=snapshot.DEFAULT_CHUNK_SIZE,
+                            help=f"Events read per query (default: {snapshot.DEFAULT_CHUNK_SIZE})")
+
+    def handle(self, *args, **opts):
+        directory = opts["directory"] or settings.BTN_SNAPSHOT_DIR
+        result = snapshot.update(directory, chunk_size=max(1, opts["chunk_size"]), rebuild=opts["rebuild"])
+
+        if result["rebuilt"]:
+            self.stdout.write(f"Started a new snapshot ({len(result['answer_columns'])} answer columns).")
+        if result["unknown_answers"]:
+            self.stdout.write(self.style.WARNING(
+                f"{result['unknown_answers']} answers match no question/choice of the current trees; left out."
+            ))
+        self.stdout.write(self.style.SUCCESS(
+            f"Added {result['added']} events; {result['rows']} in {directory} (last id {result['last_id']})."
+        ))
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-17 23:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendationevent',
+            name='tree_version',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,43 @@
+import uuid
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def fill_public_ids(apps, schema_editor):
+    RecommendationEvent = apps.get_model("recommender", "RecommendationEvent")
+    batch = []
+    for event in RecommendationEvent.objects.only("id").iterator(chunk_size=2000):
+        event.public_id = uuid.uuid4()
+        batch.append(event)
+        if len(batch) >= 2000:
+            RecommendationEvent.objects.bulk_update(batch, ["public_id"])
+            batch = []
+    if batch:
+        RecommendationEvent.objects.bulk_update(batch, ["public_id"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0002_recommendationevent_tree_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recommendationevent',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='recommendationevent',
+            name='public_id',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_public_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='recommendationevent',
+            name='public_id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+    ]
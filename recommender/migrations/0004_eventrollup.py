@@ -0,0 +1,57 @@
+# Generated by Django 5.2.10 on 2026-10-17 23:40
+
+from django.db import migrations, models
+
+
+def build_rollups(apps, schema_editor):
+    """
+    Count the existing events into EventRollup (as rollups.py did when this
+    migration was written; products were only stored on the events then).
+    """
+    from collections import Counter
+
+    from django.utils import timezone
+
+    RecommendationEvent = apps.get_model("recommender", "RecommendationEvent")
+    EventRollup = apps.get_model("recommender", "EventRollup")
+    value_max_length = 255
+
+    counts = Counter()
+    rows = RecommendationEvent.objects.values_list("created_at", "goal", "customer_type", "recommended_products")
+    for created_at, goal, customer_type, products in rows.iterator(chunk_size=5000):
+        day = timezone.localdate(created_at)
+        counts[(day, "goal", (goal or "").strip()[:value_max_length])] += 1
+        counts[(day, "customer_type", (customer_type or "").strip()[:value_max_length])] += 1
+        for product in products or []:
+            product = (product or "").strip()
+            if product:
+                counts[(day, "product", product[:value_max_length])] += 1
+
+    EventRollup.objects.bulk_create(
+        [EventRollup(day=day, dimension=dim, value=value, count=n) for (day, dim, value), n in counts.items()],
+        batch_size=5000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0003_recommendationevent_public_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('dimension', models.CharField(choices=[('goal', 'Goal'), ('customer_type', 'Customer type'), ('product', 'Recommended product')], max_length=16)),
+                ('value', models.CharField(blank=True, max_length=255)),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('dimension', 'day', 'value'), name='eventrollup_unique_key')],
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
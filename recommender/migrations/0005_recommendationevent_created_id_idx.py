@@ -0,0 +1,17 @@
+# Generated by Django 5.2.10 on 2026-10-17 23:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0004_eventrollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recommendationevent',
+            index=models.Index(fields=['created_at', 'id'], name='event_created_id_idx'),
+        ),
+    ]
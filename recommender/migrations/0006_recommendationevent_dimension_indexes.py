@@ -0,0 +1,25 @@
+# Generated by Django 5.2.10 on 2026-10-17 23:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0005_recommendationevent_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recommendationevent',
+            index=models.Index(fields=['segment', 'created_at'], name='event_segment_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recommendationevent',
+            index=models.Index(fields=['customer_type', 'created_at'], name='event_custtype_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recommendationevent',
+            index=models.Index(fields=['goal', 'created_at'], name='event_goal_created_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.10 on 2026-10-17 23:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0006_recommendationevent_dimension_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('url', models.CharField(blank=True, max_length=500)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('name', 'url'), name='product_unique_name_url')],
+            },
+        ),
+        migrations.CreateModel(
+            name='EventProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField()),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='product_rows', to='recommender.recommendationevent')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='event_rows', to='recommender.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product', 'event'], name='eventproduct_product_idx')],
+                'constraints': [models.UniqueConstraint(fields=('event', 'position'), name='eventproduct_unique_position')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.10 on 2026-10-17 23:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0007_product_eventproduct'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NodeCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('segment', models.CharField(max_length=32)),
+                ('node', models.CharField(max_length=128)),
+                ('choice', models.CharField(blank=True, max_length=128)),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('segment', 'day', 'node', 'choice'), name='nodecount_unique_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.10 on 2026-10-17 23:55
+
+from django.db import migrations, models
+
+
+def build_sketches(apps, schema_editor):
+    """
+    Sketch the session_keys of the existing events per (day, segment,
+    customer_type, goal), with the register layout of hll.py when this
+    migration was written (P = 12, blake2b-64).
+    """
+    import hashlib
+
+    from django.utils import timezone
+
+    RecommendationEvent = apps.get_model("recommender", "RecommendationEvent")
+    SessionSketch = apps.get_model("recommender", "SessionSketch")
+    p = 12
+    w = 64 - p
+
+    sketches = {}
+    rows = RecommendationEvent.objects.values_list("created_at", "segment", "customer_type", "goal", "session_key")
+    for created_at, segment, customer_type, goal, session_key in rows.iterator(chunk_size=5000):
+        key = (timezone.localdate(created_at), segment or "", customer_type or "", goal or "")
+        registers = sketches.get(key)
+        if registers is None:
+            registers = sketches[key] = bytearray(1 << p)
+        h = int.from_bytes(hashlib.blake2b((session_key or "").encode("utf-8"), digest_size=8).digest(), "big")
+        index = h >> w
+        rank = w - (h & ((1 << w) - 1)).bit_length() + 1
+        if rank > registers[index]:
+            registers[index] = rank
+
+    SessionSketch.objects.bulk_create(
+        [SessionSketch(day=day, segment=segment, customer_type=customer_type, goal=goal, registers=bytes(registers))
+         for (day, segment, customer_type, goal), registers in sketches.items()],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0008_nodecount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('segment', models.CharField(blank=True, max_length=32)),
+                ('customer_type', models.CharField(blank=True, max_length=32)),
+                ('goal', models.CharField(blank=True, max_length=64)),
+                ('registers', models.BinaryField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'segment', 'customer_type', 'goal'), name='sessionsketch_unique_key')],
+            },
+        ),
+        migrations.RunPython(build_sketches, migrations.RunPython.noop),
+    ]
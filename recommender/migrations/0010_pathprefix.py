@@ -0,0 +1,33 @@
+# Generated by Django 5.2.10 on 2026-10-17 23:56
+
+from django.db import migrations, models
+
+
+# The trie of existing events is not built here: it depends on the trees
+# configured at the time (paths.path_steps). Run `python manage.py
+# rebuild_rollups` after migrating.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0009_sessionsketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PathPrefix',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.CharField(max_length=32)),
+                ('parent', models.CharField(blank=True, max_length=1000)),
+                ('node', models.CharField(max_length=128)),
+                ('choice', models.CharField(max_length=128)),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('ends', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['segment', 'ends'], name='pathprefix_ends_idx')],
+                'constraints': [models.UniqueConstraint(fields=('segment', 'parent', 'node', 'choice'), name='pathprefix_unique_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.10 on 2026-10-17 23:58
+
+import recommender.expressions
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0010_pathprefix'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recommendationevent',
+            index=models.Index(models.F('segment'), recommender.expressions.AnswerChoice('q1'), models.F('created_at'), name='event_answer_q1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recommendationevent',
+            index=models.Index(models.F('segment'), recommender.expressions.AnswerChoice('ind_q2_goal'), models.F('created_at'), name='event_answer_ind_q2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recommendationevent',
+            index=models.Index(models.F('segment'), recommender.expressions.AnswerChoice('biz_q2_goal'), models.F('created_at'), name='event_answer_biz_q2_idx'),
+        ),
+    ]
@@ -1,5 +1,26 @@
-from django.db import models
+import uuid
+
+from django.db import models, transaction
 from django.contrib import admin
+from django.utils import timezone
+
+from .expressions import AnswerChoice
+
+
+class EventQuerySet(models.QuerySet):
+    def delete(self):
+        # deleted history: aggregates subtract the rows (events_deleting),
+        # cached trends / sketches must be recomputed (generation.py)
+        from .events import events_deleting
+        from .generation import bump
+
+        with transaction.atomic(using=self.db):
+            events_deleting.send(sender=RecommendationEvent, events=self)
+            deleted, per_model = super().delete()
+            if deleted:
+                bump()
+        return deleted, per_model
+
 
 class RecommendationEvent(models.Model):
     """
@@ -7,13 +28,20 @@ class RecommendationEvent(models.Model):
     No PII stored; only session key + answers + recommended products.
     """
 
-    created_at = models.DateTimeField(auto_now_add=True)
+    # set when the leaf is reached (not on INSERT: writes may be deferred,
+    # see event_buffer.py)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    # id used in public URLs (result page); known before the row is written
+    public_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
 
     # helps you dedupe / group events without storing identity
     session_key = models.CharField(max_length=64, db_index=True)
 
     # store everything you need for later analysis
     answers = models.JSONField()  # { "q1": "...", "q2": "...", ... }
+    # legacy per-row copies; products of new rows live in EventProduct and
+    # these stay [] (see products.py, backfill_event_products)
     recommended_products = models.JSONField()  # ["KPR BTN Platinum", ...]
     product_links = models.JSONField(default=list, blank=True)  # optional
 
@@ -22,7 +50,182 @@ class RecommendationEvent(models.Model):
     customer_type = models.CharField(max_length=32, blank=True)  # "individual" / "business"
     goal = models.CharField(max_length=64, blank=True)  # "property" / "saving" / etc.
 
+    # tree revision the path was answered on (CompiledTree.version)
+    tree_version = models.CharField(max_length=64, blank=True)
+
+    objects = EventQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # newest-first listing / keyset pagination (pagination.py)
+            models.Index(fields=["created_at", "id"], name="event_created_id_idx"),
+            # dashboard filters (dashboard.py): one dimension + date range
+            models.Index(fields=["segment", "created_at"], name="event_segment_created_idx"),
+            models.Index(fields=["customer_type", "created_at"], name="event_custtype_created_idx"),
+            models.Index(fields=["goal", "created_at"], name="event_goal_created_idx"),
+            # choice histograms (choice_report.py, always per tree) of the questions every path answers
+            models.Index("segment", AnswerChoice("q1"), "created_at", name="event_answer_q1_idx"),
+            models.Index("segment", AnswerChoice("ind_q2_goal"), "created_at", name="event_answer_ind_q2_idx"),
+            models.Index("segment", AnswerChoice("biz_q2_goal"), "created_at", name="event_answer_biz_q2_idx"),
+        ]
+
     def __str__(self) -> str:
         return f"{self.created_at:%Y-%m-%d %H:%M} | {self.segment} | {self.customer_type}"
 
-admin.site.register(RecommendationEvent)
\ No newline at end of file
+    def delete(self, *args, **kwargs):
+        from .events import events_deleting
+        from .generation import bump
+
+        with transaction.atomic(using=kwargs.get("using") or self._state.db):
+            events_deleting.send(sender=RecommendationEvent, events=RecommendationEvent.objects.filter(pk=self.pk))
+            result = super().delete(*args, **kwargs)
+            bump()
+        return result
+
+
+
+class Product(models.Model):
+    """
+    Catalog entry for a product recommended by some leaf. The same name can
+    link to different pages (e.g. individual vs business), hence (name, url).
+    """
+
+    name = models.CharField(max_length=255)
+    url = models.CharField(max_length=500, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["name", "url"], name="product_unique_name_url"),
+        ]
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class EventProduct(models.Model):
+    """A product recommended by an event, in the leaf's order."""
+
+    event = models.ForeignKey(RecommendationEvent, on_delete=models.CASCADE, related_name="product_rows")
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, related_name="event_rows")
+    position = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["event", "position"], name="eventproduct_unique_position"),
+        ]
+        indexes = [
+            # top products: GROUP BY product over a set of events
+            models.Index(fields=["product", "event"], name="eventproduct_product_idx"),
+        ]
+
+
+class EventRollup(models.Model):
+    """
+    Event counts per day and dimension value (see rollups.py), so the
+    dashboard reads a few hundred rows instead of the event table.
+    """
+
+    DIMENSION_CHOICES = [
+        ("goal", "Goal"),
+        ("customer_type", "Customer type"),
+        ("product", "Recommended product"),
+    ]
+
+    day = models.DateField()
+    dimension = models.CharField(max_length=16, choices=DIMENSION_CHOICES)
+    value = models.CharField(max_length=255, blank=True)  # "" = not set
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["dimension", "day", "value"], name="eventrollup_unique_key"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.day} | {self.dimension}={self.value} | {self.count}"
+
+
+class NodeCount(models.Model):
+    """
+    Questionnaire funnel counters (see funnel.py): per day, how often each
+    node of a tree was shown (choice "") and how often each choice was picked.
+    """
+
+    day = models.DateField()
+    segment = models.CharField(max_length=32)
+    node = models.CharField(max_length=128)
+    choice = models.CharField(max_length=128, blank=True)  # "" = node shown
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["segment", "day", "node", "choice"], name="nodecount_unique_key"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.day} | {self.segment}:{self.node}{'=' + self.choice if self.choice else ''} | {self.count}"
+
+
+class SessionSketch(models.Model):
+    """
+    HyperLogLog sketch of the session_keys of one day's events with the same
+    segment/customer_type/goal (see sketches.py), for unique-session counts.
+    """
+
+    day = models.DateField()
+    segment = models.CharField(max_length=32, blank=True)
+    customer_type = models.CharField(max_length=32, blank=True)
+    goal = models.CharField(max_length=64, blank=True)
+    registers = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["day", "segment", "customer_type", "goal"], name="sessionsketch_unique_key"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.day} | {self.segment}/{self.customer_type}/{self.goal}"
+
+
+class PathPrefix(models.Model):
+    """
+    One node of the answer-path trie (see paths.py): how many events of a
+    tree picked `choice` at `node` after the answers in `parent`, and how many
+    of those paths ended there.
+    """
+
+    segment = models.CharField(max_length=32)
+    parent = models.CharField(max_length=1000, blank=True)  # "q1=a|q2=b"; "" at the root
+    node = models.CharField(max_length=128)
+    choice = models.CharField(max_length=128)
+    depth = models.PositiveSmallIntegerField()  # len of the path including this step
+    count = models.PositiveIntegerField(default=0)
+    ends = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["segment", "parent", "node", "choice"], name="pathprefix_unique_key"),
+        ]
+        indexes = [
+            models.Index(fields=["segment", "ends"], name="pathprefix_ends_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.segment}:{self.parent}|{self.node}={self.choice} | {self.count}"
+
+class DataGeneration(models.Model):
+    """
+    A counter that changes whenever stored history changes (see
+    generation.py); caches of past buckets are keyed on it.
+    """
+
+    name = models.CharField(max_length=32, unique=True)
+    value = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f"{self.name} | {self.value}"
+
+admin.site.register(RecommendationEvent)
+admin.site.register(EventRollup)
+admin.site.register(Product)
+admin.site.register(NodeCount)
@@ -0,0 +1,77 @@
+"""
+Keyset (cursor) pagination over RecommendationEvent, newest first.
+
+A page is selected by the (created_at, id) of the row next to it instead of
+an OFFSET, so every page is one range scan on the (created_at, id) index,
+however deep it is and however many rows are added meanwhile.
+
+Cursors are opaque strings for ?before= (older rows) / ?after= (newer rows).
+"""
+from __future__ import annotations
+
+import base64
+import binascii
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+
+Cursor = Tuple[datetime, int]
+
+
+class Page(NamedTuple):
+    rows: List
+    newer: str  # cursor for the previous (newer) page, "" if none
+    older: str  # cursor for the next (older) page, "" if none
+
+
+def encode_cursor(created_at: datetime, pk: int) -> str:
+    raw = f"{created_at.isoformat()}|{pk}".encode("ascii")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Optional[Cursor]:
+    """(created_at, id) for a cursor, None if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        stamp, pk = raw.rsplit("|", 1)
+        created_at = parse_datetime(stamp)
+        return (created_at, int(pk)) if created_at else None
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+def keyset_page(qs: QuerySet, size: int, before: str = "", after: str = "") -> Page:
+    """
+    size rows of qs, newest first: the newest ones, the ones older than
+    before, or the ones newer than after (cursors from a previous Page).
+    """
+    before_key = decode_cursor(before) if before else None
+    after_key = decode_cursor(after) if after else None
+
+    if after_key:
+        created_at, pk = after_key
+        rows = list(
+            qs.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+            .order_by("created_at", "id")[:size + 1]
+        )
+        more_newer = len(rows) > size
+        rows = rows[:size][::-1]
+        more_older = True
+    else:
+        if before_key:
+            created_at, pk = before_key
+            qs = qs.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+        rows = list(qs.order_by("-created_at", "-id")[:size + 1])
+        more_older = len(rows) > size
+        rows = rows[:size]
+        more_newer = before_key is not None
+
+    if not rows:
+        return Page(rows, "", "")
+    return Page(
+        rows,
+        newer=encode_cursor(rows[0].created_at, rows[0].pk) if more_newer else "",
+        older=encode_cursor(rows[-1].created_at, rows[-1].pk) if more_older else "",
+    )
@@ -0,0 +1,63 @@
+"""
+Signed, compact tokens that carry a questionnaire run instead of the session.
+
+A token is "<run id>.<path>.<segment>.<tree version>" signed with SECRET_KEY,
+where <path> is the list of choice positions taken from the root (one byte
+each, base64url encoded). Three answers from q1 encode to 4 characters, so
+the whole token stays short enough for a hidden form field or a ?t= query
+parameter. Positions only mean something for the tree (segment + version)
+they were taken on, hence those two fields.
+"""
+from __future__ import annotations
+
+import base64
+import binascii
+import secrets
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+from django.core import signing
+
+TOKEN_SALT = "recommender.path_token"
+
+
+def _signer() -> signing.Signer:
+    # built per call: SECRET_KEY is read when a token is used, not at import
+    return signing.Signer(salt=TOKEN_SALT)
+
+
+def _encode_path(path: Sequence[int]) -> str:
+    return base64.urlsafe_b64encode(bytes(path)).decode("ascii").rstrip("=")
+
+
+def _decode_path(raw: str) -> Tuple[int, ...]:
+    padded = raw + "=" * (-len(raw) % 4)
+    return tuple(base64.urlsafe_b64decode(padded.encode("ascii")))
+
+
+def new_run_id() -> str:
+    return secrets.token_urlsafe(9)
+
+
+class PathToken(NamedTuple):
+    run_id: str
+    segment: str
+    version: str
+    path: Tuple[int, ...]
+
+
+def issue_token(run_id: str, segment: str, version: str, path: Sequence[int]) -> str:
+    """Sign a run's state. Choice positions must fit in a byte."""
+    return _signer().sign(f"{run_id}.{_encode_path(path)}.{segment}.{version}")
+
+
+def read_token(token: str) -> Optional[PathToken]:
+    """
+    The PathToken for a valid token, or None if it was tampered with or is
+    malformed.
+    """
+    try:
+        value = _signer().unsign(token)
+        run_id, raw_path, segment, version = value.split(".", 3)
+        return PathToken(run_id, segment, version, _decode_path(raw_path))
+    except (signing.BadSignature, ValueError, binascii.Error):
+        return None
@@ -0,0 +1,240 @@
+"""
+Answer-path trie: how often each sequence of answers was given, per tree.
+
+An event's answers are put in questionnaire order by walking its tree from
+the root ("steps", [(node, choice), ...]). Every prefix of the steps is one
+PathPrefix row, keyed by the prefix before it ("parent", "q1=a|q2=b") plus
+its own (node, choice):
+
+- count  events whose path starts with this prefix
+- ends   events whose path is exactly this prefix (full questionnaire paths)
+
+So the children of a prefix are the rows with parent = that prefix, and the
+most common full paths are the rows with the largest ends. Rows are updated
+whenever events are inserted or deleted (events_saved, events_deleting),
+like the rollups; `python manage.py rebuild_rollups` recounts them.
+"""
+from __future__ import annotations
+
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from django.db import transaction
+from django.db.models import F
+from django.dispatch import receiver
+
+from .events import events_deleting, events_saved
+from .models import PathPrefix, RecommendationEvent
+from .tree_engine import CompiledTree
+from .tree_store import UnknownSegment, registry
+
+STEP_SEP = "|"
+CHOICE_SEP = "="
+
+PARENT_MAX_LENGTH = PathPrefix._meta.get_field("parent").max_length
+
+Step = Tuple[str, str]  # (node, choice)
+
+
+def prefix_key(steps: Sequence[Step]) -> str:
+    return STEP_SEP.join(f"{node}{CHOICE_SEP}{choice}" for node, choice in steps)
+
+
+def parse_prefix(prefix: str) -> List[Step]:
+    """Steps of a prefix key ([] for "" or malformed keys)."""
+    steps = []
+    for part in prefix.split(STEP_SEP) if prefix else []:
+        node, sep, choice = part.partition(CHOICE_SEP)
+        if not sep:
+            return []
+        steps.append((node, choice))
+    return steps
+
+
+def path_steps(tree: Optional[CompiledTree], answers: Any) -> List[Step]:
+    """
+    answers in questionnaire order: follow tree from the root while the
+    answers continue the path. Without a tree (segment no longer configured),
+    the stored order.
+    """
+    if not isinstance(answers, Mapping):
+        return []
+    if tree is None:
+        return [(str(node), str(choice)) for node, choice in answers.items()]
+    steps: List[Step] = []
+    node = tree.root
+    while node >= 0 and not tree.is_leaf[node]:
+        key = tree.keys[node]
+        pos = tree.choice_index(node, answers.get(key, ""))
+        if pos < 0:
+            break
+        steps.append((key, answers[key]))
+        node = tree.next_ids[node][pos]
+    return steps
+
+
+class _Trees:
+    """Compiled tree per segment, looked up once per batch."""
+
+    def __init__(self):
+        self._trees: Dict[str, Optional[CompiledTree]] = {}
+
+    def get(self, segment: str) -> Optional[CompiledTree]:
+        if segment not in self._trees:
+            try:
+                self._trees[segment] = registry().get(segment)
+            except UnknownSegment:
+                self._trees[segment] = None
+        return self._trees[segment]
+
+
+def _count_path(counts: Counter, ends: Counter, segment: str, steps: Sequence[Step]) -> None:
+    parent = ""
+    for node, choice in steps:
+        key = (segment, parent, node, choice)
+        counts[key] += 1
+        parent = f"{parent}{STEP_SEP}{node}{CHOICE_SEP}{choice}" if parent else f"{node}{CHOICE_SEP}{choice}"
+        if len(parent) > PARENT_MAX_LENGTH:
+            break
+    if steps:
+        ends[key] += 1
+
+
+def _apply(counts: Counter, ends: Counter) -> None:
+    """Add counts / ends to the stored prefixes (rows created as needed)."""
+    PathPrefix.objects.bulk_create(
+        [PathPrefix(segment=segment, parent=parent, node=node, choice=choice, depth=_depth(parent) + 1)
+         for segment, parent, node, choice in counts],
+        ignore_conflicts=True,
+    )
+    for (segment, parent, node, choice), n in counts.items():
+        PathPrefix.objects.filter(segment=segment, parent=parent, node=node, choice=choice).update(
+            count=F("count") + n, ends=F("ends") + ends.get((segment, parent, node, choice), 0),
+        )
+
+
+def _depth(parent: str) -> int:
+    return parent.count(STEP_SEP) + 1 if parent else 0
+
+
+@receiver(events_saved)
+def _on_events_saved(sender, events, **kwargs) -> None:
+    trees = _Trees()
+    counts: Counter = Counter()
+    ends: Counter = Counter()
+    for event in events:
+        _count_path(counts, ends, event.segment, path_steps(trees.get(event.segment), event.answers))
+    if counts:
+        _apply(counts, ends)
+
+
+@receiver(events_deleting)
+def _on_events_deleting(sender, events, **kwargs) -> None:
+    counts, ends = count(events.values_list("segment", "answers").iterator())
+    for (segment, parent, node, choice), n in counts.items():
+        PathPrefix.objects.filter(segment=segment, parent=parent, node=node, choice=choice).update(
+            count=F("count") - n, ends=F("ends") - ends.get((segment, parent, node, choice), 0),
+        )
+    PathPrefix.objects.filter(count__lte=0).delete()
+
+
+def count(
+    rows: Iterable[Tuple[str, Any]],
+    counts: Optional[Counter] = None,
+    ends: Optional[Counter] = None,
+) -> Tuple[Counter, Counter]:
+    """
+    (counts, ends) per (segment, parent, node, choice) of (segment, answers)
+    event rows, added to counts / ends when given.
+    """
+    trees = _Trees()
+    counts = Counter() if counts is None else counts
+    ends = Counter() if ends is None else ends
+    for segment, answers in rows:
+        _count_path(counts, ends, segment, path_steps(trees.get(segment), answers))
+    return counts, ends
+
+
+def write(counts: Counter, ends: Counter, prefix_model=PathPrefix, chunk_size: int = 5000) -> int:
+    """Replace the whole trie with counts / ends; returns the number of prefixes written."""
+    with transaction.atomic():
+        prefix_model.objects.all().delete()
+        prefix_model.objects.bulk_create(
+            [prefix_model(segment=segment, parent=parent, node=node, choice=choice, depth=_depth(parent) + 1,
+                          count=n, ends=ends.get((segment, parent, node, choice), 0))
+             for (segment, parent, node, choice), n in counts.items()],
+            batch_size=chunk_size,
+        )
+    return len(counts)
+
+
+def rebuild(event_model=RecommendationEvent, prefix_model=PathPrefix, chunk_size: int = 5000) -> int:
+    """Recount the whole trie from the event table; returns the number of prefixes written."""
+    rows = event_model.objects.values_list("segment", "answers")
+    counts, ends = count(rows.iterator(chunk_size=chunk_size))
+    return write(counts, ends, prefix_model, chunk_size)
+
+
+def children(segment: str, prefix: str = "") -> List[PathPrefix]:
+    """The steps taken after prefix, most common first."""
+    return list(PathPrefix.objects.filter(segment=segment, parent=prefix).order_by("-count", "node", "choice"))
+
+
+def top_paths(segment: str, limit: int = 20) -> List[PathPrefix]:
+    """Most common full paths (rows with ends > 0), most common first."""
+    return list(PathPrefix.objects.filter(segment=segment, ends__gt=0).order_by("-ends", "parent")[:limit])
+
+
+class Branch(NamedTuple):
+    node: str
+    question: str
+    choice: str
+    label: str
+    count: int
+    share: float   # count / events that reached the prefix
+    ends: int
+    prefix: str    # prefix key including this step (to drill into it)
+
+
+def _describe(tree: Optional[CompiledTree], node: str, choice: str) -> Tuple[str, str]:
+    """(question text, choice label) for a step, falling back to the keys."""
+    node_id = tree.node_id(node) if tree is not None else -1
+    if node_id < 0:
+        return node, choice
+    labels = dict(tree.choices[node_id])
+    return tree.texts[node_id] or node, labels.get(choice, choice)
+
+
+def drill_down(tree: Optional[CompiledTree], segment: str, prefix: str = "") -> Dict[str, Any]:
+    """
+    {"crumbs": [(question, label, prefix), ...] for the steps of prefix,
+     "total": events that reached prefix, "ends": of those, ended there,
+     "branches": [Branch, ...] taken next, most common first}
+    """
+    steps = parse_prefix(prefix)
+    prefix = prefix_key(steps)
+    crumbs = [(*_describe(tree, node, choice), prefix_key(steps[:i + 1])) for i, (node, choice) in enumerate(steps)]
+
+    rows = children(segment, prefix)
+    if steps:
+        node, choice = steps[-1]
+        here = PathPrefix.objects.filter(segment=segment, parent=prefix_key(steps[:-1]), node=node, choice=choice).first()
+        total, ends = (here.count, here.ends) if here else (0, 0)
+    else:
+        total, ends = sum(row.count for row in rows), 0
+
+    branches = []
+    for row in rows:
+        question, label = _describe(tree, row.node, row.choice)
+        branches.append(Branch(
+            node=row.node, question=question, choice=row.choice, label=label, count=row.count,
+            share=row.count / total if total else 0.0, ends=row.ends,
+            prefix=prefix_key(steps + [(row.node, row.choice)]),
+        ))
+    return {"crumbs": crumbs, "total": total, "ends": ends, "branches": branches}
+
+
+def describe_path(tree: Optional[CompiledTree], row: PathPrefix) -> Tuple[str, str]:
+    """(readable path, prefix key) of a full path row (see top_paths)."""
+    steps = parse_prefix(row.parent) + [(row.node, row.choice)]
+    return " › ".join(_describe(tree, node, choice)[1] for node, choice in steps), prefix_key(steps)
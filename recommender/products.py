@@ -0,0 +1,96 @@
+"""
+Product catalog (Product) and the products of each event (EventProduct).
+
+Events used to carry their product names and URLs as JSON lists on every
+row. Now events.save_events() stores them as EventProduct rows pointing at
+the catalog and leaves the JSON columns empty. Rows written before that keep
+their lists until `python manage.py backfill_event_products` moves them.
+Readers go through the helpers here, which understand both forms.
+"""
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from .models import EventProduct, Product, RecommendationEvent
+from .tree_engine import CompiledTree
+
+ProductKey = Tuple[str, str]  # (name, url)
+
+NAME_MAX_LENGTH = Product._meta.get_field("name").max_length
+URL_MAX_LENGTH = Product._meta.get_field("url").max_length
+
+
+def product_keys(names: Sequence[str], links: Sequence[str]) -> List[ProductKey]:
+    """(name, url) per product; links are paired by index, safe when lengths differ."""
+    return [
+        ((name or "")[:NAME_MAX_LENGTH], (links[i] if i < len(links) else "")[:URL_MAX_LENGTH])
+        for i, name in enumerate(names)
+    ]
+
+
+def product_ids(keys: Iterable[ProductKey]) -> Dict[ProductKey, int]:
+    """Catalog ids for keys, adding missing products (e.g. from a new tree version)."""
+    wanted = set(keys)
+    if not wanted:
+        return {}
+    names = {name for name, _ in wanted}
+
+    def lookup():
+        return {
+            (name, url): pk
+            for pk, name, url in Product.objects.filter(name__in=names).values_list("id", "name", "url")
+            if (name, url) in wanted
+        }
+
+    ids = lookup()
+    if len(ids) < len(wanted):
+        Product.objects.bulk_create(
+            [Product(name=name, url=url) for name, url in wanted - set(ids)], ignore_conflicts=True,
+        )
+        ids = lookup()
+    return ids
+
+
+def link_events(events: Sequence[RecommendationEvent], keys_per_event: Sequence[List[ProductKey]]) -> None:
+    """EventProduct rows for saved events (keys_per_event[i] belongs to events[i])."""
+    ids = product_ids(key for keys in keys_per_event for key in keys)
+    EventProduct.objects.bulk_create([
+        EventProduct(event_id=event.pk, product_id=ids[key], position=position)
+        for event, keys in zip(events, keys_per_event)
+        for position, key in enumerate(keys)
+    ])
+
+
+def sync_catalog(tree: CompiledTree) -> int:
+    """Add the products of every leaf of tree to the catalog; returns how many it has."""
+    keys = set()
+    for node, is_leaf in enumerate(tree.is_leaf):
+        if is_leaf:
+            keys.update(product_keys(tree.products[node], tree.links[node]))
+    return len(product_ids(keys))
+
+
+def products_with_links(event: RecommendationEvent) -> List[Dict[str, str]]:
+    """[{"name", "url"}, ...] for an event, from EventProduct or the legacy lists."""
+    if event.recommended_products or event.pk is None:
+        # not backfilled yet, or still pending in the write-behind buffer
+        return [{"name": name, "url": url} for name, url in
+                product_keys(event.recommended_products or [], event.product_links or [])]
+    rows = event.product_rows.select_related("product").order_by("position")
+    return [{"name": row.product.name, "url": row.product.url} for row in rows]
+
+
+def attach_product_names(events: Sequence[RecommendationEvent]) -> None:
+    """Set event.product_names on a page of events with one query."""
+    names: Dict[int, List[str]] = {}
+    linked = [event.pk for event in events if not event.recommended_products]
+    if linked:
+        rows = (
+            EventProduct.objects.filter(event_id__in=linked)
+            .order_by("event_id", "position")
+            .values_list("event_id", "product__name")
+        )
+        for event_id, name in rows:
+            names.setdefault(event_id, []).append(name)
+    for event in events:
+        event.product_names = list(event.recommended_products or []) or names.get(event.pk, [])
@@ -0,0 +1,130 @@
+"""
+Daily analytics rollups: EventRollup rows counting events per
+(day, dimension, value) for the goal, customer_type and product dimensions.
+
+Rows are incremented whenever events are inserted (events_saved, same
+transaction as the INSERT) and decremented when they are deleted through
+the ORM (events_deleting, before the DELETE; rows reaching 0 are removed),
+so they never drift from the event table while all writes go through
+events.save_events() and the models. After importing or changing rows some
+other way, run `python manage.py rebuild_rollups`.
+
+Days are local dates (TIME_ZONE) of created_at.
+"""
+from __future__ import annotations
+
+from collections import Counter
+from datetime import date
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .events import events_deleting, events_saved
+from .models import EventProduct, EventRollup, RecommendationEvent
+
+DIMENSIONS = ("goal", "customer_type", "product")
+
+VALUE_MAX_LENGTH = EventRollup._meta.get_field("value").max_length
+
+RollupKey = Tuple[date, str, str]  # (day, dimension, value)
+
+
+def _count_row(counts: Counter, created_at, goal: str, customer_type: str, products) -> None:
+    day = timezone.localdate(created_at)
+    counts[(day, "goal", (goal or "").strip()[:VALUE_MAX_LENGTH])] += 1
+    counts[(day, "customer_type", (customer_type or "").strip()[:VALUE_MAX_LENGTH])] += 1
+    for product in products or []:
+        _count_product(counts, day, product)
+
+
+def _count_product(counts: Counter, day: date, product: str) -> None:
+    product = (product or "").strip()
+    if product:
+        counts[(day, "product", product[:VALUE_MAX_LENGTH])] += 1
+
+
+def _apply(counts: Counter, rollup_model=EventRollup) -> None:
+    """Add counts to the stored rollups (rows created as needed)."""
+    rollup_model.objects.bulk_create(
+        [rollup_model(day=day, dimension=dim, value=value, count=0) for day, dim, value in counts],
+        ignore_conflicts=True,
+    )
+    for (day, dim, value), n in counts.items():
+        rollup_model.objects.filter(day=day, dimension=dim, value=value).update(count=F("count") + n)
+
+
+@receiver(events_saved)
+def _on_events_saved(sender, events, **kwargs) -> None:
+    counts: Counter = Counter()
+    for event in events:
+        _count_row(counts, event.created_at, event.goal, event.customer_type, event.recommended_products)
+    _apply(counts)
+
+
+@receiver(events_deleting)
+def _on_events_deleting(sender, events, **kwargs) -> None:
+    rows = events.values_list("created_at", "goal", "customer_type", "recommended_products")
+    links = EventProduct.objects.filter(event__in=events).values_list("event__created_at", "product__name")
+    for (day, dim, value), n in count(rows.iterator(), links.iterator()).items():
+        EventRollup.objects.filter(day=day, dimension=dim, value=value).update(count=F("count") - n)
+    EventRollup.objects.filter(count__lte=0).delete()
+
+
+def count(rows: Iterable, links: Iterable = (), counts: Optional[Counter] = None) -> Counter:
+    """
+    Rollup counts of (created_at, goal, customer_type, recommended_products)
+    event rows plus (created_at, product name) EventProduct links, added to
+    counts when given.
+    """
+    counts = Counter() if counts is None else counts
+    for row in rows:
+        _count_row(counts, *row)  # products: legacy lists only ([] once linked)
+    for created_at, name in links:
+        _count_product(counts, timezone.localdate(created_at), name)
+    return counts
+
+
+def write(counts: Counter, rollup_model=EventRollup, chunk_size: int = 5000) -> int:
+    """Replace all rollups with counts; returns the number of rows written."""
+    with transaction.atomic():
+        rollup_model.objects.all().delete()
+        rollup_model.objects.bulk_create(
+            [rollup_model(day=day, dimension=dim, value=value, count=n) for (day, dim, value), n in counts.items()],
+            batch_size=chunk_size,
+        )
+    return len(counts)
+
+
+def rebuild(
+    event_model=RecommendationEvent,
+    rollup_model=EventRollup,
+    link_model=EventProduct,
+    chunk_size: int = 5000,
+) -> int:
+    """
+    Recount all rollups from the event table (one streaming pass, plus one
+    over link_model for products stored as EventProduct rows). Returns the
+    number of rollup rows written.
+    """
+    rows = event_model.objects.values_list("created_at", "goal", "customer_type", "recommended_products")
+    links = ()
+    if link_model is not None:
+        links = link_model.objects.values_list("event__created_at", "product__name").iterator(chunk_size=chunk_size)
+    return write(count(rows.iterator(chunk_size=chunk_size), links), rollup_model, chunk_size)
+
+
+def totals(dimension: str, since: Optional[date] = None, until: Optional[date] = None) -> Counter:
+    """{value: event count} for dimension, over all days or the days since..until (inclusive)."""
+    qs = EventRollup.objects.filter(dimension=dimension)
+    if since is not None:
+        qs = qs.filter(day__gte=since)
+    if until is not None:
+        qs = qs.filter(day__lte=until)
+    return Counter({row["value"]: row["total"] for row in qs.values("value").annotate(total=Sum("count"))})
+
+
+def dashboard_counters(since: Optional[date] = None, until: Optional[date] = None) -> Dict[str, Counter]:
+    return {dimension: totals(dimension, since, until) for dimension in DIMENSIONS}
@@ -0,0 +1,149 @@
+"""
+Unique sessions per day: one HyperLogLog sketch (hll.py) of session_key per
+(day, segment, customer_type, goal), stored in SessionSketch.
+
+Sketches are merged into whenever events are inserted (events_saved, same
+transaction as the INSERT), like the rollups. Unique sessions for any day
+range and dimension filter is the estimate of the merge of the matching
+rows, a few hundred 4 KiB blobs at most instead of a COUNT(DISTINCT) over
+the event table. `python manage.py rebuild_rollups` recomputes them too.
+
+A sketch cannot forget a session, so deleting events leaves the sessions
+in it. Deletes are counted in the DELETES generation instead, and until
+the sketches are recomputed stale() is true and the dashboard says so.
+
+The merge of the closed days of a query (before the day of now - CLOSE_GRACE)
+is cached in the default cache, keyed on that day and the history generation
+(generation.py), so a dashboard poll only merges today's rows.
+
+Days are local dates (TIME_ZONE) of created_at.
+"""
+from __future__ import annotations
+
+from datetime import date
+from typing import Dict, Iterable, Mapping, Optional, Tuple
+
+from django.core.cache import cache
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import generation, hll
+from .events import events_deleting, events_saved
+from .models import DataGeneration, RecommendationEvent, SessionSketch
+
+SketchKey = Tuple[date, str, str, str]  # (day, segment, customer_type, goal)
+
+SKETCH_FIELDS = ("created_at", "segment", "customer_type", "goal", "session_key")
+
+# generation counting event deletes since the sketches were last written
+DELETES = "sketch-deletes"
+
+# closed-day merges change key with the day, so they need not outlive it
+MERGED_CACHE_SECONDS = 24 * 3600
+
+
+def _add(sketches: Dict[SketchKey, bytearray], created_at, segment, customer_type, goal, session_key) -> None:
+    key = (timezone.localdate(created_at), segment or "", customer_type or "", goal or "")
+    registers = sketches.get(key)
+    if registers is None:
+        registers = sketches[key] = hll.empty()
+    hll.add(registers, session_key or "")
+
+
+def _key_fields(key: SketchKey) -> Dict[str, object]:
+    day, segment, customer_type, goal = key
+    return {"day": day, "segment": segment, "customer_type": customer_type, "goal": goal}
+
+
+def _apply(sketches: Dict[SketchKey, bytearray]) -> None:
+    """Merge sketches into the stored ones (rows created as needed)."""
+    SessionSketch.objects.bulk_create(
+        [SessionSketch(registers=bytes(hll.M), **_key_fields(key)) for key in sketches],
+        ignore_conflicts=True,
+    )
+    for key, registers in sketches.items():
+        row = SessionSketch.objects.select_for_update().get(**_key_fields(key))
+        row.registers = hll.merge([row.registers, registers])
+        row.save(update_fields=["registers"])
+
+
+@receiver(events_saved)
+def _on_events_saved(sender, events, **kwargs) -> None:
+    sketches: Dict[SketchKey, bytearray] = {}
+    for event in events:
+        _add(sketches, event.created_at, event.segment, event.customer_type, event.goal, event.session_key)
+    _apply(sketches)
+
+
+@receiver(events_deleting)
+def _on_events_deleting(sender, events, **kwargs) -> None:
+    if events.exists():
+        generation.bump(DELETES)
+
+
+def stale() -> bool:
+    """True while the stored sketches may count sessions of deleted events."""
+    return generation.current(DELETES) > 0
+
+
+def collect(rows: Iterable, sketches: Optional[Dict[SketchKey, bytearray]] = None) -> Dict[SketchKey, bytearray]:
+    """Sketches of (created_at, segment, customer_type, goal, session_key) event rows, added to sketches when given."""
+    sketches = {} if sketches is None else sketches
+    for row in rows:
+        _add(sketches, *row)
+    return sketches
+
+
+def merge_into(sketches: Dict[SketchKey, hll.Sketch], other: Mapping[SketchKey, hll.Sketch]) -> None:
+    """Merge the sketches of other into sketches (in place)."""
+    for key, registers in other.items():
+        sketches[key] = hll.merge([sketches[key], registers]) if key in sketches else registers
+
+
+def write(sketches: Mapping[SketchKey, hll.Sketch], sketch_model=SessionSketch) -> int:
+    """Replace all stored sketches with sketches; returns the number of rows written."""
+    with transaction.atomic():
+        sketch_model.objects.all().delete()
+        sketch_model.objects.bulk_create(
+            [sketch_model(registers=bytes(registers), **_key_fields(key)) for key, registers in sketches.items()],
+            batch_size=500,
+        )
+        DataGeneration.objects.filter(name=DELETES).update(value=0)
+    return len(sketches)
+
+
+def rebuild(event_model=RecommendationEvent, sketch_model=SessionSketch, chunk_size: int = 5000) -> int:
+    """Recompute all sketches from the event table; returns the number of rows written."""
+    rows = event_model.objects.values_list(*SKETCH_FIELDS)
+    return write(collect(rows.iterator(chunk_size=chunk_size)), sketch_model)
+
+
+def _merged(qs) -> bytes:
+    return hll.merge(qs.values_list("registers", flat=True).iterator(chunk_size=500))
+
+
+def unique_sessions(
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    dimensions: Optional[Mapping[str, str]] = None,
+    now=None,
+) -> int:
+    """Approximate distinct session_keys over the days since..until (inclusive) with dimensions."""
+    dimensions = dimensions or {}
+    qs = SessionSketch.objects.filter(**dimensions)
+    if since is not None:
+        qs = qs.filter(day__gte=since)
+    if until is not None:
+        qs = qs.filter(day__lte=until)
+
+    open_day = timezone.localdate((now or timezone.now()) - generation.CLOSE_GRACE)
+    dim_part = ",".join(f"{name}={value}" for name, value in sorted(dimensions.items()))
+    key = f"sessions:{generation.current()}:{open_day}:{since}:{until}:{dim_part}"
+    closed = cache.get(key)
+    if closed is None:
+        closed = _merged(qs.filter(day__lt=open_day))
+        cache.set(key, closed, MERGED_CACHE_SECONDS)
+    if until is not None and until < open_day:
+        return hll.estimate(closed)
+    return hll.estimate(hll.merge([closed, _merged(qs.filter(day__gte=open_day))]))
@@ -0,0 +1,273 @@
+"""
+Columnar snapshot of RecommendationEvent for offline analysis.
+
+A snapshot is a directory of .npy files, one per column, that np.load(...,
+mmap_mode="r") maps without reading them (see load()):
+
+- id.npy             int64   event id
+- created_at.npy     int64   microseconds since the Unix epoch (UTC)
+- segment.npy        int16   \\
+- customer_type.npy  int16    } codes into manifest["dictionaries"][column]
+- goal.npy           int16   /
+- leaf.npy           int32   code into manifest["dictionaries"]["leaf"]
+                             ("<segment>:<leaf node>"), -1 if the answers do
+                             not resolve in the current tree
+- answers.npy        uint8   (rows, len(answer_columns)) one-hot matrix, one
+                             column per "<question node>=<choice>" of the
+                             configured trees
+
+manifest.json records the rows written, the last event id, the dictionaries
+and the answer columns. update() appends only events with a larger id:
+column files are grown in place (fixed-size .npy header) and manifest.json is
+replaced last, so an interrupted run is cut back to the manifest next time.
+Dictionaries only ever grow, so codes stay valid across updates; if the
+trees gain or lose answer columns, the snapshot is rebuilt from scratch.
+"""
+from __future__ import annotations
+
+import json
+import os
+import struct
+import tempfile
+from datetime import datetime, timezone as dt_timezone
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .models import RecommendationEvent
+from .tree_engine import CompiledTree
+from .tree_store import UnknownSegment, registry
+
+FORMAT = 1
+MANIFEST = "manifest.json"
+DEFAULT_CHUNK_SIZE = 50_000
+
+DICTIONARY_COLUMNS = ("segment", "customer_type", "goal")
+# column -> dtype
+COLUMNS: Dict[str, str] = {
+    "id": "<i8",
+    "created_at": "<i8",
+    "segment": "<i2",
+    "customer_type": "<i2",
+    "goal": "<i2",
+    "leaf": "<i4",
+    "answers": "u1",  # second dimension = len(answer_columns)
+}
+
+# .npy header size, fixed so the shape can be rewritten in place as rows are appended
+HEADER_SIZE = 128
+_MAGIC = b"\x93NUMPY\x01\x00"
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+_MICROSECOND = datetime.resolution  # timedelta(microseconds=1)
+
+
+def _header(dtype: str, shape: Tuple[int, ...]) -> bytes:
+    text = repr({"descr": dtype, "fortran_order": False, "shape": shape})
+    body = text.ljust(HEADER_SIZE - len(_MAGIC) - 2 - 1) + "\n"
+    return _MAGIC + struct.pack("<H", len(body)) + body.encode("latin1")
+
+
+def _row_bytes(name: str, width: int) -> int:
+    return np.dtype(COLUMNS[name]).itemsize * (width if name == "answers" else 1)
+
+
+def _shape(name: str, rows: int, width: int) -> Tuple[int, ...]:
+    return (rows, width) if name == "answers" else (rows,)
+
+
+def answer_columns() -> List[str]:
+    """"<question node>=<choice>" for every choice of the configured trees (stable order)."""
+    columns: Dict[str, None] = {}
+    reg = registry()
+    for segment in reg.segments():
+        tree = reg.get(segment)
+        for node, is_leaf in enumerate(tree.is_leaf):
+            if not is_leaf:
+                for choice_key, _ in tree.choices[node]:
+                    columns[f"{tree.keys[node]}={choice_key}"] = None
+    return list(columns)
+
+
+def read_manifest(directory: Path) -> Optional[Dict[str, Any]]:
+    try:
+        manifest = json.loads((Path(directory) / MANIFEST).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("format") == FORMAT else None
+
+
+def _write_manifest(directory: Path, manifest: Dict[str, Any]) -> None:
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{MANIFEST}-", suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, ensure_ascii=False, indent=1)
+    os.replace(tmp, directory / MANIFEST)
+
+
+def _empty_manifest(columns: List[str]) -> Dict[str, Any]:
+    return {
+        "format": FORMAT,
+        "rows": 0,
+        "last_id": 0,
+        "created_at_unit": "us",
+        "dictionaries": {name: [] for name in DICTIONARY_COLUMNS + ("leaf",)},
+        "answer_columns": columns,
+        "updated_at": "",
+    }
+
+
+class _Encoder:
+    """Turns chunks of event rows into column arrays, growing the dictionaries."""
+
+    def __init__(self, manifest: Dict[str, Any]):
+        self.dictionaries = manifest["dictionaries"]
+        self.codes = {name: {v: i for i, v in enumerate(values)} for name, values in self.dictionaries.items()}
+        self.answer_index = {column: i for i, column in enumerate(manifest["answer_columns"])}
+        self.trees: Dict[str, Optional[CompiledTree]] = {}
+        self.unknown_answers = 0
+
+    def code(self, name: str, value: str) -> int:
+        codes = self.codes[name]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.dictionaries[name])
+            self.dictionaries[name].append(value)
+        return code
+
+    def tree(self, segment: str) -> Optional[CompiledTree]:
+        if segment not in self.trees:
+            try:
+                self.trees[segment] = registry().get(segment)
+            except UnknownSegment:
+                self.trees[segment] = None
+        return self.trees[segment]
+
+    def leaf(self, segment: str, answers: Any) -> int:
+        tree = self.tree(segment)
+        path_id = tree.resolve(answers) if tree is not None else -1
+        if path_id < 0:
+            return -1
+        return self.code("leaf", f"{segment}:{tree.keys[tree.path_leaf[path_id]]}")
+
+    def encode(self, rows: List[Tuple]) -> Dict[str, np.ndarray]:
+        n = len(rows)
+        answers = np.zeros((n, len(self.answer_index)), dtype=COLUMNS["answers"])
+        for i, (_, _, _, _, _, given) in enumerate(rows):
+            if not isinstance(given, dict):
+                continue
+            for key, choice in given.items():
+                column = self.answer_index.get(f"{key}={choice}")
+                if column is None:
+                    self.unknown_answers += 1
+                else:
+                    answers[i, column] = 1
+        return {
+            "id": np.fromiter((r[0] for r in rows), dtype=COLUMNS["id"], count=n),
+            "created_at": np.fromiter(
+                ((r[1] - _EPOCH) // _MICROSECOND for r in rows), dtype=COLUMNS["created_at"], count=n,
+            ),
+            "segment": np.fromiter((self.code("segment", r[2]) for r in rows), dtype=COLUMNS["segment"], count=n),
+            "customer_type": np.fromiter(
+                (self.code("customer_type", r[3]) for r in rows), dtype=COLUMNS["customer_type"], count=n,
+            ),
+            "goal": np.fromiter((self.code("goal", r[4]) for r in rows), dtype=COLUMNS["goal"], count=n),
+            "leaf": np.fromiter((self.leaf(r[2], r[5]) for r in rows), dtype=COLUMNS["leaf"], count=n),
+            "answers": answers,
+        }
+
+
+class _ColumnFiles:
+    """The column files of a snapshot, opened for appending after `rows` rows."""
+
+    def __init__(self, directory: Path, rows: int, width: int):
+        self.directory = directory
+        self.rows = rows
+        self.width = width
+        self.files = {}
+        for name, dtype in COLUMNS.items():
+            path = directory / f"{name}.npy"
+            fh = open(path, "r+b" if path.exists() else "w+b")
+            # drop anything an interrupted run wrote past the manifest
+            fh.truncate(HEADER_SIZE + rows * _row_bytes(name, width))
+            fh.seek(0)
+            fh.write(_header(dtype, _shape(name, rows, width)))
+            fh.seek(0, os.SEEK_END)
+            self.files[name] = fh
+
+    def append(self, arrays: Dict[str, np.ndarray]) -> None:
+        for name, fh in self.files.items():
+            fh.write(np.ascontiguousarray(arrays[name]).tobytes())
+        self.rows += len(arrays["id"])
+
+    def close(self) -> None:
+        for name, fh in self.files.items():
+            fh.seek(0)
+            fh.write(_header(COLUMNS[name], _shape(name, self.rows, self.width)))
+            fh.flush()
+            os.fsync(fh.fileno())
+            fh.close()
+
+
+def _event_rows(after_id: int, chunk_size: int) -> Iterator[List[Tuple]]:
+    rows = (
+        RecommendationEvent.objects.filter(id__gt=after_id).order_by("id")
+        .values_list("id", "created_at", "segment", "customer_type", "goal", "answers")
+        .iterator(chunk_size=chunk_size)
+    )
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def update(directory, chunk_size: int = DEFAULT_CHUNK_SIZE, rebuild: bool = False) -> Dict[str, Any]:
+    """
+    Append the events added since the last update to the snapshot in
+    directory (created if missing; rebuilt if rebuild or the answer columns
+    changed). Returns the new manifest plus "added", "rebuilt" and
+    "unknown_answers" (answers matching no column).
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    columns = answer_columns()
+    manifest = read_manifest(directory)
+    rebuilt = rebuild or manifest is None or manifest["answer_columns"] != columns
+    if rebuilt:
+        (directory / MANIFEST).unlink(missing_ok=True)
+        for name in COLUMNS:
+            (directory / f"{name}.npy").unlink(missing_ok=True)
+        manifest = _empty_manifest(columns)
+
+    encoder = _Encoder(manifest)
+    files = _ColumnFiles(directory, manifest["rows"], len(columns))
+    added = 0
+    try:
+        for chunk in _event_rows(manifest["last_id"], chunk_size):
+            files.append(encoder.encode(chunk))
+            added += len(chunk)
+            manifest["last_id"] = chunk[-1][0]
+    finally:
+        files.close()
+
+    manifest["rows"] = files.rows
+    manifest["updated_at"] = datetime.now(dt_timezone.utc).isoformat()
+    _write_manifest(directory, manifest)
+    return {**manifest, "added": added, "rebuilt": rebuilt, "unknown_answers": encoder.unknown_answers}
+
+
+def load(directory, mmap: bool = True) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """
+    ({column: array}, manifest) for a snapshot directory; with mmap the
+    arrays are memory-mapped read-only instead of read into memory.
+    """
+    directory = Path(directory)
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError(f"No snapshot in {directory}")
+    arrays = {
+        name: np.load(directory / f"{name}.npy", mmap_mode="r" if mmap else None)[:manifest["rows"]]
+        for name in COLUMNS
+    }
+    return arrays, manifest
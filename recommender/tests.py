@@ -1,3 +1,1286 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import Future
+from dataclasses import FrozenInstanceError
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import (
+    aggregates,
+    api,
+    charts,
+    choice_report,
+    dashboard,
+    events,
+    funnel,
+    generation,
+    hll,
+    paths,
+    rollups,
+    sketches,
+    snapshot,
+    timeseries,
+    tree_store,
+    views,
+)
+from .event_buffer import EventBuffer, dump_event
+from .events import build_event, save_events
+from .expressions import AnswerChoice
+from .models import EventProduct, EventRollup, NodeCount, PathPrefix, Product, RecommendationEvent, SessionSketch
+from .pagination import keyset_page
+from .path_token import PathToken, issue_token, read_token
+from .products import products_with_links
+from .tree_engine import compile_tree
+from .tree_konven import TREE
+from .tree_store import TreeRegistry, UnknownSegment, get_tree, load_tree_file, registry
+
+
+ANSWERS = {"q1": "individual", "ind_q2_goal": "property", "ind_property_q3": "non_subsidized"}
+ANSWERS_PATH = [0, 1, 1]
+
+# funnel counts are written as they happen: no flusher thread or exit hook that
+# outlives the test database (tests that check the buffering flush explicitly)
+TEST_SETTINGS = override_settings(BTN_FUNNEL_FLUSH_SECONDS=0)
+
+
+def setUpModule():
+    TEST_SETTINGS.enable()
+
+
+def tearDownModule():
+    TEST_SETTINGS.disable()
+
+
+def form_token(response) -> str:
+    """The path token in a questionnaire page's hidden field."""
+    return re.search(r'name="t" value="([^"]+)"', response.content.decode()).group(1)
+
+
+def location_token(response) -> str:
+    """The path token in a redirect's ?t= parameter."""
+    return parse_qs(urlsplit(response["Location"]).query)["t"][0]
+
+
+FRAGMENT = {"HTTP_X_BTN_FRAGMENT": "1"}
+
+
+def post_json(client, url: str, body):
+    return client.post(url, json.dumps(body), content_type="application/json")
+
+
+def ndjson(response) -> list:
+    return [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+
+
+def reset_tree_registry(test) -> None:
+    """Make test build the tree registry from its own settings."""
+    tree_store._registry = None
+    test.addCleanup(setattr, tree_store, "_registry", None)
+
+
+SYARIAH_TREE = {
+    "q1": {"text": "Syariah root?", "choices": {"a": {"label": "A", "next": "leaf_a"}}, "meta": {"segment": "syariah"}},
+    "leaf_a": {"leaf": True, "products": ["Tabungan iB"], "links": [""], "meta": {"goal": "saving"}},
+}
+
+
+def generate(*args: str) -> None:
+    """Run generate_recommendation_results without output."""
+    call_command("generate_recommendation_results", *args, verbosity=0, stdout=io.StringIO())
+
+
+def login_staff(client) -> None:
+    User.objects.create_superuser("staff", "staff@example.test", "pw")
+    client.login(username="staff", password="pw")
+
+
+def stored_rollups() -> list:
+    return sorted(EventRollup.objects.values_list("day", "dimension", "value", "count"))
+
+
+def make_legacy(event) -> list:
+    """Move event's products back into its JSON columns, as rows written before the catalog."""
+    rows = list(event.product_rows.select_related("product").order_by("position"))
+    names = [row.product.name for row in rows]
+    event.product_rows.all().delete()
+    RecommendationEvent.objects.filter(pk=event.pk).update(
+        recommended_products=names, product_links=[row.product.url for row in rows],
+    )
+    return names
+
+
+def stored_sketches() -> list:
+    rows = SessionSketch.objects.values_list("day", "segment", "customer_type", "goal", "registers")
+    return sorted((*key, bytes(registers)) for *key, registers in rows)
+
+
+def stored_prefixes() -> list:
+    return sorted(PathPrefix.objects.values_list("segment", "parent", "node", "choice", "count", "ends"))
+
+
+class CompiledTreeTests(SimpleTestCase):
+    def setUp(self):
+        self.tree = compile_tree(TREE)
+
+    def test_every_path_ends_on_its_leaf(self):
+        tree = self.tree
+        self.assertTrue(tree.paths)
+        for path_id, path in enumerate(tree.paths):
+            leaf = tree.path_leaf[path_id]
+            self.assertTrue(tree.is_leaf[leaf])
+            self.assertEqual(tree.walk(path), leaf)
+
+    def test_lookups(self):
+        tree = self.tree
+        self.assertEqual(tree.keys[tree.root], "q1")
+        self.assertEqual(tree.node_id("q1"), tree.root)
+        self.assertEqual(tree.node_id("nope"), -1)
+        self.assertEqual(tree.choice_index(tree.root, "business"), 1)
+        self.assertEqual(tree.choice_index(tree.root, "nope"), -1)
+        self.assertEqual(tree.walk([99]), -1)
+        self.assertEqual(tree.answers_for(ANSWERS_PATH), ANSWERS)
+
+    def test_leaf_payload_and_cumulative_meta(self):
+        tree = self.tree
+        leaf = tree.walk(ANSWERS_PATH)
+        self.assertEqual(tree.products[leaf][0], "KPR BTN Platinum")
+        meta = tree.meta[leaf]
+        self.assertEqual(
+            (meta["segment"], meta["customer_type"], meta["goal"]),
+            ("konven", "individual", "property"),
+        )
+
+    def test_read_only(self):
+        with self.assertRaises(FrozenInstanceError):
+            self.tree.root = 0
+        with self.assertRaises(TypeError):
+            self.tree.index["nope"] = 0
+
+    def test_version(self):
+        self.assertEqual(compile_tree(TREE).version, self.tree.version)
+        self.assertEqual(compile_tree(TREE, version="v9").version, "v9")
+
+    def test_refuses_bad_trees(self):
+        with self.assertRaises(ValueError):
+            compile_tree({"leaf": {"leaf": True}})  # no root
+        conflicting = {
+            "q1": {"text": "?", "choices": {"a": {"label": "A", "next": "x"}, "b": {"label": "B", "next": "y"}}},
+            "x": {"text": "?", "choices": {"c": {"label": "C", "next": "leaf"}}, "meta": {"goal": "saving"}},
+            "y": {"text": "?", "choices": {"c": {"label": "C", "next": "leaf"}}, "meta": {"goal": "loan"}},
+            "leaf": {"leaf": True, "products": ["P"]},
+        }
+        with self.assertRaises(ValueError):
+            compile_tree(conflicting)
+
+
+class PathTokenTests(SimpleTestCase):
+    def test_round_trip(self):
+        token = issue_token("run", "konven", "v1", (0, 1, 255))
+        self.assertEqual(read_token(token), PathToken("run", "konven", "v1", (0, 1, 255)))
+        self.assertEqual(read_token(issue_token("run", "konven", "v1", ())).path, ())
+
+    def test_tampered_token_is_rejected(self):
+        token = issue_token("run", "konven", "v1", (0, 1))
+        value, _, signature = token.rpartition(":")
+        forged = value.replace(".AAE.", ".AAI.") + ":" + signature  # path (0, 2), old signature
+        self.assertNotEqual(forged, token)
+        for bad in (forged, token[:-1] + ("A" if token[-1] != "A" else "B"), value, "", "garbage"):
+            self.assertIsNone(read_token(bad), bad)
+
+    def test_signed_with_the_current_secret_key(self):
+        token = issue_token("run", "konven", "v1", (0, 1))
+        with override_settings(SECRET_KEY="rotated"):
+            self.assertIsNone(read_token(token))
+            self.assertIsNotNone(read_token(issue_token("run", "konven", "v1", (0, 1))))
+
+
+@override_settings(BTN_STATELESS_WIZARD=True)
+class StatelessWizardTests(TestCase):
+    def start(self) -> str:
+        return form_token(self.client.get("/", follow=True))
+
+    def test_walk_writes_only_the_event(self):
+        token = self.start()
+        with self.assertNumQueries(0), mock.patch.object(funnel, "record"):  # (funnel counts: see FunnelTests)
+            for choice in ANSWERS.values():
+                response = self.client.post("/q/", {"choice": choice, "t": token})
+                self.assertEqual(response.status_code, 302)
+                token = location_token(response)
+        result = self.client.get("/q/", {"t": token})
+        self.assertIn("/result/", result["Location"])
+        event = RecommendationEvent.objects.get()
+        self.assertEqual(event.answers, ANSWERS)
+        self.assertEqual(event.goal, "property")
+        self.assertTrue(event.session_key.startswith("t:"))
+
+        # refreshing the last step shows the same event
+        self.assertEqual(self.client.get("/q/", {"t": token})["Location"], result["Location"])
+        self.assertEqual(RecommendationEvent.objects.count(), 1)
+
+    def test_tampered_token_is_rejected(self):
+        token = self.start()
+        tampered = token[:-1] + ("A" if token[-1] != "A" else "B")
+        self.assertEqual(self.client.get("/q/", {"t": tampered}).status_code, 400)
+        self.assertEqual(self.client.post("/q/", {"choice": "individual", "t": tampered}).status_code, 400)
+        self.assertFalse(RecommendationEvent.objects.exists())
+
+    def test_token_of_another_tree_version_starts_over(self):
+        response = self.client.get("/q/", {"t": issue_token("run", "konven", "old", (0, 1))})
+        self.assertEqual(response.status_code, 302)
+        parsed = read_token(location_token(response))
+        self.assertEqual((parsed.version, parsed.path), (get_tree().version, ()))
+
+
+class FragmentTests(TestCase):
+    def walk(self, token=""):
+        data = {"t": token} if token else {}
+        response = self.client.post("/q/", {"choice": "bogus", **data}, **FRAGMENT)
+        self.assertContains(response, "Please select one option.")
+        self.assertNotContains(response, "<html")
+
+        choices = list(ANSWERS.values())
+        for choice in choices[:-1]:
+            response = self.client.post("/q/", {"choice": choice, **data}, **FRAGMENT)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotContains(response, "<html")
+            if token:
+                data["t"] = form_token(response)
+        # the address the page script puts in the history is a full page
+        self.assertContains(self.client.get(response["X-BTN-Location"]), "<html")
+
+        response = self.client.post("/q/", {"choice": choices[-1], **data}, **FRAGMENT)
+        self.assertContains(response, "KPR BTN Platinum")
+        location = response["X-BTN-Location"]
+        self.assertIn("/result/", location)
+        self.assertContains(self.client.get(location), "KPR BTN Platinum")
+
+        # a repeated last answer leads to the same result, not a second event
+        response = self.client.post("/q/", {"choice": choices[-1], **data}, **FRAGMENT)
+        self.assertEqual(response["X-BTN-Location"], location)
+        self.assertEqual(RecommendationEvent.objects.count(), 1)
+
+    def test_session(self):
+        self.client.get("/")
+        self.client.post("/q/", {"choice": "business"}, **FRAGMENT)
+        self.assertContains(self.client.post("/q/", {"action": "reset"}, **FRAGMENT), "Are you using BTN as")
+        self.walk()
+
+    @override_settings(BTN_STATELESS_WIZARD=True)
+    def test_token(self):
+        token = form_token(self.client.get("/", follow=True))
+        self.walk(token)
+
+
+class ApiTests(TestCase):
+    def recommend(self, body):
+        return post_json(self.client, "/api/recommend/", body)
+
+    def test_tree(self):
+        response = self.client.get("/api/tree/")
+        data = response.json()
+        self.assertEqual(data["nodes"][data["root"]]["k"], "q1")
+        self.assertEqual(data["version"], get_tree().version)
+        self.assertEqual(self.client.get("/api/tree/", HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+        self.assertIn("immutable", self.client.get("/api/tree/", {"v": data["version"]})["Cache-Control"])
+
+    def test_tree_etag_follows_the_content(self):
+        changed = {**SYARIAH_TREE, "q1": {**SYARIAH_TREE["q1"], "text": "Changed?"}}
+        etags = []
+        api._TREE_JSON.clear()
+        for doc in (SYARIAH_TREE, changed, SYARIAH_TREE):
+            with mock.patch.object(api, "get_tree", return_value=compile_tree(doc, version="v1")):
+                etags.append(self.client.get("/api/tree/", {"segment": "syariah"})["ETag"])
+        self.assertNotEqual(etags[0], etags[1])
+        self.assertEqual(etags[0], etags[2])
+        self.assertEqual(list(api._TREE_JSON), ["syariah"])  # one entry per segment, not per tree
+
+    def test_recommend_is_idempotent_per_run(self):
+        first = self.recommend({"answers": ANSWERS, "run_id": "abc"})
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(first.json()["products"][0]["name"], "KPR BTN Platinum")
+        again = self.recommend({"answers": ANSWERS, "run_id": "abc"})
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.json()["event_id"], first.json()["event_id"])
+        self.assertEqual(self.client.get(first.json()["result_url"]).status_code, 200)
+
+        self.assertEqual(self.recommend({"path": ANSWERS_PATH, "version": get_tree().version}).status_code, 201)
+        self.assertEqual(RecommendationEvent.objects.count(), 2)
+        self.assertEqual(RecommendationEvent.objects.get(session_key="api:abc").answers, ANSWERS)
+
+    def test_recommend_rejects_bad_requests(self):
+        self.assertEqual(self.recommend({"path": ANSWERS_PATH, "version": "old"}).status_code, 409)
+        for body in ({"path": [0, 1]}, {"path": [-1]}, {"answers": {**ANSWERS, "extra": "x"}}, {}, []):
+            self.assertEqual(self.recommend(body).status_code, 400, body)
+        self.assertEqual(self.client.post("/api/recommend/", "nope", content_type="application/json").status_code, 400)
+        self.assertFalse(RecommendationEvent.objects.exists())
+
+
+class ResolveTests(SimpleTestCase):
+    def setUp(self):
+        self.tree = compile_tree(TREE)
+
+    def test_every_path_resolves_both_ways(self):
+        tree = self.tree
+        for path_id, path in enumerate(tree.paths):
+            answers = tree.answers_for(path)
+            self.assertEqual(tree.resolve(answers), path_id)
+            self.assertEqual(tree.resolve_path(path), path_id)
+            self.assertEqual(tree.resolve_path(list(path)), path_id)
+            self.assertEqual(tree.path_for_answers(answers), path)
+
+    def test_resolve_rejects_bad_answers(self):
+        bad = (
+            {},
+            {"q1": "individual"},                    # partial
+            {**ANSWERS, "extra": "x"},               # extra node
+            {**ANSWERS, "q1": "business"},           # not one path
+            {**ANSWERS, "q1": ["individual"]},       # unhashable value
+            [("q1", "individual")],                  # not a dict
+            None,
+            "q1",
+        )
+        for answers in bad:
+            self.assertEqual(self.tree.resolve(answers), -1, answers)
+        self.assertIsNone(self.tree.path_for_answers({"q1": "individual"}))
+
+    def test_resolve_path_rejects_bad_paths(self):
+        bad = ([], [0], [0, 1], [-1], [0, 1, 1, 0], [0, True, 1], ["0", 1, 1], [0.0, 1, 1], "011", None)
+        for path in bad:
+            self.assertEqual(self.tree.resolve_path(path), -1, path)
+
+
+BATCH_NDJSON = "\n".join([
+    json.dumps({"ref": "a", "answers": ANSWERS}),
+    json.dumps({"ref": "b", "path": ANSWERS_PATH}),
+    "garbage",
+    json.dumps({"ref": "c", "answers": {"q1": "individual"}}),
+]) + "\n"
+BATCH_CSV = "ref,q1,ind_q2_goal,ind_property_q3\nx,individual,property,non_subsidized\ny,individual,,\n"
+
+
+@override_settings(BTN_PARTNER_API_TOKEN="sekret")
+class BatchTests(TestCase):
+    def batch(self, body, content_type, query="", **headers):
+        return self.client.post("/api/batch/" + query, body, content_type=content_type, **headers)
+
+    def test_needs_the_partner_token(self):
+        self.assertEqual(self.batch(BATCH_NDJSON, "application/x-ndjson").status_code, 403)
+        self.assertEqual(self.batch(BATCH_NDJSON, "application/x-ndjson", HTTP_AUTHORIZATION="Bearer nope").status_code, 403)
+
+    def test_one_result_per_record(self):
+        response = self.batch(BATCH_NDJSON, "application/x-ndjson", "?persist=1&batch_size=2", HTTP_AUTHORIZATION="Bearer sekret")
+        rows = ndjson(response)
+        self.assertEqual([row["ok"] for row in rows], [True, True, False, False])
+        self.assertIn("event_id", rows[0])
+        self.assertEqual(RecommendationEvent.objects.count(), 2)
+
+        rows = ndjson(self.batch(BATCH_CSV, "text/csv", HTTP_AUTHORIZATION="Bearer sekret"))
+        self.assertEqual([(row["ref"], row["ok"]) for row in rows], [("x", True), ("y", False)])
+        self.assertEqual(RecommendationEvent.objects.count(), 2)  # not persisted
+
+    def test_command(self):
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        source = directory / "in.csv"
+        source.write_text(BATCH_CSV)
+        output = directory / "out.ndjson"
+        call_command("batch_recommend", str(source), "--output", str(output), "--persist", stderr=io.StringIO())
+        rows = [json.loads(line) for line in output.read_text().splitlines()]
+        self.assertEqual([row["ok"] for row in rows], [True, False])
+        self.assertEqual(RecommendationEvent.objects.get().answers, ANSWERS)
+
+
+class TreeFileTests(TestCase):
+    def setUp(self):
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.path = directory / "konven.json"
+        self.cache_dir = directory / "cache"
+        self.enterContext(override_settings(
+            BTN_TREES={"konven": str(self.path)}, BTN_TREE_CACHE_DIR=self.cache_dir, BTN_TREE_CHECK_SECONDS=0,
+        ))
+        call_command("export_tree", str(self.path), "--tree-version", "v1", stdout=io.StringIO())
+        reset_tree_registry(self)
+
+    def replace(self, text: str) -> None:
+        """Write the tree file the way a deploy would, with a newer mtime."""
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(text)
+        os.replace(tmp, self.path)
+        later = time.time_ns() + 10**9
+        os.utime(self.path, ns=(later, later))
+
+    def test_cached_tree_equals_compiled_tree(self):
+        compiled = load_tree_file(self.path)
+        self.assertEqual(compiled.paths, compile_tree(TREE).paths)
+        self.assertEqual(load_tree_file(self.path, self.cache_dir), compiled)  # writes the cache
+        self.assertEqual(len(list(self.cache_dir.iterdir())), 1)
+        self.assertEqual(load_tree_file(self.path, self.cache_dir), compiled)  # reads it
+
+    def test_reload(self):
+        self.assertEqual(get_tree().version, "v1")
+        doc = json.loads(self.path.read_text())
+        doc["version"] = "v2"
+        doc["tree"]["leaf_kpr_btn_platinum"]["links"] = ["https://example.test/new"]
+        self.replace(json.dumps(doc))
+        tree = get_tree()
+        self.assertEqual(tree.version, "v2")
+        self.assertEqual(tree.links[tree.walk(ANSWERS_PATH)], ("https://example.test/new",))
+
+        self.replace("{broken")
+        with self.assertLogs("recommender.tree_store", "ERROR"):
+            self.assertEqual(get_tree().version, "v2")
+
+    def test_runs_restart_on_a_new_version(self):
+        self.client.get("/")
+        self.client.post("/q/", {"choice": "individual"})
+        doc = json.loads(self.path.read_text())
+        doc["version"] = "v2"
+        self.replace(json.dumps(doc))
+        self.assertContains(self.client.get("/q/", follow=True), "Are you using BTN as")
+        for choice in ANSWERS.values():
+            self.client.post("/q/", {"choice": choice})
+        self.client.get("/q/")
+        self.assertEqual(RecommendationEvent.objects.get().tree_version, "v2")
+
+    def test_bad_definitions(self):
+        for text in ("{broken", "[]", json.dumps({"tree": []}), json.dumps({"version": "v" * 65, "tree": TREE})):
+            self.path.write_text(text)
+            with self.assertRaises(ValueError):
+                load_tree_file(self.path)
+
+
+@override_settings(BTN_TREES={"konven": "recommender.tree_konven:TREE", "syariah": "recommender.tests:SYARIAH_TREE"})
+class SegmentTests(TestCase):
+    def setUp(self):
+        reset_tree_registry(self)
+
+    def test_trees_load_on_first_use(self):
+        trees = registry()
+        self.assertEqual(trees.segments(), ["konven", "syariah"])
+        self.assertEqual(trees._loaders, {})
+        trees.get("konven")
+        self.assertEqual(list(trees._loaders), ["konven"])
+        with self.assertRaises(UnknownSegment):
+            trees.get("nope")
+        with self.assertRaises(ImproperlyConfigured):
+            TreeRegistry({"no spaces": "recommender.tree_konven:TREE"})
+
+    def test_wizard(self):
+        self.assertEqual(self.client.get("/start/nope/").status_code, 404)
+        self.client.get("/start/syariah/")
+        self.assertContains(self.client.get("/q/"), "Syariah root?")
+        self.client.post("/q/", {"choice": "a"})
+        self.client.get("/q/")
+        self.assertEqual(RecommendationEvent.objects.get().segment, "syariah")
+        self.client.get("/restart/")
+        self.assertContains(self.client.get("/q/"), "Syariah root?")
+        self.client.get("/")
+        self.assertContains(self.client.get("/q/"), "Are you using BTN as")
+
+    @override_settings(BTN_STATELESS_WIZARD=True)
+    def test_token(self):
+        token = form_token(self.client.get("/start/syariah/", follow=True))
+        self.assertContains(self.client.post("/q/", {"choice": "a", "t": token}, follow=True), "Tabungan iB")
+
+    def test_api(self):
+        syariah = self.client.get("/api/tree/", {"segment": "syariah"})
+        self.assertEqual(syariah.json()["segment"], "syariah")
+        self.assertNotEqual(syariah["ETag"], self.client.get("/api/tree/")["ETag"])
+        self.assertEqual(self.client.get("/api/tree/", {"segment": "nope"}).status_code, 404)
+        response = post_json(self.client, "/api/recommend/", {"segment": "syariah", "path": [0]})
+        self.assertEqual(response.status_code, 201)
+
+
+class QuestionPageCacheTests(TestCase):
+    def test_cached_page_gets_this_clients_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.get("/")
+        client.get("/q/")
+        with mock.patch.object(views, "render_to_string", side_effect=AssertionError("page not cached")):
+            page = client.get("/q/").content.decode()
+        self.assertNotIn(views.CSRF_PLACEHOLDER, page)
+        csrf = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', page).group(1)
+        self.assertEqual(client.post("/q/", {"choice": "individual", "csrfmiddlewaretoken": csrf}).status_code, 302)
+
+    @override_settings(BTN_STATELESS_WIZARD=True)
+    def test_cached_page_gets_this_runs_token(self):
+        first = form_token(self.client.get("/", follow=True))
+        with mock.patch.object(views, "render_to_string", side_effect=AssertionError("page not cached")):
+            page = self.client.get("/", follow=True)
+        self.assertNotIn(views.TOKEN_PLACEHOLDER, page.content.decode())
+        second = form_token(page)
+        self.assertNotEqual(read_token(first).run_id, read_token(second).run_id)
+
+
+@override_settings(BTN_EVENT_WRITE_BEHIND=True, BTN_EVENT_FLUSH_SECONDS=60)
+class EventSpoolTests(TransactionTestCase):
+    def setUp(self):
+        self.spool_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.enterContext(override_settings(BTN_EVENT_SPOOL_DIR=self.spool_dir))
+        events._buffer = None
+        self.addCleanup(setattr, events, "_buffer", None)
+        self.saved = []
+        events.events_saved.connect(self.on_saved)
+        self.addCleanup(events.events_saved.disconnect, self.on_saved)
+
+    def on_saved(self, sender, events, **kwargs):
+        self.saved.extend(events)
+
+    def test_wizard_result_before_and_after_flush(self):
+        self.client.get("/")
+        for choice in ANSWERS.values():
+            self.client.post("/q/", {"choice": choice})
+        location = self.client.get("/q/")["Location"]
+        self.assertFalse(RecommendationEvent.objects.exists())
+        self.assertContains(self.client.get(location), "KPR BTN Platinum")  # served from the buffer
+
+        self.assertEqual(events.event_buffer().flush(), 1)
+        self.assertEqual(RecommendationEvent.objects.count(), 1)
+        self.assertEqual(len(self.saved), 1)
+        self.assertContains(self.client.get(location), "KPR BTN Platinum")
+
+    def test_replay_skips_stored_events_and_cut_lines(self):
+        tree = get_tree()
+        leaf = tree.walk(ANSWERS_PATH)
+        spooled = [events.build_event(tree, leaf, f"s{i}", ANSWERS) for i in range(3)]
+        events.save_events(spooled[:1])
+        self.saved.clear()
+        orphan = self.spool_dir / "events-999-dead.ndjson"
+        orphan.write_bytes(b"".join(dump_event(event) for event in spooled) + b'{"broken')
+
+        buffer = EventBuffer(self.spool_dir, writer=events.save_events)
+        with self.assertLogs("recommender.event_buffer", "WARNING"):
+            self.assertEqual(buffer.replay_orphans(), 3)
+        self.assertFalse(orphan.exists())
+        self.assertEqual(len(self.saved), 2)
+        self.assertEqual(RecommendationEvent.objects.count(), 3)
+        self.assertEqual(RecommendationEvent.objects.get(session_key="s2").created_at, spooled[2].created_at)
+
+        # a second replay of the same file writes nothing new
+        orphan.write_bytes(b"".join(dump_event(event) for event in spooled))
+        self.assertEqual(buffer.replay_orphans(), 3)
+        self.assertEqual(RecommendationEvent.objects.count(), 3)
+        self.assertEqual(len(self.saved), 2)
+
+    def test_only_issued_result_urls_wait(self):
+        public_id = uuid.uuid4()
+        ticket = parse_qs(urlsplit(events.result_url(public_id)).query)[events.WAIT_PARAM][0]
+        self.assertTrue(events.may_wait(public_id, ticket))
+        self.assertFalse(events.may_wait(uuid.uuid4(), ticket))
+        with mock.patch.object(events.time, "sleep", side_effect=AssertionError("waited")):
+            self.assertEqual(self.client.get(f"/result/{uuid.uuid4()}/").status_code, 404)
+            self.assertEqual(self.client.get(f"/result/{uuid.uuid4()}/", {events.WAIT_PARAM: ticket}).status_code, 404)
+        with override_settings(BTN_EVENT_FLUSH_SECONDS=0.1), mock.patch.object(events.time, "sleep", wraps=time.sleep) as sleep:
+            self.assertEqual(self.client.get(f"/result/{public_id}/", {events.WAIT_PARAM: ticket}).status_code, 404)
+        self.assertTrue(sleep.called)
+
+    def test_api_retry_is_one_event(self):
+        body = {"path": ANSWERS_PATH, "run_id": "abc"}
+        first = post_json(self.client, "/api/recommend/", body)
+        again = post_json(self.client, "/api/recommend/", body)
+        self.assertEqual((first.status_code, again.status_code), (201, 200))
+        self.assertEqual(first.json()["event_id"], again.json()["event_id"])
+        events.event_buffer().flush()
+        self.assertEqual(RecommendationEvent.objects.count(), 1)
+
+
+class SaveEventsTests(TestCase):
+    def build(self, n: int) -> list:
+        tree = get_tree()
+        return [events.build_event(tree, tree.walk(ANSWERS_PATH), f"s{i}", ANSWERS) for i in range(n)]
+
+    def test_row_stored_by_another_worker_meanwhile(self):
+        stored, new = self.build(2)
+        events.save_events([stored])
+        lookups = [set()]  # the first lookup ran before the other worker's INSERT
+        real = events._stored_public_ids
+        with mock.patch.object(events, "_stored_public_ids", side_effect=lambda ids: lookups.pop() if lookups else real(ids)):
+            self.assertEqual(events.save_events([stored, new]), [new])
+        self.assertEqual(RecommendationEvent.objects.count(), 2)
+        self.assertEqual(sum(rollups.totals("goal").values()), 2)  # events_saved only had new
+
+    def test_large_batches(self):
+        batch = self.build(1200)
+        events.save_events(batch[:700])
+        with mock.patch.object(events, "LOOKUP_CHUNK_SIZE", 250):
+            self.assertEqual(len(events.save_events(batch)), 500)
+        self.assertEqual(RecommendationEvent.objects.count(), 1200)
+
+
+class RollupTests(TestCase):
+    def test_incremental_equals_rebuild(self):
+        generate("--random", "300", "--seed", "3", "--start-days-ago", "20")
+        post_json(self.client, "/api/recommend/", {"path": ANSWERS_PATH})
+        live = stored_rollups()
+        self.assertTrue(live)
+        rollups.rebuild()
+        self.assertEqual(stored_rollups(), live)
+        self.assertEqual(sum(rollups.totals("goal").values()), 301)
+
+        generate("--delete-generated", "--random", "5")
+        self.assertEqual(sum(rollups.totals("goal").values()), 6)
+
+    def test_deletes_are_subtracted(self):
+        generate("--random", "200", "--seed", "4", "--start-days-ago", "20")
+        make_legacy(RecommendationEvent.objects.order_by("id").first())
+        RecommendationEvent.objects.filter(id__lte=RecommendationEvent.objects.order_by("id")[50].id).delete()
+        RecommendationEvent.objects.order_by("-id").first().delete()
+        self.assertTrue(sketches.stale())
+        live = stored_rollups(), stored_prefixes()
+        self.assertEqual(sum(rollups.totals("goal").values()), 148)
+
+        login_staff(self.client)
+        self.assertContains(self.client.get("/analytics/"), "Still counts deleted events")
+        aggregates.rebuild_all()
+        self.assertEqual((stored_rollups(), stored_prefixes()), live)
+        self.assertFalse(sketches.stale())
+        self.assertNotContains(self.client.get("/analytics/"), "Still counts deleted events")
+
+    def test_admin_lists_aggregates(self):
+        generate("--random", "20", "--seed", "5", "--start-days-ago", "3")
+        login_staff(self.client)
+        for model in ("sessionsketch", "pathprefix", "datageneration"):
+            self.assertEqual(self.client.get(f"/admin/recommender/{model}/").status_code, 200)
+        self.assertEqual(self.client.get("/admin/recommender/pathprefix/add/").status_code, 403)
+
+    def test_dashboard_total(self):
+        generate()
+        login_staff(self.client)
+        self.assertEqual(self.client.get("/analytics/").context["kpis"]["total"], RecommendationEvent.objects.count())
+
+
+class ChartImageTests(TestCase):
+    def setUp(self):
+        caches["charts"].clear()
+        generate()
+        login_staff(self.client)
+
+    def test_images(self):
+        urls = self.client.get("/analytics/").context["chart_images"]
+        self.assertIn("goal", urls)
+        for url in urls.values():
+            image = self.client.get(url)
+            self.assertEqual(image["Content-Type"], "image/png")
+            self.assertTrue(image.content.startswith(b"\x89PNG"))
+
+        caches["charts"].clear()
+        self.assertEqual(self.client.get(urls["goal"]).status_code, 200)  # rendered again
+        post_json(self.client, "/api/recommend/", {"path": ANSWERS_PATH})
+        caches["charts"].clear()
+        self.assertEqual(self.client.get(urls["goal"]).status_code, 302)  # outdated: to the current image
+        self.assertEqual(self.client.get("/analytics/chart/nope/abc.png").status_code, 404)
+
+    def test_stale_image_while_rendering(self):
+        old = self.client.get("/analytics/").context["chart_images"]["goal"]
+        old_png = self.client.get(old).content
+        post_json(self.client, "/api/recommend/", {"path": ANSWERS_PATH})
+        new = self.client.get("/analytics/").context["chart_images"]["goal"]
+        self.assertNotEqual(new, old)
+
+        release = threading.Event()
+        render = charts.render_png
+        with mock.patch.object(charts, "render_png", side_effect=lambda *args: release.wait(5) and render(*args)):
+            stale = self.client.get(new)
+            self.assertEqual(stale.content, old_png)
+            self.assertIn("no-cache", stale["Cache-Control"])
+            release.set()
+            for future in list(charts._inflight.values()):
+                future.result()
+        fresh = self.client.get(new)
+        self.assertNotEqual(fresh.content, old_png)
+        self.assertIn("immutable", fresh["Cache-Control"])
+
+    def test_pages_do_not_import_matplotlib(self):
+        code = "import sys, django; django.setup(); import config.urls; print('matplotlib' in sys.modules)"
+        out = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, cwd=settings.BASE_DIR,
+            env={**os.environ, "DJANGO_SETTINGS_MODULE": "config.settings"},
+        )
+        self.assertEqual(out.stdout.strip(), "False", out.stderr)
+
+
+class DashboardDataTests(TestCase):
+    def setUp(self):
+        caches["charts"].clear()
+        generate()
+        login_staff(self.client)
+
+    def test_data(self):
+        page = self.client.get("/analytics/")
+        self.assertContains(page, 'id="dashboard-data"')
+        data = self.client.get("/analytics/data/")
+        total = RecommendationEvent.objects.count()
+        self.assertEqual(data.json()["kpis"]["total"], total)
+        self.assertEqual(data.json()["charts"]["goal"]["fp"], page.context["chart_images"]["goal"].split("/")[-1][:-4])
+
+        self.assertEqual(self.client.get("/analytics/data/", HTTP_IF_NONE_MATCH=data["ETag"]).status_code, 304)
+        post_json(self.client, "/api/recommend/", {"path": ANSWERS_PATH})
+        changed = self.client.get("/analytics/data/", HTTP_IF_NONE_MATCH=data["ETag"])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.json()["kpis"]["total"], total + 1)
+
+    def test_needs_staff(self):
+        self.client.logout()
+        self.assertEqual(self.client.get("/analytics/data/").status_code, 302)
+
+
+class KeysetPagingTests(TestCase):
+    def test_pages_cover_every_row_once(self):
+        generate("--random", "95", "--seed", "1", "--start-days-ago", "3")
+        first_ids = RecommendationEvent.objects.order_by("id").values_list("id", flat=True)[:5]
+        RecommendationEvent.objects.filter(id__in=list(first_ids)).update(created_at=timezone.now())  # ties
+        expected = list(RecommendationEvent.objects.order_by("-created_at", "-id").values_list("id", flat=True))
+
+        qs = RecommendationEvent.objects.all()
+        pages, page = [], keyset_page(qs, 10)
+        while True:
+            pages.append([row.id for row in page.rows])
+            if not page.older:
+                break
+            page = keyset_page(qs, 10, before=page.older)
+        self.assertEqual([pk for rows in pages for pk in rows], expected)
+
+        back = []
+        while page.newer:
+            page = keyset_page(qs, 10, after=page.newer)
+            back.insert(0, [row.id for row in page.rows])
+        self.assertEqual(back, pages[:-1])
+        self.assertEqual(keyset_page(qs, 10, before="garbage!").rows[0].id, expected[0])
+
+    def test_view_seeks_with_the_index(self):
+        generate()
+        login_staff(self.client)
+        response = self.client.get("/analytics/", {"page_size": 20})
+        self.assertEqual(len(response.context["events"]), 20)
+        older = re.search(r'href="\?([^"]*before=[^"]*)"', response.content.decode()).group(1).replace("&amp;", "&")
+        self.assertIn("page_size=20", older)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self.client.get("/analytics/?" + older).context["events"]), 20)
+        sql = next(q["sql"] for q in queries if 'created_at" <' in q["sql"])
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            self.assertIn("event_created_id_idx", str(cursor.fetchall()))
+
+
+class FilterTests(TestCase):
+    def setUp(self):
+        generate("--random", "400", "--seed", "5", "--start-days-ago", "10")
+
+    def expected(self, keep):
+        events = [event for event in RecommendationEvent.objects.all() if keep(event)]
+        self.assertTrue(events)
+        return {
+            "goal": Counter(event.goal for event in events),
+            "customer_type": Counter(event.customer_type for event in events),
+            "product": Counter(p["name"] for event in events for p in products_with_links(event)),
+        }
+
+    def test_counters_equal_a_python_count(self):
+        today = timezone.localdate()
+        filters = dashboard.parse_filters({
+            "from": (today - timedelta(days=5)).isoformat(),
+            "to": (today - timedelta(days=1)).isoformat(),
+            "customer_type": "individual",
+        })
+
+        def in_range(event):
+            return filters.date_from <= timezone.localdate(event.created_at) <= filters.date_to
+
+        self.assertEqual(
+            dashboard.dimension_counters(filters),
+            self.expected(lambda event: in_range(event) and event.customer_type == "individual"),
+        )
+        # dates only: read from the rollups
+        self.assertEqual(dashboard.dimension_counters(filters._replace(customer_type="")), self.expected(in_range))
+
+    def test_parse_filters(self):
+        self.assertEqual(dashboard.parse_filters({"from": "nope", "goal": " property "}), dashboard.Filters(goal="property"))
+
+    def test_goal_filter_uses_its_index(self):
+        filters = dashboard.parse_filters({"goal": "property", "from": "2026-01-01"})
+        qs = dashboard.filter_events(RecommendationEvent.objects.all(), filters)
+        sql, params = qs.order_by().values("goal").annotate(n=Count("id")).query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            self.assertIn("event_goal_created_idx", str(cursor.fetchall()))
+
+    def test_view(self):
+        login_staff(self.client)
+        response = self.client.get("/analytics/", {"goal": "property", "page_size": 5})
+        self.assertTrue(all(event.goal == "property" for event in response.context["events"]))
+        total = RecommendationEvent.objects.filter(goal="property").count()
+        self.assertEqual(response.context["kpis"]["total"], total)
+        self.assertContains(response, '<option value="property" selected>')
+        self.assertIn("?goal=property", response.context["chart_images"]["goal"])
+        self.assertEqual(self.client.get("/analytics/data/", {"goal": "property"}).json()["kpis"]["total"], total)
+
+
+class ProductCatalogTests(TestCase):
+    def test_events_link_catalog_products(self):
+        response = post_json(self.client, "/api/recommend/", {"path": ANSWERS_PATH})
+        event = RecommendationEvent.objects.get()
+        self.assertEqual((event.recommended_products, event.product_links), ([], []))
+        self.assertEqual(products_with_links(event), response.json()["products"])
+        self.assertTrue(Product.objects.filter(name="KPR BTN Platinum").exists())
+
+        self.assertContains(self.client.get(response.json()["result_url"]), "KPR BTN Platinum")
+        login_staff(self.client)
+        self.assertEqual(
+            self.client.get("/analytics/").context["events"][0].product_names,
+            [product["name"] for product in response.json()["products"]],
+        )
+
+    def test_backfill_keeps_counts(self):
+        generate("--random", "200", "--seed", "2", "--start-days-ago", "5")
+        filters = dashboard.parse_filters({"goal": "property"})
+        counts = dashboard.dimension_counters(filters)["product"]
+        totals = rollups.totals("product")
+        legacy = list(RecommendationEvent.objects.order_by("id")[:50])
+        names = [make_legacy(event) for event in legacy]
+        before = products_with_links(RecommendationEvent.objects.get(pk=legacy[0].pk))
+        self.assertEqual([product["name"] for product in before], names[0])
+        self.assertEqual(dashboard.dimension_counters(filters)["product"], counts)
+
+        call_command("backfill_event_products", stdout=io.StringIO())
+        self.assertFalse(RecommendationEvent.objects.exclude(recommended_products=[]).exists())
+        self.assertEqual(EventProduct.objects.filter(event__in=legacy).count(), sum(map(len, names)))
+        self.assertEqual(products_with_links(RecommendationEvent.objects.get(pk=legacy[0].pk)), before)
+        self.assertEqual(dashboard.dimension_counters(filters)["product"], counts)
+        rollups.rebuild()
+        self.assertEqual(rollups.totals("product"), totals)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        generate("--random", "300", "--seed", "3", "--start-days-ago", "5")
+        self.legacy = RecommendationEvent.objects.order_by("id").first()
+        self.legacy_names = make_legacy(self.legacy)
+
+    def body(self, response) -> bytes:
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content)
+
+    def test_view(self):
+        self.assertEqual(self.client.get("/analytics/export/").status_code, 302)
+        login_staff(self.client)
+        rows = list(csv.DictReader(io.StringIO(self.body(self.client.get("/analytics/export/", {"format": "csv"})).decode())))
+        self.assertEqual(len(rows), 300)
+        self.assertEqual(int(rows[0]["id"]), self.legacy.pk)
+        self.assertEqual(json.loads(rows[0]["products"]), self.legacy_names)
+        for row in rows[1:5]:
+            event = RecommendationEvent.objects.get(pk=row["id"])
+            self.assertEqual(json.loads(row["products"]), [p["name"] for p in products_with_links(event)])
+
+        response = self.client.get("/analytics/export/", {"format": "ndjson", "gzip": "1", "goal": "property"})
+        lines = gzip.decompress(self.body(response)).decode().splitlines()
+        self.assertEqual(len(lines), RecommendationEvent.objects.filter(goal="property").count())
+        self.assertTrue(all(json.loads(line)["goal"] == "property" for line in lines))
+        self.assertEqual(self.client.get("/analytics/export/", {"format": "xml"}).status_code, 400)
+
+    def test_command(self):
+        path = Path(self.enterContext(tempfile.TemporaryDirectory())) / "events.ndjson.gz"
+        call_command("export_events", str(path), "--chunk-size", "7", stdout=io.StringIO())
+        lines = gzip.decompress(path.read_bytes()).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line)["id"] for line in lines],
+            list(RecommendationEvent.objects.order_by("id").values_list("id", flat=True)),
+        )
+
+
+class SnapshotTests(TestCase):
+    def test_incremental_update(self):
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        generate("--random", "120", "--seed", "4")
+        result = snapshot.update(directory, chunk_size=17)
+        self.assertTrue(result["rebuilt"])
+        self.assertEqual(result["added"], 120)
+
+        generate("--random", "30", "--seed", "5")
+        with open(directory / "id.npy", "ab") as fh:
+            fh.write(b"x" * 100)  # left over by an interrupted update
+        result = snapshot.update(directory, chunk_size=7)
+        self.assertFalse(result["rebuilt"])
+        self.assertEqual((result["added"], result["unknown_answers"]), (30, 0))
+
+        columns, manifest = snapshot.load(directory)
+        self.assertIsInstance(columns["id"], np.memmap)
+        ids = list(RecommendationEvent.objects.order_by("id").values_list("id", flat=True))
+        self.assertEqual(columns["id"].tolist(), ids)
+        self.assertEqual(columns["answers"].shape, (150, len(manifest["answer_columns"])))
+        self.assertTrue((columns["leaf"] >= 0).all())
+
+        event = RecommendationEvent.objects.order_by("id")[140]
+        answered = {manifest["answer_columns"][i] for i in np.flatnonzero(columns["answers"][140])}
+        self.assertEqual(answered, {f"{key}={value}" for key, value in event.answers.items()})
+        self.assertEqual(manifest["dictionaries"]["goal"][columns["goal"][140]], event.goal)
+        self.assertEqual(int(columns["created_at"][140]), int(event.created_at.timestamp() * 1_000_000))
+
+        call_command("snapshot_events", str(directory), "--rebuild", stdout=io.StringIO())
+        self.assertEqual(snapshot.read_manifest(directory)["rows"], 150)
+        self.assertEqual(snapshot.load(directory, mmap=False)[0]["id"].tolist(), ids)
+
+
+class FunnelTests(TestCase):
+    def walk(self, choices, fragment=False):
+        headers = FRAGMENT if fragment else {}
+        self.client.get("/start/konven/")
+        self.client.get("/q/")
+        for choice in choices:
+            self.client.post("/q/", {"choice": choice}, **headers)
+            if not fragment:
+                self.client.get("/q/")
+
+    @override_settings(BTN_FUNNEL_FLUSH_SECONDS=3600)
+    def test_counts_are_buffered(self):
+        tree = get_tree()
+        with mock.patch.object(funnel, "_start"):  # no flusher thread: flushed below
+            self.walk([])                                    # left at the root
+            self.walk(["individual"])                        # left at the second question
+            self.client.post("/q/", {"choice": "bogus"})     # not a view
+        self.assertFalse(NodeCount.objects.exists())
+        self.assertGreater(funnel.flush(), 0)
+
+        rows = {row.key: row for row in funnel.funnel(tree, "konven")}
+        root = rows["q1"]
+        self.assertEqual((root.views, root.answered, root.dropped), (2, 1, 1))
+        second = rows["ind_q2_goal"]
+        self.assertEqual((second.views, second.dropped, second.reach), (1, 1, 0.5))
+
+    def test_full_run_and_page(self):
+        tree = get_tree()
+        self.walk(list(ANSWERS.values()), fragment=True)
+        leaf = tree.keys[tree.walk(ANSWERS_PATH)]
+        self.assertEqual(NodeCount.objects.get(node=leaf, choice="").count, 1)
+        for node, choice in ANSWERS.items():
+            self.assertEqual(NodeCount.objects.get(node=node, choice=choice).count, 1)
+            self.assertEqual(NodeCount.objects.get(node=node, choice="").count, 1)
+
+        login_staff(self.client)
+        self.assertContains(self.client.get("/analytics/funnel/", {"segment": "konven"}), leaf)
+        self.assertEqual(self.client.get("/analytics/funnel/", {"segment": "nope"}).status_code, 404)
+
+    @override_settings(BTN_STATELESS_WIZARD=True)
+    def test_stateless(self):
+        self.client.get("/start/konven/", follow=True)
+        self.assertEqual(NodeCount.objects.get(node="q1", choice="").count, 1)
+
+
+class TimeseriesTests(TestCase):
+    def setUp(self):
+        caches["timeseries"].clear()  # the history generation restarts with every test database
+        generate("--random", "400", "--seed", "9", "--start-days-ago", "400")
+        self.now = timezone.now()
+        self.start = self.now - timedelta(days=380)
+
+    def total(self) -> int:
+        return sum(n for _, n in timeseries.series("day", self.start, self.now, {}))
+
+    def test_series_equals_direct_counts(self):
+        since = timeseries._floor(self.start, "day")
+        series = timeseries.series("day", self.start, self.now, {})
+        self.assertEqual(len(series), (timezone.localdate(self.now) - timezone.localdate(self.start)).days + 1)
+        expected = Counter(
+            timezone.localdate(created_at)
+            for created_at in RecommendationEvent.objects.filter(created_at__gte=since).values_list("created_at", flat=True)
+        )
+        self.assertEqual({bucket.date(): n for bucket, n in series if n}, dict(expected))
+        property_series = timeseries.series("day", self.start, self.now, {"goal": "property"})
+        self.assertEqual(
+            sum(n for _, n in property_series),
+            RecommendationEvent.objects.filter(goal="property", created_at__gte=since).count(),
+        )
+        hours = timeseries.series("hour", self.now - timedelta(hours=48), self.now, {})
+        self.assertIn(len(hours), (48, 49))
+
+        with CaptureQueriesContext(connection) as queries:
+            timeseries.series("day", self.start, self.now, {})
+        self.assertLessEqual(len(queries), 2)  # the generation and the open bucket
+
+    def test_closing_a_bucket_counts_only_that_bucket(self):
+        now = timezone.localtime(self.now).replace(day=15, hour=12, minute=30, second=0, microsecond=0) - timedelta(days=31)
+        month = timeseries._month_start(now)
+        with mock.patch.object(timeseries, "_count", wraps=timeseries._count) as count:
+            first = timeseries.series("hour", month, now, {}, now=now)
+            later = now + timedelta(hours=1)
+            second = timeseries.series("hour", month, later, {}, now=later)
+        closed = [call.args[1:3] for call in count.call_args_list if call.args[2] != timeseries._next_month(month)]
+        self.assertEqual(closed, [(month, now.replace(minute=0)), (now.replace(minute=0), later.replace(minute=0))])
+        self.assertEqual(second[: len(first) - 1], first[:-1])
+
+    @override_settings(TIME_ZONE="Europe/Berlin")
+    def test_hours_across_dst_changes(self):
+        spring = timezone.make_aware(datetime(2026, 3, 29))
+        hours = [bucket.isoformat() for bucket, _ in timeseries.series("hour", spring, spring + timedelta(hours=4), {})]
+        self.assertEqual(hours, ["2026-03-29T00:00:00+01:00", "2026-03-29T01:00:00+01:00", "2026-03-29T03:00:00+02:00"])
+        autumn = timezone.make_aware(datetime(2026, 10, 25, 1))
+        hours = [bucket.isoformat() for bucket, _ in timeseries.series("hour", autumn, autumn + timedelta(hours=3), {})]
+        self.assertEqual(hours, ["2026-10-25T01:00:00+02:00", "2026-10-25T02:00:00+02:00", "2026-10-25T02:00:00+01:00",
+                                 "2026-10-25T03:00:00+01:00"])
+
+    def test_back_dated_changes_show_at_once(self):
+        total = self.total()
+        tree = get_tree()
+        event = build_event(tree, tree.walk(ANSWERS_PATH), "late", ANSWERS)
+        event.created_at = self.now - timedelta(days=200)
+        save_events([event])
+        self.assertEqual(self.total(), total + 1)
+        RecommendationEvent.objects.filter(pk=event.pk).delete()
+        self.assertEqual(self.total(), total)
+        RecommendationEvent.objects.filter(created_at__lt=self.now - timedelta(days=40)).first().delete()
+        self.assertEqual(self.total(), total - 1)
+
+    def test_dashboard(self):
+        login_staff(self.client)
+        charts = self.client.get("/analytics/data/").json()["charts"]
+        self.assertEqual(len(charts["per_day"]["values"]), dashboard.TREND_DAYS)
+        charts = self.client.get("/analytics/data/", {"from": "2020-01-01", "to": "2020-01-31"}).json()["charts"]
+        self.assertEqual(len(charts["per_day"]["values"]), 31)
+        self.assertEqual(len(charts["per_hour"]["values"]), dashboard.TREND_HOURS)
+
+
+class SessionSketchTests(TestCase):
+    def setUp(self):
+        cache.clear()  # the history generation restarts with every test database
+
+    def test_accuracy(self):
+        for n in (0, 1, 10, 1000, 50000):
+            registers = hll.empty()
+            for i in range(n):
+                hll.add(registers, f"s{i}")
+            self.assertLessEqual(abs(hll.estimate(registers) - n), max(1, 0.05 * n), n)
+        a, b = hll.empty(), hll.empty()
+        for i in range(3000):
+            hll.add(a, f"s{i}")
+        for i in range(2000, 6000):
+            hll.add(b, f"s{i}")
+        self.assertLess(abs(hll.estimate(hll.merge([a, b])) - 6000), 300)
+
+    def test_incremental_equals_rebuild(self):
+        generate("--random", "300", "--seed", "2", "--start-days-ago", "20")
+        exact = RecommendationEvent.objects.values("session_key").distinct().count()
+        self.assertLess(abs(sketches.unique_sessions() - exact), 0.05 * exact + 2)
+        live = stored_sketches()
+        sketches.rebuild()
+        self.assertEqual(stored_sketches(), live)
+
+        login_staff(self.client)
+        data = self.client.get("/analytics/data/", {"goal": "property"}).json()
+        self.assertEqual(data["kpis"]["unique_sessions"], sketches.unique_sessions(dimensions={"goal": "property"}))
+
+    def test_closed_days_are_cached(self):
+        generate("--random", "200", "--seed", "3", "--start-days-ago", "20")
+        first = sketches.unique_sessions()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(sketches.unique_sessions(), first)
+        self.assertEqual(len(queries), 2)  # the generation and today's sketches
+
+        tree = get_tree()
+        event = build_event(tree, tree.walk(ANSWERS_PATH), "late", ANSWERS)
+        event.created_at = timezone.now() - timedelta(days=5)
+        save_events([event])
+        self.assertGreater(sketches.unique_sessions(), first)
+
+
+class PathTrieTests(TestCase):
+    def test_incremental_equals_rebuild(self):
+        generate("--random", "300", "--seed", "3")
+        live = stored_prefixes()
+        self.assertTrue(live)
+        paths.rebuild()
+        self.assertEqual(stored_prefixes(), live)
+
+        tree = get_tree()
+        ends = Counter(
+            paths.prefix_key(paths.path_steps(tree, answers))
+            for answers in RecommendationEvent.objects.values_list("answers", flat=True)
+        )
+        top = paths.top_paths("konven", limit=1000)
+        self.assertEqual({paths.describe_path(tree, row)[1]: row.ends for row in top}, dict(ends))
+
+    def test_drill_down(self):
+        generate("--random", "300", "--seed", "3")
+        tree = get_tree()
+        root = paths.drill_down(tree, "konven")
+        self.assertEqual(root["total"], 300)
+        branch = root["branches"][0]
+        below = paths.drill_down(tree, "konven", branch.prefix)
+        self.assertEqual(below["total"], branch.count)
+        self.assertEqual(sum(b.count for b in below["branches"]) + below["ends"], branch.count)
+
+        login_staff(self.client)
+        self.assertContains(self.client.get("/analytics/paths/"), branch.label)
+        self.assertContains(self.client.get("/analytics/paths/", {"at": branch.prefix}), f"{branch.count} events reached")
+        self.assertEqual(self.client.get("/analytics/paths/", {"segment": "nope"}).status_code, 404)
+        self.assertEqual(self.client.get("/analytics/paths/", {"at": "garbage"}).status_code, 200)
+
+
+class ChoiceCountTests(TestCase):
+    def test_counts_equal_a_python_count(self):
+        generate("--random", "400", "--seed", "5")
+        for segment in registry().segments():
+            tree = get_tree(segment)
+            answers = list(RecommendationEvent.objects.filter(segment=segment).values_list("answers", flat=True))
+            for node, key in enumerate(tree.keys):
+                if tree.is_leaf[node]:
+                    continue
+                expected = Counter(a[key] for a in answers if isinstance(a, dict) and key in a)
+                got = choice_report.choice_counts(tree, key, dashboard.Filters(segment=segment))
+                self.assertEqual(got, dict(expected), (segment, key))
+
+    def test_queries_use_the_answer_indexes(self):
+        tree = get_tree()
+        for key, index in (("q1", "event_answer_q1_idx"), ("ind_loan_without_collateral_q4", "event_answer_ind_q2_idx")):
+            conditions = choice_report.branch_conditions(tree, key)
+            qs = RecommendationEvent.objects.filter(segment="konven")
+            for i, (node, choice) in enumerate(sorted(conditions.items())):
+                qs = qs.alias(**{f"branch_{i}": AnswerChoice(node)}).filter(**{f"branch_{i}": choice})
+            qs = qs.annotate(choice=AnswerChoice(key)).values("choice").annotate(n=Count("id")).order_by()
+            sql, params = qs.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+                self.assertIn(index, str(cursor.fetchall()), key)
+
+    def test_bad_node_keys(self):
+        with self.assertRaises(ValueError):
+            AnswerChoice("a'b")
+        login_staff(self.client)
+        self.assertContains(self.client.get("/analytics/choices/"), "answered")
+        self.assertEqual(self.client.get("/analytics/choices/", {"segment": "nope"}).status_code, 404)
+        self.assertEqual(self.client.get("/analytics/choices/", {"node": "zzz"}).status_code, 200)
+
+
+class AggregateRebuildTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        generate("--random", "300", "--seed", "6", "--start-days-ago", "10")
+
+    def stored(self):
+        return stored_rollups(), stored_sketches(), stored_prefixes()
+
+    def test_ranges_cover_every_event_once(self):
+        ids = list(RecommendationEvent.objects.order_by("id").values_list("id", flat=True))
+        ranges = aggregates.pk_ranges(7)
+        self.assertEqual([pk for lo, hi in ranges for pk in ids if lo <= pk < hi], ids)
+        RecommendationEvent.objects.all().delete()
+        self.assertEqual(aggregates.pk_ranges(), [])
+
+    def test_range_rebuild_equals_incremental(self):
+        live = self.stored()
+        before = generation.current()
+        stats = aggregates.rebuild_all(workers=1, range_size=37, chunk_size=11)
+        self.assertEqual(self.stored(), live)
+        self.assertEqual((stats.events, stats.ranges), (300, len(aggregates.pk_ranges(37))))
+        self.assertGreater(generation.current(), before)
+
+    def test_events_saved_while_counting_are_kept(self):
+        def progress(done, ranges, part):
+            if done == 1:
+                generate("--random", "20", "--seed", "7")
+
+        stats = aggregates.rebuild_all(workers=1, range_size=37, progress=progress)
+        self.assertEqual(stats.events, 320)
+        live = self.stored()
+        aggregates.rebuild_all()
+        self.assertEqual(self.stored(), live)
+
+    def test_worker_pool(self):
+        expected = aggregates.merge(aggregates.count_range(lo, hi) for lo, hi in aggregates.pk_ranges(37))
+        for part in (expected, aggregates.count_range(0, None)):  # sent back from spawned workers
+            self.assertEqual(pickle.loads(pickle.dumps(part)), part)
+        live = self.stored()
+        pools = []
+
+        class InlinePool:
+            """ProcessPoolExecutor running submissions here: spawned workers would not see the test database."""
+
+            def __init__(self, **kwargs):
+                pools.append(kwargs)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def submit(self, fn, *args):
+                future = Future()
+                future.set_result(fn(*args))
+                return future
+
+        done = []
+        with mock.patch.object(aggregates, "ProcessPoolExecutor", InlinePool):
+            stats = aggregates.rebuild_all(workers=3, range_size=37, progress=lambda *args: done.append(args[:2]))
+        self.assertEqual(self.stored(), live)
+        self.assertEqual(stats.events, expected.events)
+        [pool] = pools
+        self.assertEqual(pool["max_workers"], 3)
+        self.assertEqual(pool["mp_context"].get_start_method(), "spawn")
+        self.assertEqual(done, [(n, stats.ranges) for n in range(1, stats.ranges + 1)])
+
+    def test_command_checks_sizes(self):
+        with self.assertRaises(CommandError):
+            call_command("rebuild_rollups", "--range-size", "0", stdout=io.StringIO())
+
+
+class GeneratorTests(TestCase):
+    def test_batches_insert_every_event(self):
+        out = io.StringIO()
+        call_command("generate_recommendation_results", "--random", "250", "--seed", "8", "--batch-size", "40", stdout=out)
+        self.assertIn("Events created: 250", out.getvalue())
+        self.assertIn("events/sec", out.getvalue())
+        self.assertEqual(RecommendationEvent.objects.count(), 250)
+        self.assertEqual(sum(rollups.totals("goal").values()), 250)
+        self.assertEqual(PathPrefix.objects.filter(parent="").aggregate(n=Sum("count"))["n"], 250)
+
+    def test_seed_is_reproducible(self):
+        generate("--random", "50", "--seed", "1", "--batch-size", "7")
+        first = list(RecommendationEvent.objects.order_by("id").values_list("answers", flat=True))
+        generate("--delete-generated", "--random", "50", "--seed", "1")
+        self.assertEqual(list(RecommendationEvent.objects.order_by("id").values_list("answers", flat=True)), first)
+
+    def test_delete_generated_rebuilds_aggregates(self):
+        generate("--random", "40", "--seed", "2")
+        before = generation.current()
+        with mock.patch.object(aggregates, "_count_all", wraps=aggregates._count_all) as count_all:
+            generate("--delete-generated", "--random", "10", "--seed", "3")
+        count_all.assert_called_once()
+        self.assertGreater(generation.current(), before)
+        self.assertEqual(sum(rollups.totals("goal").values()), 10)
+        live = stored_rollups(), stored_sketches(), stored_prefixes()
+        aggregates.rebuild_all()
+        self.assertEqual((stored_rollups(), stored_sketches(), stored_prefixes()), live)
+
+    def test_dedupe(self):
+        generate("--dedupe", "--batch-size", "9")
+        count = RecommendationEvent.objects.count()
+        self.assertEqual(count, len(get_tree().paths))
+        generate("--dedupe")
+        self.assertEqual(RecommendationEvent.objects.count(), count)
+        generate("--dry-run", "--random", "20")
+        self.assertEqual(RecommendationEvent.objects.count(), count)
@@ -0,0 +1,157 @@
+"""
+Events per hour / per day for the dashboard's trend charts.
+
+Bucketing happens in SQL (TruncHour / TruncDay in TIME_ZONE, GROUP BY over
+the created_at indexes). Results are cached per calendar month ("block") in
+the "timeseries" cache alias:
+
+- a month that is over is cached without expiry, so a long range costs one
+  cache read per month;
+- for the current month, the closed buckets so far are cached with the
+  time they run to; when more buckets have closed, only those are counted
+  and added to the entry. The open bucket (from the last closed one to
+  now) is counted on every request.
+
+A bucket is closed CLOSE_GRACE after its end, which leaves time for
+write-behind events (BTN_EVENT_WRITE_BEHIND) to land in it. Cache keys
+include the history generation (generation.py), which changes when events
+are inserted with an older created_at or deleted, so every process recounts
+after such changes.
+"""
+from __future__ import annotations
+
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from django.core.cache import caches
+from django.db.models import Count
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from . import generation
+from .models import RecommendationEvent
+
+TIMESERIES_CACHE = "timeseries"
+
+GRANULARITIES = {
+    "hour": (TruncHour, timedelta(hours=1)),
+    "day": (TruncDay, timedelta(days=1)),
+}
+CLOSE_GRACE = generation.CLOSE_GRACE
+
+Series = List[Tuple[datetime, int]]
+
+
+def _floor(moment: datetime, granularity: str) -> datetime:
+    """Start of the bucket (in local time) moment falls in."""
+    local = timezone.localtime(moment)
+    if granularity == "hour":
+        return local.replace(minute=0, second=0, microsecond=0)
+    return _day_start(local.date())
+
+
+def _day_start(day: date) -> datetime:
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _month_start(moment: datetime) -> datetime:
+    return _day_start(timezone.localtime(moment).date().replace(day=1))
+
+
+def _next_month(month: datetime) -> datetime:
+    day = timezone.localtime(month).date()
+    return _day_start(date(day.year + day.month // 12, day.month % 12 + 1, 1))
+
+
+def _buckets(granularity: str, start: datetime, end: datetime) -> List[datetime]:
+    """Bucket starts in [start, end); start is a bucket start."""
+    out = []
+    if granularity == "hour":
+        # step in UTC: local wall-clock hours skip or repeat at DST changes
+        step = GRANULARITIES["hour"][1]
+        moment = start.astimezone(dt_timezone.utc)
+        while moment < end:
+            out.append(timezone.localtime(moment))
+            moment += step
+    else:
+        day = timezone.localtime(start).date()
+        while _day_start(day) < end:
+            out.append(_day_start(day))
+            day += timedelta(days=1)
+    return out
+
+
+def _count(granularity: str, start: datetime, end: datetime, dims: Mapping[str, str]) -> Dict[str, int]:
+    """{bucket start (ISO): events} for [start, end), one GROUP BY query."""
+    trunc = GRANULARITIES[granularity][0]
+    rows = (
+        RecommendationEvent.objects.filter(created_at__gte=start, created_at__lt=end, **dims)
+        .annotate(bucket=trunc("created_at", tzinfo=timezone.get_current_timezone()))
+        .order_by()
+        .values_list("bucket")
+        .annotate(n=Count("id"))
+    )
+    return {timezone.localtime(bucket).isoformat(): n for bucket, n in rows}
+
+
+def _key(granularity: str, month: datetime, dims: Mapping[str, str], version: int, suffix: str = "") -> str:
+    dim_part = ",".join(f"{name}={value}" for name, value in sorted(dims.items()))
+    return f"ts:{version}:{granularity}:{timezone.get_current_timezone_name()}:{month.date().isoformat()}:{dim_part}:{suffix}"
+
+
+def _month_counts(
+    granularity: str, month: datetime, dims: Mapping[str, str], now: datetime, version: int,
+) -> Dict[str, int]:
+    cache = caches[TIMESERIES_CACHE]
+    month_end = _next_month(month)
+    closed_until = _floor(now - CLOSE_GRACE, granularity)
+
+    if month_end <= closed_until:
+        key = _key(granularity, month, dims, version)
+        counts = cache.get(key)
+        if counts is None:
+            counts = _count(granularity, month, month_end, dims)
+            cache.set(key, counts, None)
+        return counts
+
+    if month >= now:
+        return {}
+    # current month: (closed until, counts) of its closed buckets, extended
+    # by the buckets closed since
+    counts: Dict[str, int] = {}
+    if closed_until > month:
+        key = _key(granularity, month, dims, version, "closed")
+        cached = cache.get(key)
+        until, counts = cached if cached is not None and cached[0] <= closed_until else (month, {})
+        if until < closed_until:
+            counts = {**counts, **_count(granularity, until, closed_until, dims)}
+            # past month_end + CLOSE_GRACE the month is read from its final entry
+            cache.set(key, (closed_until, counts), int((month_end + CLOSE_GRACE - now).total_seconds()) + 1)
+        counts = dict(counts)
+    counts.update(_count(granularity, max(month, closed_until), month_end, dims))
+    return counts
+
+
+def series(
+    granularity: str,
+    start: datetime,
+    end: datetime,
+    dims: Optional[Mapping[str, str]] = None,
+    now: Optional[datetime] = None,
+) -> Series:
+    """
+    [(bucket start, events), ...] for every hour/day bucket overlapping
+    [start, end), including empty ones; dims filters on segment,
+    customer_type and goal (dashboard.Filters.dimensions()).
+    """
+    dims = dims or {}
+    now = now or timezone.now()
+    start = _floor(start, granularity)
+    version = generation.current()
+    counts: Dict[str, int] = {}
+    month = _month_start(start)
+    while month < end:
+        counts.update(_month_counts(granularity, month, dims, now, version))
+        month = _next_month(month)
+    return [(bucket, counts.get(bucket.isoformat(), 0)) for bucket in _buckets(granularity, start, end)]
+
@@ -0,0 +1,282 @@
+"""
+Compiled, read-only form of a decision TREE.
+
+The TREE literals (see tree_konven.py) are nice to author but slow to walk:
+every wizard step does nested dict lookups, rebuilds the (key, label) choice
+list and re-merges meta. compile_tree() flattens a TREE once into parallel
+tuples indexed by an integer node id:
+
+- keys[i]        node id string ("q1", "leaf_kpr_btn_platinum", ...)
+- texts[i]       question text ("" for leaves)
+- is_leaf[i]     True for leaf nodes
+- choices[i]     ((choice_key, label), ...) ready to hand to the template
+- next_ids[i]    (node id, ...) aligned with choices[i]; -1 = missing node
+- choice_pos[i]  {choice_key: position in choices[i]}
+- meta[i]        cumulative meta from the root down to this node (read-only)
+- products[i] / links[i]  leaf payload
+
+Every root-to-leaf path is also enumerated once and given a path id:
+
+- paths[p]       choice positions from the root
+- path_leaf[p]   leaf node id the path ends on
+- answer_index   {frozenset of (node_id, choice_key): p}, so a stored answers
+                 dict resolves to its leaf with a single hash lookup
+- position_index {paths[p]: p}
+
+version identifies the tree revision (a short content hash of the source
+TREE unless the caller names it), so anything derived from a compiled tree
+(ETags, caches, logged events) can tell revisions apart.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+from collections import deque
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, Mapping, Optional, Sequence, Tuple
+
+ROOT_NODE = "q1"
+
+
+def merge_meta(current: Mapping[str, Any], incoming: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    Merge meta dicts. Later nodes can override earlier ones (e.g. goal changes by branch).
+    """
+    merged = dict(current or {})
+    for k, v in (incoming or {}).items():
+        if v is None:
+            continue
+        if isinstance(v, str) and v.strip() == "":
+            continue
+        merged[k] = v
+    return merged
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledTree:
+    version: str
+    root: int
+    keys: Tuple[str, ...]
+    index: Mapping[str, int]
+    texts: Tuple[str, ...]
+    is_leaf: Tuple[bool, ...]
+    choices: Tuple[Tuple[Tuple[str, str], ...], ...]
+    next_ids: Tuple[Tuple[int, ...], ...]
+    choice_pos: Tuple[Mapping[str, int], ...]
+    meta: Tuple[Mapping[str, Any], ...]
+    products: Tuple[Tuple[str, ...], ...]
+    links: Tuple[Tuple[str, ...], ...]
+    paths: Tuple[Tuple[int, ...], ...]
+    path_leaf: Tuple[int, ...]
+    answer_index: Mapping[FrozenSet[Tuple[str, str]], int]
+    position_index: Mapping[Tuple[int, ...], int]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def node_id(self, key: str) -> int:
+        """Integer id for a node key, or -1 if the tree has no such node."""
+        return self.index.get(key, -1)
+
+    def choice_index(self, node: int, choice_key: str) -> int:
+        """Position of choice_key among node's choices, or -1 if invalid."""
+        return self.choice_pos[node].get(choice_key, -1)
+
+    def walk(self, path: Sequence[int]) -> int:
+        """Follow choice positions from the root; -1 if the path leaves the tree."""
+        node = self.root
+        for pos in path:
+            if node < 0 or not 0 <= pos < len(self.next_ids[node]):
+                return -1
+            node = self.next_ids[node][pos]
+        return node
+
+    def answers_for(self, path: Sequence[int]) -> Dict[str, str]:
+        """The {node_id: choice_key} dict stored on events for a (valid) path."""
+        answers = {}
+        node = self.root
+        for pos in path:
+            answers[self.keys[node]] = self.choices[node][pos][0]
+            node = self.next_ids[node][pos]
+        return answers
+
+    def resolve(self, answers: Mapping[str, str]) -> int:
+        """
+        Path id for a complete {node_id: choice_key} dict, or -1 if it does
+        not describe exactly one root-to-leaf path of this tree.
+        """
+        try:
+            return self.answer_index.get(frozenset(answers.items()), -1)
+        except (AttributeError, TypeError):  # not a dict / unhashable values
+            return -1
+
+    def resolve_path(self, path: Any) -> int:
+        """Path id for a list/tuple of choice positions, or -1."""
+        if not isinstance(path, (list, tuple)) or not all(type(p) is int for p in path):
+            return -1
+        return self.position_index.get(tuple(path), -1)
+
+    def path_for_answers(self, answers: Mapping[str, str]) -> Optional[Tuple[int, ...]]:
+        """Choice positions for a complete answers dict, or None."""
+        path_id = self.resolve(answers)
+        return self.paths[path_id] if path_id >= 0 else None
+
+    def to_state(self) -> Dict[str, Any]:
+        """Plain dicts/tuples only, so the table can be marshal-ed to disk."""
+        return {
+            "version": self.version,
+            "root": self.root,
+            "keys": self.keys,
+            "index": dict(self.index),
+            "texts": self.texts,
+            "is_leaf": self.is_leaf,
+            "choices": self.choices,
+            "next_ids": self.next_ids,
+            "choice_pos": tuple(dict(m) for m in self.choice_pos),
+            "meta": tuple(dict(m) for m in self.meta),
+            "products": self.products,
+            "links": self.links,
+            "paths": self.paths,
+            "path_leaf": self.path_leaf,
+            "answer_index": dict(self.answer_index),
+            "position_index": dict(self.position_index),
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "CompiledTree":
+        return cls(
+            version=state["version"],
+            root=state["root"],
+            keys=state["keys"],
+            index=MappingProxyType(state["index"]),
+            texts=state["texts"],
+            is_leaf=state["is_leaf"],
+            choices=state["choices"],
+            next_ids=state["next_ids"],
+            choice_pos=tuple(MappingProxyType(m) for m in state["choice_pos"]),
+            meta=tuple(MappingProxyType(m) for m in state["meta"]),
+            products=state["products"],
+            links=state["links"],
+            paths=state["paths"],
+            path_leaf=state["path_leaf"],
+            answer_index=MappingProxyType(state["answer_index"]),
+            position_index=MappingProxyType(state["position_index"]),
+        )
+
+
+def tree_version(tree: Dict[str, Dict[str, Any]]) -> str:
+    raw = json.dumps(tree, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def compile_tree(
+    tree: Dict[str, Dict[str, Any]],
+    root: str = ROOT_NODE,
+    version: Optional[str] = None,
+) -> CompiledTree:
+    """
+    Flatten a TREE dict into a CompiledTree.
+
+    Meta is accumulated breadth-first from the root. A node reachable through
+    several parents must end up with the same meta on every path, otherwise its
+    cumulative meta would be ambiguous and we refuse to compile.
+    Nodes not reachable from the root only carry their own meta.
+    """
+    if root not in tree:
+        raise ValueError(f"Root node '{root}' not found in TREE")
+
+    keys = tuple(tree)
+    index = {key: i for i, key in enumerate(keys)}
+
+    texts = []
+    is_leaf = []
+    choices = []
+    next_ids = []
+    choice_pos = []
+    products = []
+    links = []
+    for key in keys:
+        node = tree[key]
+        leaf = node.get("leaf") is True
+        node_choices = node.get("choices", {}) if not leaf else {}
+        if not isinstance(node_choices, dict):
+            node_choices = {}
+
+        is_leaf.append(leaf)
+        texts.append(node.get("text", ""))
+        choices.append(tuple((k, v.get("label", k)) for k, v in node_choices.items()))
+        next_ids.append(tuple(index.get(v.get("next") or "", -1) for v in node_choices.values()))
+        choice_pos.append(MappingProxyType({k: i for i, k in enumerate(node_choices)}))
+        products.append(tuple(node.get("products", [])) if leaf else ())
+        links.append(tuple(node.get("links", [])) if leaf else ())
+
+    meta: list = [None] * len(keys)
+    root_id = index[root]
+    meta[root_id] = merge_meta({}, tree[root].get("meta", {}))
+    queue = deque([root_id])
+    while queue:
+        parent = queue.popleft()
+        for child in next_ids[parent]:
+            if child < 0:
+                continue
+            child_meta = merge_meta(meta[parent], tree[keys[child]].get("meta", {}))
+            if meta[child] is None:
+                meta[child] = child_meta
+                queue.append(child)
+            elif meta[child] != child_meta:
+                raise ValueError(
+                    f"Node '{keys[child]}' is reachable with conflicting meta: "
+                    f"{meta[child]!r} vs {child_meta!r}"
+                )
+
+    for i, key in enumerate(keys):
+        if meta[i] is None:
+            meta[i] = merge_meta({}, tree[key].get("meta", {}))
+
+    paths, path_leaf, answer_index = _enumerate_paths(root_id, keys, is_leaf, choices, next_ids)
+
+    return CompiledTree(
+        version=version or tree_version(tree),
+        root=root_id,
+        keys=keys,
+        index=MappingProxyType(index),
+        texts=tuple(texts),
+        is_leaf=tuple(is_leaf),
+        choices=tuple(choices),
+        next_ids=tuple(next_ids),
+        choice_pos=tuple(choice_pos),
+        meta=tuple(MappingProxyType(m) for m in meta),
+        products=tuple(products),
+        links=tuple(links),
+        paths=paths,
+        path_leaf=path_leaf,
+        answer_index=MappingProxyType(answer_index),
+        position_index=MappingProxyType({path: p for p, path in enumerate(paths)}),
+    )
+
+
+def _enumerate_paths(root, keys, is_leaf, choices, next_ids):
+    """
+    Depth-first walk of every root-to-leaf path. A choice leading back to a
+    node already on the current path (a cycle) is not followed.
+    """
+    paths = []
+    path_leaf = []
+    answer_index = {}
+
+    stack = [(root, (), ())]
+    while stack:
+        node, path, visited = stack.pop()
+        if is_leaf[node]:
+            answer_index[frozenset((keys[n], choices[n][pos][0]) for n, pos in zip(visited, path))] = len(paths)
+            paths.append(path)
+            path_leaf.append(node)
+            continue
+        visited += (node,)
+        for pos in reversed(range(len(choices[node]))):
+            child = next_ids[node][pos]
+            if child >= 0 and child not in visited:
+                stack.append((child, path + (pos,), visited))
+
+    return tuple(paths), tuple(path_leaf), answer_index
@@ -0,0 +1,258 @@
+"""
+Versioned tree definitions loaded from data files, reloaded without a restart.
+
+A tree file is JSON:
+
+    {"version": "2026-10-17.1", "root": "q1", "tree": {<same schema as TREE>}}
+
+("version" and "root" are optional; the version defaults to a content hash).
+The first worker that sees a new file compiles it and writes the compiled
+table next to the other cached versions in BTN_TREE_CACHE_DIR as a marshal
+file. Every other worker unmarshals that file (a startup cache: each process
+still builds its own copy of the table) instead of parsing and compiling the
+JSON again.
+
+Workers stat the tree file at most every BTN_TREE_CHECK_SECONDS. When its
+mtime/size change, the new tree is loaded and swapped in with a single
+reference assignment: a request that already fetched the old tree keeps
+using it until it finishes. Publish new versions by writing a temp file and
+renaming it over the old one, so a reader never sees a half-written file.
+If a file fails to load, the previous tree stays active.
+
+Trees are looked up by segment through TreeRegistry (see BTN_TREES); without
+a tree file the built-in tree_konven.TREE serves the "konven" segment.
+"""
+from __future__ import annotations
+
+import hashlib
+import importlib
+import json
+import logging
+import marshal
+import os
+import re
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .tree_engine import ROOT_NODE, CompiledTree, compile_tree
+
+logger = logging.getLogger(__name__)
+
+# Bump when CompiledTree's fields change, so stale cache files are ignored.
+CACHE_FORMAT = 1
+
+# RecommendationEvent.tree_version column size
+MAX_VERSION_LENGTH = 64
+
+DEFAULT_SEGMENT = "konven"
+DEFAULT_SOURCE = "recommender.tree_konven:TREE"
+
+# Segments travel in URLs and path tokens (which use "." as separator).
+SEGMENT_RE = re.compile(r"^[-a-zA-Z0-9_]+$")
+
+
+def _cache_name(source: bytes) -> str:
+    digest = hashlib.sha256(source).hexdigest()[:24]
+    return f"tree-{digest}-f{CACHE_FORMAT}-m{marshal.version}.bin"
+
+
+def _read_cache(path: Path) -> Optional[CompiledTree]:
+    try:
+        with open(path, "rb") as fh:
+            return CompiledTree.from_state(marshal.load(fh))
+    except (OSError, ValueError, EOFError, TypeError, KeyError):
+        return None
+
+
+def _write_cache(path: Path, tree: CompiledTree) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tree-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            marshal.dump(tree.to_state(), fh)
+        os.replace(tmp, path)
+    except OSError:
+        logger.warning("Could not write compiled tree cache %s", path, exc_info=True)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def load_tree_file(path: Path, cache_dir: Optional[Path] = None) -> CompiledTree:
+    """
+    Compiled tree for a JSON tree file, going through the binary cache when
+    cache_dir is given. Raises ValueError for unreadable definitions.
+    """
+    source = path.read_bytes()
+    cache_path = cache_dir / _cache_name(source) if cache_dir else None
+    if cache_path is not None and cache_path.exists():
+        tree = _read_cache(cache_path)
+        if tree is not None:
+            return tree
+
+    doc = json.loads(source)
+    if not isinstance(doc, dict) or not isinstance(doc.get("tree"), dict):
+        raise ValueError(f"{path}: expected an object with a 'tree' mapping")
+    version = str(doc["version"]) if doc.get("version") else None
+    if version is not None and len(version) > MAX_VERSION_LENGTH:
+        raise ValueError(f"{path}: version must be at most {MAX_VERSION_LENGTH} characters")
+    try:
+        tree = compile_tree(doc["tree"], root=doc.get("root") or ROOT_NODE, version=version)
+    except (AttributeError, TypeError) as exc:
+        raise ValueError(f"{path}: malformed tree definition ({exc})") from exc
+
+    if cache_path is not None:
+        _write_cache(cache_path, tree)
+    return tree
+
+
+class TreeStore:
+    """Current compiled tree for one tree file, reloaded when the file changes."""
+
+    def __init__(self, path: Path, cache_dir: Optional[Path] = None, check_seconds: float = 2.0):
+        self.path = Path(path)
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._tree: Optional[CompiledTree] = None
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._checked_at = 0.0
+
+    def _stat(self) -> Tuple[int, int]:
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size
+
+    def get(self) -> CompiledTree:
+        now = time.monotonic()
+        if self._tree is None or now - self._checked_at >= self.check_seconds:
+            self._refresh(now)
+        return self._tree
+
+    def _refresh(self, now: float) -> None:
+        with self._lock:
+            if self._tree is not None and now - self._checked_at < self.check_seconds:
+                return  # another thread just checked
+            self._checked_at = now
+            try:
+                stamp = self._stat()
+                if stamp == self._stamp and self._tree is not None:
+                    return
+                tree = load_tree_file(self.path, self.cache_dir)
+            except (OSError, ValueError) as exc:
+                if self._tree is None:
+                    raise
+                logger.error("Keeping tree %s: reloading %s failed: %s", self._tree.version, self.path, exc)
+                return
+
+            if self._tree is not None and tree.version != self._tree.version:
+                logger.info("Tree reloaded from %s: %s -> %s", self.path, self._tree.version, tree.version)
+            self._tree = tree
+            self._stamp = stamp
+
+
+class ModuleTree:
+    """A TREE dict defined in Python ("package.module:NAME"), compiled on first use."""
+
+    def __init__(self, source: str):
+        self.source = source
+        self._lock = threading.Lock()
+        self._tree: Optional[CompiledTree] = None
+
+    def get(self) -> CompiledTree:
+        if self._tree is None:
+            with self._lock:
+                if self._tree is None:
+                    module_name, _, attr = self.source.partition(":")
+                    tree = getattr(importlib.import_module(module_name), attr or "TREE")
+                    self._tree = compile_tree(tree)
+        return self._tree
+
+
+class UnknownSegment(LookupError):
+    pass
+
+
+class TreeRegistry:
+    """
+    Trees keyed by segment ("konven", "syariah", ...), each loaded on first
+    use. A source ending in .json is a hot-reloaded tree file (TreeStore);
+    anything else is a "module:NAME" Python TREE (ModuleTree).
+
+    Only trees that are actually requested cost compile time and memory.
+    Segments listed in BTN_PRELOAD_SEGMENTS are loaded in AppConfig.ready();
+    under gunicorn's preload_app that happens once in the master, and the
+    forked workers share those pages instead of compiling their own copies.
+    """
+
+    def __init__(self, sources: Dict[str, str], cache_dir: Optional[Path] = None, check_seconds: float = 2.0):
+        for segment in sources:
+            if not SEGMENT_RE.match(segment):
+                raise ImproperlyConfigured(f"BTN_TREES: invalid segment name '{segment}'")
+        self.sources = dict(sources)
+        self.cache_dir = cache_dir
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._loaders: Dict[str, object] = {}
+
+    def segments(self) -> List[str]:
+        return list(self.sources)
+
+    def _loader(self, segment: str):
+        loader = self._loaders.get(segment)
+        if loader is None:
+            if segment not in self.sources:
+                raise UnknownSegment(segment)
+            with self._lock:
+                loader = self._loaders.get(segment)
+                if loader is None:
+                    source = self.sources[segment]
+                    if source.endswith(".json"):
+                        loader = TreeStore(Path(source), cache_dir=self.cache_dir, check_seconds=self.check_seconds)
+                    else:
+                        loader = ModuleTree(source)
+                    self._loaders[segment] = loader
+        return loader
+
+    def get(self, segment: str) -> CompiledTree:
+        return self._loader(segment).get()
+
+    def preload(self, segments: Iterable[str]) -> None:
+        for segment in segments:
+            self.get(segment)
+
+
+_registry: Optional[TreeRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def registry() -> TreeRegistry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = TreeRegistry(
+                    getattr(settings, "BTN_TREES", {DEFAULT_SEGMENT: DEFAULT_SOURCE}),
+                    cache_dir=getattr(settings, "BTN_TREE_CACHE_DIR", None),
+                    check_seconds=getattr(settings, "BTN_TREE_CHECK_SECONDS", 2.0),
+                )
+    return _registry
+
+
+def default_segment() -> str:
+    return getattr(settings, "BTN_DEFAULT_SEGMENT", DEFAULT_SEGMENT)
+
+
+def get_tree(segment: Optional[str] = None) -> CompiledTree:
+    """
+    The tree requests should run on for segment (default: BTN_DEFAULT_SEGMENT).
+    Fetch it once per request/job and pass it along, so a reload in the middle
+    cannot mix two versions. Raises UnknownSegment for unconfigured segments.
+    """
+    return registry().get(segment or default_segment())
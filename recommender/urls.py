@@ -1,16 +1,27 @@
 from django.urls import path
-from . import views
+from . import api, views
 from django.contrib.auth import views as auth_views
 
 app_name = "recommender"
 
 urlpatterns = [
     path("", views.start_questionnaire, name="start"),
+    path("start/<slug:segment>/", views.start_questionnaire, name="start_segment"),
     path("q/", views.question, name="question"),
-    path("result/<int:event_id>/", views.result, name="result"),
+    path("result/<uuid:public_id>/", views.result, name="result"),
+    path("result/<int:event_id>/", views.result_by_id, name="result_by_id"),
     path("analytics/", views.analytics, name="analytics"),
+    path("analytics/data/", views.analytics_data, name="analytics_data"),
+    path("analytics/paths/", views.analytics_paths, name="analytics_paths"),
+    path("analytics/choices/", views.analytics_choices, name="analytics_choices"),
+    path("analytics/funnel/", views.analytics_funnel, name="analytics_funnel"),
+    path("analytics/export/", views.analytics_export, name="analytics_export"),
     path("analytics/<int:event_id>/", views.analytics_detail, name="analytics_detail"),
+    path("analytics/chart/<slug:name>/<slug:fingerprint>.png", views.analytics_chart, name="analytics_chart"),
     path("restart/", views.restart, name="restart"),
     path("login/", views.login_view, name="login"),
     path("logout/", views.logout_view, name="logout"),
+    path("api/tree/", api.tree_view, name="api_tree"),
+    path("api/recommend/", api.recommend_view, name="api_recommend"),
+    path("api/batch/", api.batch_view, name="api_batch"),
 ]
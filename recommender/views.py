@@ -1,29 +1,50 @@
 from __future__ import annotations
 
-import base64
-import io
-
-from typing import Any, Dict
-
-from collections import Counter
-
-import matplotlib
-matplotlib.use("Agg")  # server-safe backend
-import matplotlib.pyplot as plt
-
-from django.http import Http404, HttpResponseForbidden
+import hashlib
+import json
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, StreamingHttpResponse
+from django.middleware.csrf import get_token
 from django.shortcuts import redirect, render
+from django.template.loader import render_to_string
 from django.contrib.auth import authenticate, login as dj_login, logout as dj_logout
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.urls import reverse
+from django.utils import timezone, translation
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
 
+from . import charts, choice_report, dashboard, export, funnel, paths, rollups, sketches
+from .events import WAIT_PARAM, find_event, log_event, may_wait, result_url, result_wait_seconds
 from .models import RecommendationEvent
-from .tree_konven import TREE
+from .pagination import keyset_page
+from .products import attach_product_names, products_with_links
+from .path_token import issue_token, new_run_id, read_token
+from .tree_engine import CompiledTree
+from .tree_store import UnknownSegment, default_segment, get_tree, registry
 
 SESSION_ANSWERS_KEY = "btn_answers"          # Dict[node_id -> choice_key]
 SESSION_NODE_KEY = "btn_node"               # current node id
-SESSION_META_KEY = "btn_meta"               # accumulated meta: segment/customer_type/goal/etc
-SESSION_LAST_EVENT_ID = "btn_last_event_id" # prevent duplicate logging on refresh
+SESSION_LAST_EVENT_ID = "btn_last_event_id" # public_id logged for this run (refresh => no re-log)
+SESSION_RUN_ID = "btn_run_id"               # new per run; part of the logged event's public_id
+SESSION_SEGMENT = "btn_segment"             # which tree (konven/syariah/...) the run is on
+SESSION_TREE_VERSION = "btn_tree_version"   # tree version the run started on
+STATELESS_SESSION_PREFIX = "t:"             # session_key of events logged in token mode
+
+MAX_ANALYTICS_PAGE_SIZE = 500
+
+TREND_TITLES = {"per_day": "Events per day", "per_hour": "Events per hour"}
+
+FRAGMENT_HEADER = "X-BTN-Fragment"          # request: "1" => answer with the card only
+LOCATION_HEADER = "X-BTN-Location"          # response: URL the card belongs to
+
+# Cached question pages are rendered with these stand-ins for per-user values
+QUESTION_CACHE_PREFIX = "btn:question"
+CSRF_PLACEHOLDER = "__btn_csrf_token__"
+TOKEN_PLACEHOLDER = "__btn_path_token__"
 
 def _is_admin(user):
     return user.is_authenticated and (user.is_staff or user.is_superuser)
@@ -85,258 +106,534 @@ def _ensure_session(request) -> None:
     if not request.session.session_key:
         request.session.create()
 
-def _reset_flow(request) -> None:
+def _reset_flow(request, segment: str, tree: CompiledTree) -> None:
     request.session[SESSION_ANSWERS_KEY] = {}
-    request.session[SESSION_NODE_KEY] = "q1"
-    request.session[SESSION_META_KEY] = {}
+    request.session[SESSION_NODE_KEY] = tree.keys[tree.root]
+    request.session[SESSION_SEGMENT] = segment
+    request.session[SESSION_TREE_VERSION] = tree.version
+    request.session[SESSION_RUN_ID] = new_run_id()
     request.session.pop(SESSION_LAST_EVENT_ID, None)
     request.session.modified = True
 
-def _merge_meta(current: Dict[str, Any], incoming: Dict[str, Any]) -> Dict[str, Any]:
+def _stateless() -> bool:
+    return getattr(settings, "BTN_STATELESS_WIZARD", False)
+
+def _wants_fragment(request) -> bool:
+    """True when the page script asked for just the card (see question.html)."""
+    return request.headers.get(FRAGMENT_HEADER) == "1"
+
+def _question_url(token: str = "") -> str:
+    url = reverse("recommender:question")
+    return f"{url}?{urlencode({'t': token})}" if token else url
+
+def _question_response(request, segment: str, tree: CompiledTree, node: int, token: str = "", error: str = ""):
+    """
+    Render a question node: the full page for normal requests, only the card
+    for fragment requests. X-BTN-Location tells the script which URL to put in
+    the address bar so a refresh GETs the same step.
+
+    The markup only depends on (segment, tree version, node, locale, error,
+    fragment, token mode), so it is rendered once with placeholders and cached;
+    the per-user CSRF and path tokens are substituted into the cached copy.
+    """
+    if not error:
+        funnel.record(segment, tree.keys[node])
+
+    fragment = _wants_fragment(request)
+    cache_key = ":".join((
+        QUESTION_CACHE_PREFIX, segment, tree.version, str(node),
+        translation.get_language() or "", "e" if error else "-", "f" if fragment else "p", "t" if token else "-",
+    ))
+    html = cache.get(cache_key)
+    if html is None:
+        context = {
+            "node_id": tree.keys[node],
+            "question": tree.texts[node],
+            "choices": tree.choices[node],
+            "token": TOKEN_PLACEHOLDER if token else "",
+            "csrf_token": CSRF_PLACEHOLDER,
+        }
+        if error:
+            context["error"] = error
+        template = "recommender/_question_card.html" if fragment else "recommender/question.html"
+        html = render_to_string(template, context)
+        cache.set(cache_key, html, getattr(settings, "BTN_QUESTION_CACHE_SECONDS", None))
+
+    html = html.replace(CSRF_PLACEHOLDER, get_token(request))
+    if token:
+        html = html.replace(TOKEN_PLACEHOLDER, token)
+
+    response = HttpResponse(html)
+    if fragment:
+        response[LOCATION_HEADER] = _question_url(token)
+    patch_vary_headers(response, (FRAGMENT_HEADER,))
+    return response
+
+def _leaf_response(request, public_id: str):
     """
-    Merge meta dicts. Later nodes can override earlier ones (e.g. goal changes by branch).
+    Redirect to the result page, or (fragment requests) render the result card
+    straight away and point the address bar at the result URL.
     """
-    merged = dict(current or {})
-    for k, v in (incoming or {}).items():
-        if v is None:
-            continue
-        if isinstance(v, str) and v.strip() == "":
-            continue
-        merged[k] = v
-    return merged
+    if not _wants_fragment(request):
+        return redirect(result_url(public_id))
+
+    event = find_event(public_id)
+    response = render(request, "recommender/_result_card.html", {
+        "event": event,
+        "products_with_links": products_with_links(event),
+    })
+    response[LOCATION_HEADER] = result_url(public_id)
+    patch_vary_headers(response, (FRAGMENT_HEADER,))
+    return response
 
-def start_questionnaire(request):
+def _step_response(request, segment: str, tree: CompiledTree, node: int, token: str = ""):
+    """
+    Response after a POST moved the wizard to node: PRG redirect for plain
+    form posts, the next card (or result) directly for fragment requests.
+    """
+    if not _wants_fragment(request):
+        return redirect(_question_url(token))
+    if node < 0:
+        return redirect(_question_url(token))
+    if tree.is_leaf[node]:
+        funnel.record(segment, tree.keys[node])
+        if token:
+            parsed = read_token(token)
+            return _leaf_response(request, _log_leaf_stateless(tree, parsed.run_id, parsed.path, node))
+        return _leaf_response(request, _log_leaf(request, tree, node))
+    return _question_response(request, segment, tree, node, token=token)
+
+def _fresh_token(segment: str, tree: CompiledTree) -> str:
+    return issue_token(new_run_id(), segment, tree.version, ())
+
+def _restart(request, segment: str):
+    """Begin a new run on segment's tree (404 for unknown segments)."""
+    try:
+        tree = get_tree(segment)
+    except UnknownSegment:
+        raise Http404("Unknown questionnaire")
+    if _stateless():
+        return redirect(_question_url(_fresh_token(segment, tree)))
     _ensure_session(request)
-    _reset_flow(request)
+    _reset_flow(request, segment, tree)
     return redirect("recommender:question")
 
+def start_questionnaire(request, segment: str = ""):
+    return _restart(request, segment or request.GET.get("segment") or default_segment())
+
 def question(request):
     """
     One-question-per-page wizard.
     - GET shows current question node
     - POST records answer and advances
     - If node becomes leaf -> create RecommendationEvent and redirect to result page
+    - POSTs sent by the page script (X-BTN-Fragment: 1) get the next card back
+      directly instead of a redirect
     """
+    if _stateless():
+        return _question_stateless(request)
+
     _ensure_session(request)
 
-    node_id = request.session.get(SESSION_NODE_KEY, "q1")
-    node = TREE.get(node_id)
-    if not node:
-        # unknown node => restart cleanly
-        _reset_flow(request)
-        return redirect("recommender:question")
-
-    # Accumulate meta from current node (some nodes define goal/customer_type/etc)
-    meta = request.session.get(SESSION_META_KEY, {})
-    meta = _merge_meta(meta, node.get("meta", {}))
-    request.session[SESSION_META_KEY] = meta
-    request.session.modified = True
+    segment = request.session.get(SESSION_SEGMENT) or default_segment()
+    try:
+        tree = get_tree(segment)
+    except UnknownSegment:
+        # segment dropped from BTN_TREES mid-run => start over on the default tree
+        segment = default_segment()
+        tree = get_tree(segment)
+        _reset_flow(request, segment, tree)
+        return _step_response(request, segment, tree, tree.root)
+
+    node = tree.node_id(request.session.get(SESSION_NODE_KEY, tree.keys[tree.root]))
+    if node < 0 or request.session.get(SESSION_TREE_VERSION) != tree.version:
+        # unknown node, or the tree was reloaded mid-run => restart cleanly
+        _reset_flow(request, segment, tree)
+        return _step_response(request, segment, tree, tree.root)
 
     # If current node is leaf, log recommendation and go to result
-    if node.get("leaf") is True:
-        return _handle_leaf(request, node_id, node)
+    if tree.is_leaf[node]:
+        funnel.record(segment, tree.keys[node])
+        return _leaf_response(request, _log_leaf(request, tree, node))
 
-        # For non-leaf nodes, show question and options
+    # For non-leaf nodes, show question and options
     if request.method == "POST":
         action = request.POST.get("action", "next")
 
         # --- RESET / START OVER ---
         if action == "reset":
-            _reset_flow(request)
-            return redirect("recommender:question")
+            _reset_flow(request, segment, tree)
+            return _step_response(request, segment, tree, tree.root)
 
         # --- NEXT ---
-        choice = request.POST.get("choice")
-        choices_dict = node.get("choices", {})
+        choice = request.POST.get("choice") or ""
+        pos = tree.choice_index(node, choice)
 
-        if not choice or choice not in choices_dict:
+        if pos < 0:
             # Re-render with an error
-            choices = [(k, v["label"]) for k, v in choices_dict.items()]
-            return render(
-                request,
-                "recommender/question.html",
-                {
-                    "node_id": node_id,
-                    "question": node["text"],
-                    "choices": choices,
-                    "error": "Please select one option.",
-                },
-            )
+            return _question_response(request, segment, tree, node, error="Please select one option.")
+
+        funnel.record(segment, tree.keys[node], choice)
 
         # Store answer: key by node_id (robust for deep trees)
         answers = request.session.get(SESSION_ANSWERS_KEY, {})
-        answers[node_id] = choice
+        answers[tree.keys[node]] = choice
         request.session[SESSION_ANSWERS_KEY] = answers
 
-        # Advance to next node
-        next_node = choices_dict[choice]["next"]
-        request.session[SESSION_NODE_KEY] = next_node
+        # Advance to next node ("" => missing node, restarts on next GET)
+        next_node = tree.next_ids[node][pos]
+        request.session[SESSION_NODE_KEY] = tree.keys[next_node] if next_node >= 0 else ""
 
         # Any new path means last event id no longer relevant
         request.session.pop(SESSION_LAST_EVENT_ID, None)
 
         request.session.modified = True
-        return redirect("recommender:question")
+        return _step_response(request, segment, tree, next_node)
 
     # GET
-    choices = [(k, v["label"]) for k, v in node["choices"].items()]
-    return render(
-        request,
-        "recommender/question.html",
-        {"node_id": node_id, "question": node["text"], "choices": choices},
-    )
+    return _question_response(request, segment, tree, node)
 
-def _handle_leaf(request, node_id: str, node: Dict[str, Any]):
+def _log_leaf(request, tree: CompiledTree, node: int) -> str:
     """
     Create RecommendationEvent exactly once for a reached leaf.
     If the user refreshes, we don't create duplicates.
+    Returns the event's public_id.
     """
     last_event_id = request.session.get(SESSION_LAST_EVENT_ID)
-    if last_event_id:
+    if isinstance(last_event_id, str):  # (int: pk stored by older versions)
         # If already logged for this session leaf, just go to it
-        return redirect("recommender:result", event_id=last_event_id)
+        return last_event_id
 
     answers = request.session.get(SESSION_ANSWERS_KEY, {})
-    meta = request.session.get(SESSION_META_KEY, {})
-
-    event = RecommendationEvent.objects.create(
-        session_key=request.session.session_key,
-        answers=answers,
-        recommended_products=node.get("products", []),
-        product_links=node.get("links", []),
-        # store common dimensions if present (optional model fields)
-        segment=meta.get("segment", ""),
-        customer_type=meta.get("customer_type", ""),
-        goal=meta.get("goal", ""),
-    )
+    event = log_event(tree, node, request.session.session_key, answers, run_id=request.session.get(SESSION_RUN_ID, ""))
 
-    request.session[SESSION_LAST_EVENT_ID] = event.id
+    request.session[SESSION_LAST_EVENT_ID] = str(event.public_id)
     request.session.modified = True
-    return redirect("recommender:result", event_id=event.id)
+    return str(event.public_id)
 
-def result(request, event_id: int):
-    event = RecommendationEvent.objects.get(id=event_id)
+def _question_stateless(request):
+    """
+    Same wizard as question(), but the run lives in a signed path token (?t= /
+    hidden field) instead of the session, so no step writes to the database.
+    A token that fails the signature check gets a 400.
+    """
+    token = request.POST.get("t") or request.GET.get("t") or ""
+    parsed = read_token(token) if token else None
+    if token and parsed is None:
+        return HttpResponseBadRequest("Invalid questionnaire token")
+    segment = parsed.segment if parsed else default_segment()
+    try:
+        tree = get_tree(segment)
+    except UnknownSegment:
+        segment, parsed = default_segment(), None
+        tree = get_tree(segment)
 
-    # Pair by index, safe when lengths differ
-    products = event.recommended_products or []
-    links = event.product_links or []
+    node = tree.walk(parsed.path) if parsed and parsed.version == tree.version else -1
+    if node < 0:
+        # no token, or one issued for another tree version => new run
+        return _step_response(request, segment, tree, tree.root, token=_fresh_token(segment, tree))
 
-    products_with_links = []
-    for i, name in enumerate(products):
-        url = links[i] if i < len(links) else ""
-        products_with_links.append({"name": name, "url": url})
+    run_id, path = parsed.run_id, parsed.path
+    if tree.is_leaf[node]:
+        funnel.record(segment, tree.keys[node])
+        return _leaf_response(request, _log_leaf_stateless(tree, run_id, path, node))
 
-    return render(request, "recommender/result.html", {
-        "event": event,
-        "products_with_links": products_with_links,
-    })
+    if request.method == "POST":
+        if request.POST.get("action", "next") == "reset":
+            return _step_response(request, segment, tree, tree.root, token=_fresh_token(segment, tree))
 
-def _fig_to_base64(fig) -> str:
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png", bbox_inches="tight", dpi=160)
-    plt.close(fig)
-    buf.seek(0)
-    return base64.b64encode(buf.read()).decode("utf-8")
-
-
-def _pie_chart_base64(counter: Counter, title: str, max_slices: int = 8) -> str:
-    # Keep chart readable: top N + "Other"
-    items = counter.most_common(max_slices)
-    if not items:
-        # empty chart placeholder
-        fig = plt.figure(figsize=(5, 3))
-        plt.title(title)
-        plt.text(0.5, 0.5, "No data", ha="center", va="center")
-        plt.axis("off")
-        return _fig_to_base64(fig)
-
-    labels = [k if k else "(blank)" for k, _ in items]
-    sizes = [v for _, v in items]
-
-    remaining = sum(counter.values()) - sum(sizes)
-    if remaining > 0:
-        labels.append("Other")
-        sizes.append(remaining)
-
-    fig = plt.figure(figsize=(5, 4))
-    plt.title(title)
-    plt.pie(sizes, labels=labels, autopct="%1.0f%%", startangle=90)
-    plt.axis("equal")
-    return _fig_to_base64(fig)
-
-
-def _bar_chart_base64(counter: Counter, title: str, top_n: int = 10) -> str:
-    items = counter.most_common(top_n)
-    if not items:
-        fig = plt.figure(figsize=(6, 3))
-        plt.title(title)
-        plt.text(0.5, 0.5, "No data", ha="center", va="center")
-        plt.axis("off")
-        return _fig_to_base64(fig)
-
-    labels = [k if k else "(blank)" for k, _ in items]
-    values = [v for _, v in items]
-
-    fig = plt.figure(figsize=(8, 6))
-    plt.title(title)
-
-    # Horizontal bars
-    y_pos = range(len(values))
-    plt.barh(y_pos, values)
-    plt.yticks(y_pos, labels)
-
-    plt.xlabel("Count")
-    plt.tight_layout()
-    return _fig_to_base64(fig)
+        choice = request.POST.get("choice") or ""
+        pos = tree.choice_index(node, choice)
+        if pos < 0:
+            return _question_response(request, segment, tree, node, token=token, error="Please select one option.")
+        funnel.record(segment, tree.keys[node], choice)
+        next_token = issue_token(run_id, segment, tree.version, path + (pos,))
+        return _step_response(request, segment, tree, tree.next_ids[node][pos], token=next_token)
 
+    return _question_response(request, segment, tree, node, token=token)
 
-@admin_required
-def analytics(request):
+def _log_leaf_stateless(tree: CompiledTree, run_id: str, path, node: int) -> str:
     """
-    Analytics dashboard:
-    - KPI cards
-    - goal/customer type pie charts
-    - top products bar chart
-    - recent events table
+    Token-mode counterpart of _log_leaf: the run id doubles as session_key.
+    A refresh logs the same run again, which log_event turns into the same
+    event (same public_id) instead of a duplicate.
     """
-    qs = RecommendationEvent.objects.order_by("-created_at")
-    events = list(qs)
+    session_key = f"{STATELESS_SESSION_PREFIX}{run_id}"
+    return str(log_event(tree, node, session_key, tree.answers_for(path)).public_id)
+
+def result(request, public_id):
+    # with write-behind, a redirect can land on another worker before the
+    # event's row is flushed: wait for it, but only on a URL we just handed
+    # out (anything else is answered at once, so made-up ids stay cheap)
+    wait = result_wait_seconds() if may_wait(public_id, request.GET.get(WAIT_PARAM, "")) else 0
+    event = find_event(public_id, wait=wait)
+    if event is None:
+        raise Http404("Result not found")
 
-    total = len(events)
-    goal_counter = Counter((e.goal or "").strip() for e in events)
-    customer_type_counter = Counter((e.customer_type or "").strip() for e in events)
+    return render(request, "recommender/result.html", {
+        "event": event,
+        "products_with_links": products_with_links(event),
+    })
 
-    product_counter = Counter()
-    for e in events:
-        for p in (e.recommended_products or []):
-            p = (p or "").strip()
-            if p:
-                product_counter[p] += 1
+def result_by_id(request, event_id: int):
+    """Old /result/<id>/ links."""
+    try:
+        event = RecommendationEvent.objects.only("public_id").get(id=event_id)
+    except RecommendationEvent.DoesNotExist:
+        raise Http404("Result not found")
+    return redirect("recommender:result", public_id=event.public_id, permanent=True)
 
-    goal_chart = _pie_chart_base64(goal_counter, "Goals (Business/Individual)")
-    customer_type_chart = _pie_chart_base64(customer_type_counter, "Customer Type")
-    top_products_chart = _bar_chart_base64(product_counter, "Top Recommended Products", top_n=5)
+def _dashboard_data(filters: dashboard.Filters):
+    """
+    KPIs and chart series for the dashboard, aggregated in SQL (see dashboard.py):
+    {"kpis": {...}, "charts": {name: {"kind", "title", "labels", "values", "fp"}}}
+    ("line" charts are the per_day / per_hour trends, drawn in the browser only)
+    """
+    counters = dashboard.dimension_counters(filters)
+    goal_counter = counters["goal"]
+    customer_type_counter = counters["customer_type"]
+    product_counter = counters["product"]
 
     # Simple “most common” KPIs
     top_goal = goal_counter.most_common(1)[0][0] if goal_counter else "-"
     top_customer_type = customer_type_counter.most_common(1)[0][0] if customer_type_counter else "-"
     top_product = product_counter.most_common(1)[0][0] if product_counter else "-"
 
-    return render(request, "recommender/analytics.html", {
-        "events": events[:200],  # show latest 200 in table
+    chart_series = {}
+    for name, spec in charts.CHARTS.items():
+        data = charts.chart_data(name, counters[spec.dimension])
+        chart_series[name] = {
+            "kind": spec.kind,
+            "title": spec.title,
+            "labels": [label for label, _ in data],
+            "values": [value for _, value in data],
+            "fp": charts.fingerprint(name, data),
+        }
+    for name, data in dashboard.trends(filters).items():
+        chart_series[name] = {
+            "kind": "line",
+            "title": TREND_TITLES[name],
+            "labels": [label for label, _ in data],
+            "values": [value for _, value in data],
+            "fp": charts.fingerprint(name, data),
+        }
+
+    return {
         "kpis": {
-            "total": total,
+            "total": sum(goal_counter.values()),  # every event has exactly one goal row
+            "unique_sessions": sketches.unique_sessions(filters.date_from, filters.date_to, filters.dimensions()),
+            "unique_sessions_stale": sketches.stale(),
             "top_goal": top_goal or "-",
             "top_customer_type": top_customer_type or "-",
             "top_product": top_product or "-",
         },
-        "charts": {
-            "goal": goal_chart,
-            "customer_type": customer_type_chart,
-            "top_products": top_products_chart,
+        "charts": chart_series,
+    }
+
+
+@admin_required
+def analytics(request):
+    """
+    Analytics dashboard:
+    - KPI cards
+    - goal/customer type pie charts, top products bar chart (drawn in the
+      browser from the embedded data; refreshed from analytics_data)
+    - recent events table, newest first, paged by ?before= / ?after= cursors
+      (?page_size=, default BTN_ANALYTICS_PAGE_SIZE)
+    - all of it narrowed by ?from=&to= (days) and ?segment=&customer_type=&goal=
+    """
+    filters = dashboard.parse_filters(request.GET)
+    data = _dashboard_data(filters)
+    filter_query = urlencode(filters.params())
+    chart_images = {
+        name: reverse("recommender:analytics_chart", kwargs={"name": name, "fingerprint": series["fp"]})
+        + (f"?{filter_query}" if filter_query else "")
+        for name, series in data["charts"].items()
+        if name in charts.CHARTS
+    }
+    default_size = getattr(settings, "BTN_ANALYTICS_PAGE_SIZE", 50)
+    try:
+        page_size = max(1, min(int(request.GET.get("page_size", default_size)), MAX_ANALYTICS_PAGE_SIZE))
+    except ValueError:
+        page_size = default_size
+    page = keyset_page(
+        dashboard.filter_events(
+            RecommendationEvent.objects.only("id", "created_at", "segment", "customer_type", "goal", "recommended_products"),
+            filters,
+        ),
+        page_size,
+        before=request.GET.get("before", ""),
+        after=request.GET.get("after", ""),
+    )
+    attach_product_names(page.rows)
+
+    return render(request, "recommender/analytics.html", {
+        "events": page.rows,
+        "page": page,
+        "page_size": page_size,
+        "kpis": data["kpis"],
+        "dashboard_data": data,
+        "chart_images": chart_images,  # <noscript> fallback
+        "export_urls": {
+            fmt: reverse("recommender:analytics_export") + "?" + urlencode({**filters.params(), "format": fmt, "gzip": 1})
+            for fmt in export.FORMATS
+        },
+        "filters": filters,
+        "filter_options": {
+            "segment": registry().segments(),
+            "customer_type": sorted(v for v in rollups.totals("customer_type") if v),
+            "goal": sorted(v for v in rollups.totals("goal") if v),
         },
     })
 
+@admin_required
+def analytics_data(request):
+    """
+    Dashboard KPIs and chart series as JSON (same filter parameters as
+    analytics). The ETag is a hash of the body, so a client polling with
+    If-None-Match gets 304 until counts change.
+    """
+    filters = dashboard.parse_filters(request.GET)
+    body = json.dumps(_dashboard_data(filters), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = quote_etag(hashlib.sha256(body).hexdigest()[:32])
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+@admin_required
+def analytics_chart(request, name: str, fingerprint: str):
+    """
+    One dashboard chart as PNG (same filter parameters as analytics). The
+    URL names the data version, so the image never changes and is cached by
+    the browser for a year.
+    """
+    if name not in charts.CHARTS:
+        raise Http404("Unknown chart")
+
+    png, fresh = charts.cached_png(name, fingerprint), True
+    if png is None:
+        filters = dashboard.parse_filters(request.GET)
+        counters = dashboard.dimension_counters(filters)
+        data = charts.chart_data(name, counters[charts.CHARTS[name].dimension])
+        current = charts.fingerprint(name, data)
+        query = urlencode(filters.params())
+        if current != fingerprint:
+            # an old version this worker does not have: show the current one
+            url = reverse("recommender:analytics_chart", kwargs={"name": name, "fingerprint": current})
+            return redirect(f"{url}?{query}" if query else url)
+        png, fresh = charts.png_for(name, data, current, variant=query)
+
+    response = HttpResponse(png, content_type="image/png")
+    if fresh:
+        patch_cache_control(response, private=True, max_age=365 * 24 * 3600, immutable=True)
+    else:
+        # the previous version while this one renders: not to be kept under this URL
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@admin_required
+def analytics_export(request):
+    """
+    Stream the events matching the dashboard filters as a download:
+    ?format=csv (default) or ndjson, ?gzip=1 to compress on the fly.
+    Rows are read in chunks, so any number of events is exported in
+    constant memory (see export.py).
+    """
+    fmt = request.GET.get("format", "csv")
+    if fmt not in export.FORMATS:
+        return HttpResponseBadRequest("format must be 'csv' or 'ndjson'")
+    gzip = request.GET.get("gzip") in ("1", "true", "yes")
+
+    filters = dashboard.parse_filters(request.GET)
+    qs = dashboard.filter_events(RecommendationEvent.objects.all(), filters)
+    if gzip:
+        content_type = "application/gzip"
+    else:
+        content_type = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+    response = StreamingHttpResponse(export.stream(qs, fmt, gzip=gzip), content_type=content_type)
+    name = export.filename(fmt, gzip, timezone.localtime().strftime("%Y%m%d-%H%M%S"))
+    response["Content-Disposition"] = f'attachment; filename="{name}"'
+    patch_cache_control(response, private=True, no_store=True)
+    return response
+
+@admin_required
+def analytics_funnel(request):
+    """
+    Questionnaire funnel of one tree (?segment=, default tree otherwise):
+    views, picked choices and drop-off per node, breadth first from the
+    root. ?from=&to= narrow the days as on the dashboard.
+    """
+    filters = dashboard.parse_filters(request.GET)
+    segment = filters.segment or default_segment()
+    try:
+        tree = get_tree(segment)
+    except UnknownSegment:
+        raise Http404("Unknown questionnaire")
+
+    return render(request, "recommender/analytics_funnel.html", {
+        "segment": segment,
+        "segments": registry().segments(),
+        "filters": filters,
+        "nodes": funnel.funnel(tree, segment, filters.date_from, filters.date_to),
+    })
+
+@admin_required
+def analytics_choices(request):
+    """
+    How often each choice was picked at one question (?node=, the root
+    otherwise) of one tree (?segment=, default tree otherwise), counted in
+    the database (see choice_report.py). Dashboard filters apply.
+    """
+    filters = dashboard.parse_filters(request.GET)
+    segment = filters.segment or default_segment()
+    try:
+        tree = get_tree(segment)
+    except UnknownSegment:
+        raise Http404("Unknown questionnaire")
+    filters = filters._replace(segment=segment)
+
+    node = tree.node_id(request.GET.get("node", ""))
+    if node < 0 or tree.is_leaf[node]:
+        node = tree.root
+    rows = choice_report.choice_report(tree, node, filters)
+
+    return render(request, "recommender/analytics_choices.html", {
+        "segment": segment,
+        "segments": registry().segments(),
+        "filters": filters,
+        "node": tree.keys[node],
+        "question": tree.texts[node] or tree.keys[node],
+        "questions": [(key, tree.texts[i] or key) for i, key in enumerate(tree.keys) if not tree.is_leaf[i]],
+        "rows": rows,
+        "total": sum(row.count for row in rows),
+    })
+
+@admin_required
+def analytics_paths(request):
+    """
+    Answer paths of one tree (?segment=, default tree otherwise), all time:
+    the branches taken after ?at=<prefix> with their share, to drill down
+    step by step, and the most common full paths (see paths.py).
+    """
+    segment = request.GET.get("segment") or default_segment()
+    try:
+        tree = get_tree(segment)
+    except UnknownSegment:
+        tree = None  # no longer configured: keys instead of labels
+        if not paths.children(segment):
+            raise Http404("Unknown questionnaire")
+
+    return render(request, "recommender/analytics_paths.html", {
+        "segment": segment,
+        "segments": registry().segments(),
+        "drill": paths.drill_down(tree, segment, request.GET.get("at", "")),
+        "top_paths": [(*paths.describe_path(tree, row), row.ends) for row in paths.top_paths(segment)],
+    })
+
 @admin_required
 def analytics_detail(request, event_id: int):
     """
@@ -350,24 +647,16 @@ def analytics_detail(request, event_id: int):
     except RecommendationEvent.DoesNotExist:
         raise Http404("Event not found")
 
-    # Pair by index, safe when lengths differ
-    products = event.recommended_products or []
-    links = event.product_links or []
-
-    products_with_links = []
-    for i, name in enumerate(products):
-        url = links[i] if i < len(links) else ""
-        products_with_links.append({"name": name, "url": url})
-
     return render(request, "recommender/analytics_detail.html", {
         "event": event,
-        "products_with_links": products_with_links,
+        "products_with_links": products_with_links(event),
     })
 
 def restart(request):
     """
     Convenience endpoint if you want a 'Restart' link.
     """
-    _ensure_session(request)
-    _reset_flow(request)
-    return redirect("recommender:question")
+    segment = request.GET.get("segment")
+    if not segment and not _stateless():
+        segment = request.session.get(SESSION_SEGMENT)
+    return _restart(request, segment or default_segment())